@@ -14,6 +14,7 @@ import tkFileDialog
 from Tkinter import *
 
 from pipemodules.functs import get_datetime
+import pipemodules.service as service
 
 # the file and directory path to this script: in case you call it from 
 # another directory, so relative paths to the script are still intact
@@ -687,6 +688,10 @@ class Application(Frame):
             except IOError:
                 print "ERROR\tcouldn't find {}".format(argslist[0])
                 return
+            if service.available():
+                # the pipeline service already has IRAF loaded
+                print "INFO\tsubmitting to pipeline service"
+                pipeproc = service.ServiceJob(argslist[0],argslist[1:])
             else:
                 pipeproc = subprocess.Popen(["python2.7"]+argslist,stdout=subprocess.PIPE,
                                             stderr=subprocess.STDOUT,
@@ -45,11 +45,39 @@ IMAGEMAXOBJ = 85
 IMAGETHRESH = 25
 TEMPTHRESH = 25
 
+# object finding
+# "sex" - the bundled SExtractor (pipemodules/Sex)
+# "numpy" - pipemodules.sourcefind, in process on the image in memory. no
+#           deblending, CLASS_STAR or world coordinates
+SEXMETHOD = "sex"
+
 # saturation limit used by SExtractor and cosmic ray removal
 # being a bit conservative probably works best
 IMAGESATLIMIT = 55000
 TEMPSATLIMIT = 55000
 
+# cosmic ray detection can be split into overlapping tiles of COSMICTILESIZE
+# pixels, detected across COSMICNPROC processes (None for the cpu count).
+# the result is the same as for the whole frame. 0 to not split. only worth
+# it with cores to spare, i.e. not alongside run-subpipe -j using them all
+COSMICTILESIZE = 0
+COSMICNPROC = None
+# cosmic ray removal in float32, reusing its work arrays, for a fraction of
+# the memory (e.g. to run more processes per node). differs by rounding only
+COSMICLOWMEM = False
+# after the first iteration, only detect cosmic rays again around the pixels
+# the last cleaning changed (the result is the same), and stop iterating once
+# an iteration finds fewer than COSMICMINNEW new cosmic ray pixels
+COSMICINCREMENTAL = True
+COSMICMINNEW = 0
+
+# a directory, shared by runs and workdirs, to keep the cleaned template and
+# its products (information, object lists, aperture correction) in, so a run
+# on a template another run has prepared starts with them ready. entries are
+# per template, fringe frame, bad pixel mask, cleaning options and PIPEcfg.py
+# contents. None to not cache
+TEMPLATECACHE = None
+
 # the limits of sum_kernel (see ISIS code for description)
 # if the value falls outside these limits, the  subtraction is deemed to be
 # incorrect and is ran in reverse
@@ -69,6 +97,21 @@ MINSUMKERNEL = 0.0
 XYXYMATCH = True
 WREGISTER = False
 
+# object matching for XYXYMATCH alignment
+# "iraf" - iraf.xyxymatch (triangles, then SEARCHRAD, then tolerance matching)
+# "numpy" - pipemodules.starmatch, in process and without IRAF. uses XYTOL,
+#           XYNMATCH and XYSEP below in the same way
+MATCHMETHOD = "iraf"
+
+# transformation for XYXYMATCH alignment, once objects are matched
+# "iraf" - iraf.geomap and iraf.geotran
+# "numpy" - pipemodules.geotrans, in process and without IRAF
+TRANSMETHOD = "iraf"
+GEOORDER = 1            # "numpy" only: 1 for the general linear transform
+                        # (shift, rotation, scale, skew), 2+ adds distortion
+GEOREJECT = 3           # "numpy" only: reject matches this many sigma from
+                        # the fit, 0 for none
+
 # XYXYMATCH params (see iraf.xyxymatch help for info)
 XYTOL = 3               # tolerance
 XYNMATCH = 60           # nmatch (CPU time can rocket if this is too high)
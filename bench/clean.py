@@ -0,0 +1,103 @@
+#! /usr/bin/env python2.7
+"""
+cosmics clean benchmark
+
+times cosmicsimage.clean on test/image.fits with synthetic bad pixel masks
+(scattered pixels, bad columns and clumps), against the per pixel loop it
+replaced, and checks the two give the same replacement values. run from
+anywhere:
+
+    python2.7 bench/clean.py [-n repeats] [-f fraction ...]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+import pyfits
+
+FILEDIR = os.path.dirname(os.path.realpath(__file__))
+CLASPDIR = os.path.dirname(FILEDIR)
+sys.path.insert(0,CLASPDIR)
+
+import pipemodules.cosmics as cosmics
+
+IMAGE = os.path.join(CLASPDIR,'test','image.fits')
+
+def make_mask(shape,fraction,seed=0):
+    """
+    a mask with `fraction` of the pixels flagged: mostly scattered pixels,
+    plus a few bad columns, 3x3 clumps and three 5x5 clumps (whose centres
+    have no good pixels to use)
+    """
+    rng = np.random.RandomState(seed)
+    mask = rng.rand(*shape) < fraction
+    for x in rng.randint(2,shape[1]-2,3):
+        mask[:,x] = True
+    for y,x in rng.randint(5,min(shape)-5,(20,2)):
+        mask[y-1:y+2,x-1:x+2] = True
+    for y,x in rng.randint(5,min(shape)-5,(3,2)):
+        mask[y-2:y+3,x-2:x+3] = True
+    return mask
+
+
+def clean_loop(c,mask):
+    """
+    the per pixel loop cosmicsimage.clean used to run, on a copy of c's
+    cleanarray
+    """
+    cleanarray = c.cleanarray.copy()
+    cleanarray[mask] = np.Inf
+    w,h = cleanarray.shape
+    padarray = np.zeros((w+4,h+4))+np.Inf
+    padarray[2:w+2,2:h+2] = cleanarray.copy()
+    if c.satstars is not None:
+        padarray[2:w+2,2:h+2][c.satstars] = np.Inf
+    for x,y in np.argwhere(mask):
+        cutout = padarray[x:x+5,y:y+5].ravel()
+        goodcutout = cutout[cutout != np.Inf]
+        if len(goodcutout) > 0:
+            cleanarray[x,y] = np.median(goodcutout)
+        else:
+            cleanarray[x,y] = c.guessbackgroundlevel()
+    return cleanarray
+
+
+def time_clean(data,mask,repeats):
+    times = []
+    for i in range(repeats):
+        c = cosmics.cosmicsimage(data,satlevel=-1)
+        c.mask = mask
+        t0 = time.time()
+        c.clean()
+        times.append(time.time()-t0)
+    return min(times),c.cleanarray
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time cosmics clean')
+    parser.add_argument('-n',dest='repeats',type=int,default=3,
+                        help='runs of each case (default: 3)')
+    parser.add_argument('-f',dest='fractions',type=float,nargs='+',
+                        default=[0.001,0.01,0.05],
+                        help='fractions of pixels to mask '
+                             '(default: 0.001 0.01 0.05)')
+    args = parser.parse_args()
+    # the 5x5 clumps would otherwise log a warning on every run
+    logging.basicConfig(level=logging.ERROR)
+
+    data = pyfits.getdata(IMAGE).astype(np.float64)
+    print '{0:>9} {1:>9} {2:>10} {3:>10} {4:>6}'.format('fraction','pixels',
+                                             'loop (s)','bulk (s)','same')
+    for fraction in args.fractions:
+        mask = make_mask(data.shape,fraction)
+        c = cosmics.cosmicsimage(data,satlevel=-1)
+        t0 = time.time()
+        expected = clean_loop(c,mask)
+        looptime = time.time()-t0
+        bulktime,result = time_clean(data,mask,args.repeats)
+        same = np.array_equal(result,expected)
+        print '{0:>9g} {1:>9} {2:>10.3f} {3:>10.3f} {4:>6}'.format(fraction,
+                                    mask.sum(),looptime,bulktime,str(same))
@@ -0,0 +1,132 @@
+#! /usr/bin/env python2.7
+"""
+L.A.Cosmic detection benchmark
+
+times one L.A.Cosmic detection (cosmics.detectcosmics) on test/image.fits
+with synthetic cosmic rays added, against the operators it used to run (the
+laplacian of the 2x2 subsampled frame with convolve2d, and mask growth by
+convolve2d of float32 casts), per operator and in total, and checks the two
+give the same L+ and the same mask. run from anywhere:
+
+    python2.7 bench/lacosmic.py [-n repeats] [-c cosmics]
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pyfits
+from scipy import signal, ndimage
+
+FILEDIR = os.path.dirname(os.path.realpath(__file__))
+CLASPDIR = os.path.dirname(FILEDIR)
+sys.path.insert(0,CLASPDIR)
+
+import pipemodules.cosmics as cosmics
+
+IMAGE = os.path.join(CLASPDIR,'test','image.fits')
+
+GAIN = 2.2
+READNOISE = 10.0
+SIGCLIP = 5.0
+SIGFRAC = 0.3
+OBJLIM = 5.0
+
+def add_cosmics(data,ncosmics,seed=0):
+    """
+    data with ncosmics single pixel hits and short tracks added
+    """
+    rng = np.random.RandomState(seed)
+    data = data.copy()
+    for y,x in rng.randint(2,min(data.shape)-2,(ncosmics,2)):
+        length = rng.randint(1,5)
+        dy,dx = rng.randint(-1,2,2)
+        for i in range(length):
+            data[y+i*dy,x+i*dx] += rng.uniform(500,20000)
+    return data
+
+
+def laplacian_old(a):
+    subsam = cosmics.subsample(a)
+    conved = signal.convolve2d(subsam,cosmics.laplkernel,mode='same',
+                               boundary='symm')
+    return cosmics.rebin(conved.clip(min=0.0),a.shape)
+
+
+def grow_old(mask):
+    return np.cast['bool'](signal.convolve2d(np.cast['float32'](mask),
+                           cosmics.growkernel,mode='same',boundary='symm'))
+
+
+def grow_new(mask):
+    return ndimage.binary_dilation(mask,structure=cosmics.growkernel)
+
+
+def detect_old(cleanarray,satstars,gain,readnoise,sigclip,sigcliplow,objlim):
+    """
+    cosmics.detectcosmics as it was, with the old operators
+    """
+    lplus = laplacian_old(cleanarray)
+    m5 = ndimage.filters.median_filter(cleanarray,size=5,mode='mirror')
+    noise = (1.0/gain)*np.sqrt(gain*m5.clip(min=0.00001)+readnoise*readnoise)
+    s = lplus/(2.0*noise)
+    sp = s-ndimage.filters.median_filter(s,size=5,mode='mirror')
+    candidates = sp > sigclip
+    if satstars is not None:
+        candidates = np.logical_and(np.logical_not(satstars),candidates)
+    m3 = ndimage.filters.median_filter(cleanarray,size=3,mode='mirror')
+    m37 = ndimage.filters.median_filter(m3,size=7,mode='mirror')
+    f = ((m3-m37)/noise).clip(min=0.01)
+    found = np.logical_and(candidates,sp/f > objlim)
+    growcosmics = np.logical_and(sp > sigclip,grow_old(found))
+    finalsel = np.logical_and(sp > sigcliplow,grow_old(growcosmics))
+    if satstars is not None:
+        finalsel = np.logical_and(np.logical_not(satstars),finalsel)
+    return finalsel
+
+
+def best(func,args,repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        result = func(*args)
+        times.append(time.time()-t0)
+    return min(times),result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time L.A.Cosmic detection')
+    parser.add_argument('-n',dest='repeats',type=int,default=3,
+                        help='runs of each case (default: 3)')
+    parser.add_argument('-c',dest='ncosmics',type=int,default=2000,
+                        help='cosmic rays to add (default: 2000)')
+    args = parser.parse_args()
+
+    data = add_cosmics(pyfits.getdata(IMAGE).astype(np.float64),
+                       args.ncosmics)
+    c = cosmics.cosmicsimage(data,gain=GAIN,readnoise=READNOISE,
+                             sigclip=SIGCLIP,sigfrac=SIGFRAC,objlim=OBJLIM)
+    c.findsatstars()
+    cleanarray,satstars = c.cleanarray,c.satstars
+    params = (GAIN,READNOISE,SIGCLIP,SIGCLIP*SIGFRAC,OBJLIM)
+
+    print '{0:>12} {1:>9} {2:>9} {3:>8} {4:>6}'.format('operator','old (s)',
+                                               'new (s)','speedup','same')
+    def report(name,old,new):
+        (told,rold),(tnew,rnew) = old,new
+        print '{0:>12} {1:>9.3f} {2:>9.3f} {3:>7.1f}x {4:>6}'.format(name,
+                         told,tnew,told/tnew,str(np.array_equal(rold,rnew)))
+
+    report('laplacian',best(laplacian_old,(cleanarray,),args.repeats),
+                       best(cosmics.laplacianplus,(cleanarray,),args.repeats))
+    mask = cosmics.detectcosmics(cleanarray,satstars,*params)
+    report('grow',best(grow_old,(mask,),args.repeats),
+                  best(grow_new,(mask,),args.repeats))
+    report('iteration',
+           best(detect_old,(cleanarray,satstars)+params,args.repeats),
+           best(cosmics.detectcosmics,(cleanarray,satstars)+params,
+                args.repeats))
+    print '%i cosmic pixels found in a %ix%i frame' % (mask.sum(),
+                                                      data.shape[0],
+                                                      data.shape[1])
@@ -0,0 +1,54 @@
+#! /usr/bin/env python2.7
+"""
+startup time benchmark
+
+times, in fresh interpreters, importing the pipeline modules (which should
+no longer touch pyraf, see pipemodules/lazyiraf.py) and the cost of pyraf
+and its packages when they are first needed. run from anywhere:
+
+    python2.7 bench/startup.py [-n repeats]
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+FILEDIR = os.path.dirname(os.path.realpath(__file__))
+CLASPDIR = os.path.dirname(FILEDIR)
+
+CASES = [('python','pass'),
+         ('import subpipe','import subpipe'),
+         ('import photpipe','import photpipe'),
+         ('import subpipe,photpipe','import subpipe,photpipe'),
+         ('pyraf imported',
+          'import subpipe; subpipe.iraf.unlearn'),
+         ('all packages loaded',
+          'import subpipe; subpipe.iraf.preload()')]
+
+def time_case(statement,repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        code = subprocess.call([sys.executable,'-c',statement],cwd=CLASPDIR,
+                               stdout=open(os.devnull,'w'),
+                               stderr=subprocess.STDOUT)
+        times.append(time.time()-t0)
+        if code:
+            return None
+    return sorted(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time pipeline start up')
+    parser.add_argument('-n',dest='repeats',type=int,default=5,
+                        help='runs of each case (default: 5)')
+    args = parser.parse_args()
+
+    print '{0:<26} {1:>9} {2:>9}'.format('case','min (s)','median (s)')
+    for name,statement in CASES:
+        times = time_case(statement,args.repeats)
+        if times is None:
+            print '{0:<26} {1:>9}'.format(name,'failed')
+            continue
+        print '{0:<26} {1:>9.3f} {2:>9.3f}'.format(name,times[0],
+                                                   times[len(times)//2])
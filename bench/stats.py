@@ -0,0 +1,136 @@
+#! /usr/bin/env python2.7
+"""
+image statistics benchmark
+
+times functs.get_stats (chunked clipped_stats passes) against the copying,
+boolean indexing version it replaced, on test/image.fits and on larger
+synthetic frames (sky, stars and a zero border, as an aligned image), and
+shows how far apart their results are. also shows the error of the strided
+sample get_stats takes of frames over maxpixels. run from anywhere:
+
+    python2.7 bench/stats.py [-n repeats] [-s size ...]
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pyfits
+
+FILEDIR = os.path.dirname(os.path.realpath(__file__))
+CLASPDIR = os.path.dirname(FILEDIR)
+sys.path.insert(0,CLASPDIR)
+
+import pipemodules.functs as functs
+
+IMAGE = os.path.join(CLASPDIR,'test','image.fits')
+
+def get_stats_old(data,rmzeros=False):
+    """
+    functs.get_stats as it was (without the sampling of large frames)
+    """
+    try:
+        ysize,xsize = data.shape
+    except ValueError:
+        ysize = data.shape[0]
+        xsize = 1
+    npixels = data.size
+    if rmzeros:
+        data = data[data!=0]
+    tstddev = np.std(data)
+    data3 = data.copy()
+    for i in range(2):
+        stddev = np.std(data3)
+        mean = np.sum(data3)/len(data3.ravel())
+        clipmin = mean - 3 * stddev
+        clipmax = mean + 3 * stddev
+        data3 = data3[data3>clipmin]
+        data3 = data3[data3<clipmax]
+    if len(data3) < float(npixels)/100:
+        data3 = data
+    stddev = np.std(data3)
+    mean = np.sum(data3)/len(data3.ravel())
+    datamin = mean - 5*stddev
+    return {'xsize':xsize,'ysize':ysize,'mean':mean,
+            'stddev':stddev,'tstddev':tstddev,'datamin':datamin}
+
+
+def make_frame(size,seed=0):
+    """
+    a float32 frame of sky noise with stars, cosmics and a zero border
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.normal(1000,20,(size,size)).astype(np.float32)
+    n = size*size//2000
+    data[rng.randint(0,size,n),rng.randint(0,size,n)] += \
+        rng.uniform(100,50000,n).astype(np.float32)
+    data[:size//20] = 0
+    data[:,-size//20:] = 0
+    return data
+
+
+def best(func,args,kwargs,repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        result = func(*args,**kwargs)
+        times.append(time.time()-t0)
+    return min(times),result
+
+
+def reldiff(a,b):
+    return max(abs(a[k]-b[k])/abs(b['stddev'])
+               for k in ('mean','stddev','tstddev','datamin'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time get_stats')
+    parser.add_argument('-n',dest='repeats',type=int,default=3,
+                        help='runs of each case (default: 3)')
+    parser.add_argument('-s',dest='sizes',type=int,nargs='+',
+                        default=[2048,4096],
+                        help='sizes of the synthetic frames '
+                             '(default: 2048 4096)')
+    args = parser.parse_args()
+
+    frames = [('image.fits',pyfits.getdata(IMAGE))]
+    for size in args.sizes:
+        frames.append(('%ix%i' % (size,size),make_frame(size)))
+
+    print '{0:>12} {1:>8} {2:>9} {3:>9} {4:>8} {5:>10}'.format('frame',
+                   'rmzeros','old (s)','new (s)','speedup','difference')
+    for name,data in frames:
+        for rmzeros in (False,True):
+            told,old = best(get_stats_old,(data,),{'rmzeros':rmzeros},
+                            args.repeats)
+            tnew,new = best(functs.get_stats,(data,),
+                            {'rmzeros':rmzeros,'maxpixels':None},
+                            args.repeats)
+            print '{0:>12} {1:>8} {2:>9.3f} {3:>9.3f} {4:>7.1f}x {5:>10.2g}'\
+                  .format(name,str(rmzeros),told,tnew,told/tnew,
+                          reldiff(new,old))
+    print '(difference: largest of mean, stddev, tstddev, datamin, ' \
+          'in units of stddev)'
+    print
+
+    print '{0:>12} {1:>10} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+          'frame','maxpixels','time (s)','mean','stddev','tstddev','bound')
+    name,data = frames[-1]
+    tfull,full = best(functs.get_stats,(data,),
+                      {'rmzeros':True,'maxpixels':None},args.repeats)
+    for maxpixels in (2**22,2**20,2**18,2**16):
+        if maxpixels >= data.size:
+            continue
+        t,result = best(functs.get_stats,(data,),
+                        {'rmzeros':True,'maxpixels':maxpixels},args.repeats)
+        print '{0:>12} {1:>10} {2:>9.3f} {3:>9.2g} {4:>9.2g} {5:>9.2g} ' \
+              '{6:>9.2g}'.format(name,maxpixels,t,
+                  abs(result['mean']-full['mean'])/full['stddev'],
+                  abs(result['stddev']/full['stddev']-1),
+                  abs(result['tstddev']/full['tstddev']-1),
+                  1/np.sqrt(functs.sample(data,maxpixels).size))
+    print '(errors of the sampled stats: mean in units of stddev, stddev ' \
+          'and tstddev relative;'
+    print ' bound: 1/sqrt(pixels sampled), the expected error of mean and ' \
+          'stddev)'
@@ -13,18 +13,14 @@ import math
 import subprocess
 from glob import glob
 
-from pyraf import iraf
 import numpy as np
 
-# load necessary iraf packages
-iraf.tv(_doprint=0)
-iraf.noao(_doprint=0)
-iraf.digiphot(_doprint=0)
-iraf.ptools(_doprint=0)
-iraf.photcal(_doprint=0)
-iraf.apphot(_doprint=0)
+import pipemodules.functs as functs
+import pipemodules.crossmatch as crossmatch
+import pipemodules.templatecache as templatecache
+# pyraf is imported and the iraf packages loaded on first use, see lazyiraf
+from pipemodules.lazyiraf import iraf
 
-iraf.unlearn(iraf.display)
 DS9DELAY = 15 # delay time in seconds to allow ds9 to load, extend if 
              # faling with error when trying to load images
 
@@ -112,6 +108,18 @@ class PhotometryPipeline(object):
         else:
             logger.info('starlist found as: %s' % self.starcoordsfile)     
 
+        # the template's aperture correction products are shared across
+        # workdirs through the template cache (see run-subpipe), keyed by
+        # the cleaned template and everything else its photometry uses
+        templatecache.set_cachedir(TEMPLATECACHE)
+        self.templatephotkey = None
+        if getattr(si,'templatekey',None):
+            self.templatephotkey = functs.get_hash([self.starcoordsfile],
+                                    [si.templatekey,self.apcorapertures,
+                                     IMAGESATLIMIT,RDNOISEHDR,GAINHDR,EXPHDR,
+                                     self.a.readnoise,self.a.gain,
+                                     self.a.exptime])
+
         self.fail = None
         
         # start the main method
@@ -164,6 +172,7 @@ class PhotometryPipeline(object):
         numobj = len(np.atleast_2d(a))
         # now load the template and mark the stars in the ds9 window
         loaded = False
+        iraf.unlearn(iraf.display)
         for i in range(DS9DELAY):
             try:
                 iraf.display(self.template,1)
@@ -355,6 +364,11 @@ class PhotometryPipeline(object):
         self.templatestarphotfile = self.basetemplate+".apcorphot"
         self.templatemkapfile = self.basetemplate+".mkap"
         self.templateapcorfile = self.basetemplate+".apcor"
+        apcorsuffixes = ['.apcorphot','.mkap','.apcor']
+        if self.templatephotkey and \
+           not os.path.isfile(self.templatemkapfile):
+            templatecache.fetch(self.templatephotkey,self.basetemplate,
+                                apcorsuffixes)
         try:
             open(self.templatestarphotfile)
             open(self.templatemkapfile)
@@ -365,6 +379,9 @@ class PhotometryPipeline(object):
                 logger.error("cog model failed on template!"
                              "try selcting different stars to use")
                 return
+            if self.templatephotkey:
+                templatecache.save(self.templatephotkey,self.basetemplate,
+                                   apcorsuffixes)
         # then for the image
         self.imagestarphotfile = self.basealignedimage+".apcorphot"
         self.imagemkapfile = self.basealignedimage+".mkap"
@@ -399,15 +416,10 @@ class PhotometryPipeline(object):
         logger.info("calculating image-template median offset")
         ta = np.atleast_2d(np.genfromtxt(self.templatemkapfile))
         ia = np.atleast_2d(np.genfromtxt(self.imagemkapfile))
-        offsets = []
-        offsetserr = []
-        for x in range(len(ia)):
-            for y in range(len(ta)):
-                r = ((ia[x,5] - ta[y,5])**2 + (ia[x,6] - ta[y,6])**2)**0.5
-                if r < 3:
-                    offsets.append(ta[y,7]-ia[x,7])
-                    offsetserr.append((ta[y,8]**2+ia[x,8]**2)**0.5)
-                    break
+        # pair each image star with the nearest template star within 3 pix
+        i,t,sep = crossmatch.match(ia[:,5:7],ta[:,5:7],3)
+        offsets = list(ta[t,7]-ia[i,7])
+        offsetserr = list((ta[t,8]**2+ia[i,8]**2)**0.5)
         self.numoffsetstars = len(offsets)         
         
         if self.numoffsetstars == 0:
@@ -472,6 +484,7 @@ def get_object_coords(workdir):
     image = subimages[imgnum]
     # wait for ds9 to load by sleeping between attempts to open image
     loaded = False
+    iraf.unlearn(iraf.display)
     for i in range(int(math.ceil(DS9DELAY*0.8))):
         try:
             iraf.display(image,frame=1,Stderr=1)
@@ -4,4 +4,7 @@ pipeline
 
 """
 
-__all__ = ["functs","cosmics","f2n","myalardwrap"]
+__all__ = ["functs","cosmics","f2n","myalardwrap","scratch","jobqueue",
+           "service","lazyiraf","starmatch","geotrans","crossmatch",
+           "sexcache","sourcefind","imagecontext","templatecache",
+           "resultstore"]
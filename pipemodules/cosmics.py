@@ -67,9 +67,11 @@ Malte Tewes, January 2010
 __version__ = '0.4'
 
 import os, sys
+import resource
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import math
-import scipy.signal as signal
 import scipy.ndimage as ndimage
 import pyfits
 import logging
@@ -93,10 +95,22 @@ dilstruct[4,4] = 0
 #	01110
 # and is used to dilate saturated stars and connect cosmic rays.
 
+# Number of cosmic pixels whose 5x5 cutouts clean() gathers at a time (25 floats each)
+CLEANCHUNK = 2**16
+
+# Width of the border of neighbouring pixels a tile needs (see cosmicsimage.detecttiled) for its cosmics to come
+# out as from the whole frame : the 5x5 median of s, on the noise from a 5x5 median, reaches 4 pixels (as does
+# the 3x3 then 7x7 median of f), and the cosmics are then grown twice by a pixel.
+TILEHALO = 6
+
+# In incremental mode (see cosmicsimage.detectincremental), the frame is detected whole again rather than
+# around its changed pixels once these regions cover more than this fraction of it.
+INCREMENTALMAXFRACTION = 0.5
+
 	
 class cosmicsimage:
 
-	def __init__(self, rawarray, pssl=0.0, gain=2.2, readnoise=10.0, sigclip = 5.0, sigfrac = 0.3, objlim = 5.0, satlevel = 50000.0, bpm=None, trimborder=0, usebin=False, verbose=False):
+	def __init__(self, rawarray, pssl=0.0, gain=2.2, readnoise=10.0, sigclip = 5.0, sigfrac = 0.3, objlim = 5.0, satlevel = 50000.0, bpm=None, trimborder=0, usebin=False, verbose=False, tilesize=0, nproc=None, lowmem=False, incremental=False):
 		"""
 		
 		sigclip : increase this if you detect cosmics where there are none. Default is 5.0, a good value for earth-bound images.
@@ -106,6 +120,12 @@ class cosmicsimage:
 		sigclip : laplacian-to-noise limit for cosmic ray detection 
 		objlim : minimum contrast between laplacian image and fine structure image. Use 5.0 if your image is undersampled, HST, ...
 		
+		lowmem : work in float32 (rather than the dtype of rawarray), and keep and reuse work arrays.
+		Results differ from the float64 ones only by rounding.
+		
+		incremental : after the first iteration, only detect again around the pixels clean() changed.
+		Results are the same.
+		
 		satlevel : if we find agglomerations of pixels above this level, we consider it to be a saturated star and
 		do not try to correct and pixels around it. A negative satlevel skips this feature.
 		
@@ -122,7 +142,12 @@ class cosmicsimage:
 		
 		"""
 		logger.debug("setting up cosmicsimage")
-		self.rawarray = rawarray + pssl # internally, we will always work "with sky".
+		self.lowmem = lowmem # work in float32, reusing work arrays between iterations
+		self.buffers = {} # the work arrays
+		if lowmem:
+			self.rawarray = np.asarray(rawarray, dtype=np.float32) + np.float32(pssl)
+		else:
+			self.rawarray = rawarray + pssl # internally, we will always work "with sky".
 		self.cleanarray = self.rawarray.copy() # In lacosmiciteration() we work on this guy
 		self.verbose = verbose
 		if bpm:		
@@ -146,6 +171,12 @@ class cosmicsimage:
 		self.satlevel = satlevel 	
 		self.pssl = pssl 	
 		self.trimborder = trimborder
+		self.tilesize = tilesize # if > 0, lacosmiciteration() works in tiles of this size ...
+		self.nproc = nproc # ... across this many processes (None for the cpu count)
+		self.pool = None # ... kept by run() for all of its iterations
+		self.incremental = incremental # only detect again where the cleanarray changed, ...
+		self.lastclean = None # ... since it was this
+		self.lastsel = None # ... when these cosmics were detected
 		self.backgroundlevel = None # only calculated and used if required.
 		self.satstars = None # a mask of the saturated stars, only calculated if required
 
@@ -161,7 +192,7 @@ class cosmicsimage:
 		if self.pssl != 0.0:
 			stringlist.append("Using a previously subtracted sky level of %f" % self.pssl)
 			
-		if self.satstars != None:
+		if self.satstars is not None:
 			stringlist.append("Saturated star mask : %i pixels" % np.sum(self.satstars))
 		
 		return "\n".join(stringlist)
@@ -219,7 +250,7 @@ class cosmicsimage:
 		"""
 		Given the mask, we replace the actual problematic pixels with the masked 5x5 median value.
 		This mimics what is done in L.A.Cosmic, but it's a bit harder to do in python, as there is no
-		readymade masked median. So for now we do a loop...
+		readymade masked median. So we gather the 5x5 cutouts and take their medians in bulk...
 		Saturated stars, if calculated, are also masked : they are not "cleaned", but their pixels are not
 		used for the interpolation.
 		
@@ -230,14 +261,14 @@ class cosmicsimage:
 		"""
 		if verbose == None:
 			verbose = self.verbose
-		if mask == None:
+		if mask is None:
 			mask = self.mask
 			
 		if verbose:
 			print "    cleaning cosmic affected pixels ..."
 		
 		# So... mask is a 2D array containing False and True, where True means "here is a cosmic"
-		# We want to loop through these cosmics one by one.
+		# We want to clean all of these cosmics at once.
 		cosmicindices = np.argwhere(mask)
 		# This is a list of the indices of cosmic affected pixels.
 		#print cosmicindices
@@ -248,45 +279,65 @@ class cosmicsimage:
 		# Now we want to have a 2 pixel frame of Inf padding around our image.
 		w = self.cleanarray.shape[0]
 		h = self.cleanarray.shape[1]
-		padarray = np.zeros((w+4,h+4))+np.Inf
-		padarray[2:w+2,2:h+2] = self.cleanarray.copy() # that copy is important, we need 2 independent arrays
+		if self.lowmem:
+			# in low memory mode, a float32 padarray kept from the last time
+			padarray = self.buffers.get("padarray")
+			if padarray is None or padarray.shape != (w+4,h+4):
+				padarray = self.buffers["padarray"] = np.empty((w+4,h+4), dtype=np.float32)
+			padarray.fill(np.Inf)
+		else:
+			padarray = np.zeros((w+4,h+4))+np.Inf
+		padarray[2:w+2,2:h+2] = self.cleanarray # a copy, we need 2 independent arrays
 		
 		# The medians will be evaluated in this padarray, skipping the np.Inf.
 		# Now in this copy called padarray, we also put the saturated stars to np.Inf, if available :
-		if self.satstars != None:
+		if self.satstars is not None:
 			padarray[2:w+2,2:h+2][self.satstars] = np.Inf
 			# Viva python, I tested this one, it works...
  
-		# A counter to prevent an incorrect BPM from trying to make use interpolate over huge areas
-		numhuge = 0
-		# A loop through every cosmic pixel :
-		for cosmicpos in cosmicindices:
-			if numhuge > 9:
-				logger.error("check your bad pixel mask, "
-								"attempting to clean too many large pixel clumps")
-				sys.exit(3)
-			x = cosmicpos[0]
-			y = cosmicpos[1]
-			cutout = padarray[x:x+5, y:y+5].ravel() # remember the shift due to the padding !
-			#print cutout
-			# Now we have our 25 pixels, some of them are np.Inf, and we want to take the median
-			goodcutout = cutout[cutout != np.Inf]
-			#print np.alen(goodcutout)
-			
-			if np.alen(goodcutout) >= 25 :
-				# This never happened, but you never know ...
-				raise RuntimeError, "Mega error in clean !"
-			elif np.alen(goodcutout) > 0 :
-				replacementvalue = np.median(goodcutout)
-			else :	
-				# i.e. no good pixels : Shit, a huge cosmic, we will have to improvise ...
-				logger.warning("found a large clump of pixels to correct")
-				numhuge +=1
-				replacementvalue = self.guessbackgroundlevel()
-			
-			# We update the cleanarray,
-			# but measure the medians in the padarray, so to not mix things up...
-			self.cleanarray[x, y] = replacementvalue
+		# The medians of all the cosmic pixels are found at once, from the 5x5 cutouts gathered into the
+		# rows of an array (in chunks, to bound the memory used). Sorting a row puts its np.Inf last, so the
+		# median of the good pixels is the middle of the first ngood. This gives exactly what np.median does
+		# on each goodcutout.
+		ncosmics = len(cosmicindices)
+		replacements = np.empty(ncosmics)
+		ngoods = np.empty(ncosmics, dtype=int)
+		offsets = np.arange(5)
+		for start in range(0, ncosmics, CLEANCHUNK):
+			x = cosmicindices[start:start+CLEANCHUNK, 0] # remember the shift due to the padding !
+			y = cosmicindices[start:start+CLEANCHUNK, 1]
+			cutouts = padarray[(x[:,None]+offsets)[:,:,None], (y[:,None]+offsets)[:,None,:]].reshape(-1, 25)
+			ngood = np.sum(cutouts != np.Inf, axis=1)
+			cutouts.sort(axis=1)
+			rows = np.arange(len(cutouts))
+			low = cutouts[rows, np.maximum(ngood-1, 0)//2]
+			high = cutouts[rows, ngood//2]
+			medians = np.where(ngood % 2, low, (low + high)/2.)
+			# np.median gives nan if any of the good pixels are nan (sorted after the np.Inf here)
+			medians[np.isnan(cutouts[:,-1])] = np.nan
+			replacements[start:start+CLEANCHUNK] = medians
+			ngoods[start:start+CLEANCHUNK] = ngood
+		
+		if np.any(ngoods >= 25):
+			# This never happened, but you never know ...
+			raise RuntimeError, "Mega error in clean !"
+		
+		# i.e. no good pixels : Shit, huge cosmics, we will have to improvise ...
+		# An incorrect BPM could have us trying to interpolate over huge areas, so as before, we give up on
+		# any cosmic pixel after the tenth without good pixels.
+		huge = np.flatnonzero(ngoods == 0)
+		for i in huge[:10]:
+			logger.warning("found a large clump of pixels to correct")
+		if len(huge) >= 10 and huge[9] < ncosmics - 1:
+			logger.error("check your bad pixel mask, "
+							"attempting to clean too many large pixel clumps")
+			sys.exit(3)
+		if len(huge):
+			replacements[huge] = self.guessbackgroundlevel()
+		
+		# We update the cleanarray,
+		# but measured the medians in the padarray, so to not mix things up...
+		self.cleanarray[cosmicindices[:,0], cosmicindices[:,1]] = replacements
 			
 		# That's it.
 		if verbose:
@@ -323,6 +374,8 @@ class cosmicsimage:
 		"""
 		if verbose == None:
 			verbose = self.verbose
+		self.lastsel = None # the next detection has to be on the whole frame
+		
 		if verbose:
 				print "    detecting saturated stars ..."
 		# DETECTION
@@ -341,7 +394,7 @@ class cosmicsimage:
 		
 		# BUILDING THE MASK
 		# The subtility is that we want to include all saturated pixels connected to these saturated stars...
-		# I haven't found a better solution then the double loop
+		# We label the islands of saturated pixels, and keep those containing a centre.
 		
 		# We dilate the satpixels alone, to ensure connectivity in glitchy regions and to add a safety margin around them.
 		#dilstruct = np.array([[0,1,0], [1,1,1], [0,1,0]])
@@ -357,17 +410,12 @@ class cosmicsimage:
 		if verbose:
 				print "    we have %i saturated stars." % nsat
 		logger.info("%i saturated stars found" % nsat)
-		# The ouput, False for now :
-		outmask = np.zeros(self.rawarray.shape)
-		
-		for i in range(1,nsat+1): # we go through the islands of saturated pixels
-			thisisland = dilsatlabels == i # gives us a boolean array
-			# Does this intersect with satstarscenters ?
-			overlap = np.logical_and(thisisland, satstarscenters)
-			if np.sum(overlap) > 0:
-				outmask = np.logical_or(outmask, thisisland) # we add thisisland to the mask
-			
-		self.satstars = np.cast['bool'](outmask)
+		# Which islands intersect with satstarscenters ? A lookup from label to True/False, then gives
+		# the mask in one pass over the labels :
+		keep = np.zeros(nsat+1, dtype=bool)
+		keep[dilsatlabels[satstarscenters]] = True
+		keep[0] = False # the background
+		self.satstars = keep[dilsatlabels]
 		
 		if verbose:
 				print "    mask of saturated stars done"
@@ -381,7 +429,7 @@ class cosmicsimage:
 			verbose = self.verbose
 		if not self.satlevel > 0:
 			raise RuntimeError, "Cannot determine satstars : you gave satlevel <= 0 !" 
-		if self.satstars == None:
+		if self.satstars is None:
 			self.findsatstars(verbose = verbose)
 		return self.satstars
 
@@ -435,93 +483,19 @@ class cosmicsimage:
 		if verbose:
 			print "\tconvolving image with Laplacian kernel ..."
 		
-		# We subsample, convolve, clip negative values, and rebin to original size
-		subsam = subsample(self.cleanarray)
-		conved = signal.convolve2d(subsam, laplkernel, mode="same", boundary="symm")
-		cliped = conved.clip(min=0.0)
-		#cliped = np.abs(conved) # unfortunately this does not work to find holes as well ...
-		lplus = rebin2x2(cliped)
-			
-		# We build a custom noise map, so to compare the laplacian to
- 		m5 = ndimage.filters.median_filter(self.cleanarray, size=5, mode='mirror')
- 		# We keep this m5, as I will use it later for the interpolation.
- 		m5clipped = m5.clip(min=0.00001) # As we will take the sqrt
- 		noise = (1.0/self.gain) * np.sqrt(self.gain*m5clipped + self.readnoise*self.readnoise)
- 
- 		# Laplacian signal to noise ratio :
- 		s = lplus / (2.0 * noise) # the 2.0 is from the 2x2 subsampling
- 		# This s is called sigmap in the original lacosmic.cl
- 		
- 		# We remove the large structures (s prime) :
- 		sp = s - ndimage.filters.median_filter(s, size=5, mode='mirror')
- 		
-		if verbose:
-			print "\tselecting candidate cosmic rays ..."
-			
- 		# Candidate cosmic rays (this will include stars + HII regions)
- 		candidates = sp > self.sigclip	
-		nbcandidates = np.sum(candidates)
+		finalsel = None
+		if self.incremental and self.lastsel is not None:
+			finalsel = self.detectincremental(verbose = verbose)
+		if finalsel is None and self.tilesize and max(self.cleanarray.shape) > self.tilesize:
+			finalsel = self.detecttiled(verbose = verbose)
+		elif finalsel is None:
+			finalsel = detectcosmics(self.cleanarray, self.satstars, self.gain, self.readnoise, self.sigclip,
+									 self.sigcliplow, self.objlim, verbose = verbose, lowmem = self.lowmem,
+									 buffers = self.buffers)
+		if self.incremental:
+			self.lastclean = self.cleanarray.copy()
+			self.lastsel = finalsel.copy()
 		
-		if verbose:
-			print "\t  %5i candidate pixels" % nbcandidates
- 		
- 		# At this stage we use the saturated stars to mask the candidates, if available :
- 		if self.satstars != None:
- 			if verbose:
- 				print "\tmasking saturated stars ..."
- 			candidates = np.logical_and(np.logical_not(self.satstars), candidates)
- 			nbcandidates = np.sum(candidates)
-		
-			if verbose:
-				print "\t  %5i candidate pixels not part of saturated stars" % nbcandidates
-
-			
- 		# We build the fine structure image :
- 		m3 = ndimage.filters.median_filter(self.cleanarray, size=3, mode='mirror')
-		m37 = ndimage.filters.median_filter(m3, size=7, mode='mirror')
-		f = m3 - m37
-		# In the article that's it, but in lacosmic.cl f is divided by the noise...
-		# Ok I understand why, it depends on if you use sp/f or L+/f as criterion.
-		# There are some differences between the article and the iraf implementation.
-		# So I will stick to the iraf implementation.
-		f = f / noise
-		f = f.clip(min=0.01) # as we will divide by f. like in the iraf version.
-		
-		if verbose:
-			print "\tremoving suspected compact bright objects ..."
-			
-		# Now we have our better selection of cosmics :
-		cosmics = np.logical_and(candidates, sp/f > self.objlim)
-		# Note the sp/f and not lplus/f ... due to the f = f/noise above.
-		
-		nbcosmics = np.sum(cosmics)
-		
-		if verbose:
-			print "\t  %5i remaining candidate pixels" % nbcosmics
-		
-		# What follows is a special treatment for neighbors, with more relaxed constains.
-		
-		if verbose:
-			print "\tfinding neighboring pixels affected by cosmic rays ..."
-			
-		# We grow these cosmics a first time to determine the immediate neighborhod  :
-		growcosmics = np.cast['bool'](signal.convolve2d(np.cast['float32'](cosmics), growkernel, mode="same", boundary="symm"))
-		
-		# From this grown set, we keep those that have sp > sigmalim
-		# so obviously not requiring sp/f > objlim, otherwise it would be pointless
-		growcosmics = np.logical_and(sp > self.sigclip, growcosmics)
-		
-		# Now we repeat this procedure, but lower the detection limit to sigmalimlow :
-			
-		finalsel = np.cast['bool'](signal.convolve2d(np.cast['float32'](growcosmics), growkernel, mode="same", boundary="symm"))
-		finalsel = np.logical_and(sp > self.sigcliplow, finalsel)
-		
-		# Again, we have to kick out pixels on saturated stars :
-		if self.satstars != None:
- 			if verbose:
- 				print "\tmasking saturated stars ..."
- 			finalsel = np.logical_and(np.logical_not(self.satstars), finalsel)
- 		
         # Remove any cosmics in the border that will be trimmed as unecessary to clean.
 		if self.trimborder:
 			finalsel[:self.trimborder] = False
@@ -551,6 +525,86 @@ class cosmicsimage:
 		
 		return {"niter":nbfinal, "nnew":nbnew, "itermask":finalsel, "newmask":newmask}
 		
+	def detecttiled(self, verbose = None):
+		"""
+		The detection of lacosmiciteration(), done in overlapping tiles of self.tilesize across a pool of
+		self.nproc workers. Each tile carries a border of TILEHALO pixels, so that the stitched mask is
+		identical to the one from the whole frame.
+		Uses the pool run() keeps for its iterations, or one of its own if called outside of run().
+		"""
+		if verbose == None:
+			verbose = self.verbose
+		tiles = tileslices(self.cleanarray.shape, self.tilesize)
+		if verbose:
+			print "\tdetecting cosmics in %i tiles ..." % len(tiles)
+		logger.debug("detecting cosmics in %i tiles" % len(tiles))
+		jobs = []
+		for tile, padded, inner in tiles:
+			satstars = self.satstars[padded] if self.satstars is not None else None
+			jobs.append((self.cleanarray[padded], satstars, self.gain, self.readnoise, self.sigclip,
+						 self.sigcliplow, self.objlim, False, self.lowmem))
+		if self.pool is not None:
+			results = self.pool.map(_detecttile, jobs)
+		else:
+			pool = self.tilepool()
+			try:
+				results = pool.map(_detecttile, jobs)
+			finally:
+				pool.close()
+				pool.join()
+		
+		finalsel = np.zeros(self.cleanarray.shape, dtype=bool)
+		for (tile, padded, inner), result in zip(tiles, results):
+			finalsel[tile] = result[inner]
+		return finalsel
+		
+	def tilepool(self):
+		"""
+		A pool of self.nproc workers for detecttiled() : processes, or threads if we are ourselves a
+		(daemonic) pool worker.
+		"""
+		if multiprocessing.current_process().daemon:
+			return ThreadPool(self.nproc)
+		return multiprocessing.Pool(self.nproc)
+		
+	def detectincremental(self, verbose = None):
+		"""
+		The detection of lacosmiciteration(), from the cosmics of the previous one : a pixel's detection
+		only depends on the cleanarray within TILEHALO of it, so only the pixels within TILEHALO of those
+		clean() has changed since are detected again, in the bounding boxes of these regions (with a border of
+		TILEHALO). The mask is identical to the one from the whole frame.
+		Returns None if these boxes add up to more than INCREMENTALMAXFRACTION of the frame, as detecting it
+		whole is then faster.
+		"""
+		if verbose == None:
+			verbose = self.verbose
+		# (NaNs always count as changed)
+		changed = self.cleanarray != self.lastclean
+		dirty = ndimage.maximum_filter(changed, size = 2*TILEHALO+1, mode = 'constant')
+		labels, n = ndimage.label(dirty, structure = growkernel)
+		shape = self.cleanarray.shape
+		boxes = []
+		for box in ndimage.find_objects(labels):
+			padded = tuple(slice(max(s.start-TILEHALO, 0), min(s.stop+TILEHALO, size))
+						   for s, size in zip(box, shape))
+			inner = tuple(slice(s.start-p.start, s.stop-p.start) for s, p in zip(box, padded))
+			boxes.append((box, padded, inner))
+		npixels = sum((p[0].stop-p[0].start)*(p[1].stop-p[1].start) for box, p, inner in boxes)
+		if npixels > INCREMENTALMAXFRACTION * dirty.size:
+			logger.debug("%i regions (%i pixels) to detect again, detecting the whole frame" % (n, npixels))
+			return None
+		
+		if verbose:
+			print "\tdetecting cosmics again in %i regions (%i pixels) ..." % (n, npixels)
+		logger.debug("detecting cosmics again in %i regions (%i pixels)" % (n, npixels))
+		finalsel = self.lastsel.copy()
+		for box, padded, inner in boxes:
+			satstars = self.satstars[padded] if self.satstars is not None else None
+			result = detectcosmics(self.cleanarray[padded], satstars, self.gain, self.readnoise, self.sigclip,
+								   self.sigcliplow, self.objlim, lowmem = self.lowmem)
+			finalsel[box] = result[inner]
+		return finalsel
+		
 	def findholes(self, verbose = True):
 		"""
 		Detects "negative cosmics" in the cleanarray and adds them to the mask.
@@ -597,7 +651,7 @@ class cosmicsimage:
 		"""
 		"""
 		# We have to kick out pixels on saturated stars :
-		if self.satstars != None:
+		if self.satstars is not None:
  			if verbose:
  				print "Masking saturated stars ..."
  			holes = np.logical_and(np.logical_not(self.satstars), holes)
@@ -609,13 +663,13 @@ class cosmicsimage:
 		self.mask = np.logical_or(self.mask, holes)
 		"""
 	
-	def run(self, maxiter = 4, verbose = False):
+	def run(self, maxiter = 4, verbose = False, minnew = 0):
 		"""
 		Full artillery :-)
 			- Find saturated stars
 			- Run maxiter L.A.Cosmic iterations (stops if no more cosmics are found)
 	
-		Stops if no cosmics are found or if maxiter is reached.
+		Stops if no cosmics are found, if fewer than minnew of them are new or if maxiter is reached.
 		"""
 		verbose = self.verbose	
 
@@ -628,11 +682,31 @@ class cosmicsimage:
 			logger.warning("cleaning called with no iterations or bpm, skipping")
 			return
 
-		if self.satlevel > 0 and self.satstars == None:
+		if self.satlevel > 0 and self.satstars is None:
 			self.findsatstars(verbose=self.verbose)
 			
 		if verbose: print "    starting %i L.A.Cosmic iterations ..." % maxiter
 		logger.info("beginning %i L.A. cosmic iterations" % maxiter)
+		# The tile workers are started once, for all the iterations, rather than forking the whole
+		# process again for each of them :
+		if self.tilesize and max(self.cleanarray.shape) > self.tilesize:
+			self.pool = self.tilepool()
+		try:
+			self.iterate(maxiter, verbose, minnew)
+		finally:
+			if self.pool is not None:
+				self.pool.close()
+				self.pool.join()
+				self.pool = None
+		
+		# So that we know how many of us fit on a node :
+		logger.info("peak memory use %.0f MB%s" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.,
+												  " (low memory mode)" if self.lowmem else ""))
+	
+	def iterate(self, maxiter, verbose, minnew):
+		"""
+		The L.A.Cosmic iterations of run().
+		"""
 		for i in range(1, maxiter+1):
 			if verbose: print "    iteration %i" % i
 			logger.debug("iteration %i" % i)
@@ -648,6 +722,192 @@ class cosmicsimage:
 			
 			if iterres["niter"] == 0:
 				break
+			if iterres["nnew"] < minnew:
+				logger.info("fewer than %i new cosmic pixels, stopping" % minnew)
+				break
+
+
+def detectcosmics(cleanarray, satstars, gain, readnoise, sigclip, sigcliplow, objlim, verbose = False,
+				  lowmem = False, buffers = None):
+	"""
+	The detection of one L.A.Cosmic iteration, see cosmicsimage.lacosmiciteration().
+	Returns the mask of pixels detected as cosmics in cleanarray, leaving out those in the satstars mask
+	(None if there isn't one).
+	A module level function, so that tiles of a frame can be sent to a pool of processes.
+	With lowmem, see detectcosmicslowmem().
+	"""
+	if lowmem:
+		return detectcosmicslowmem(cleanarray, satstars, gain, readnoise, sigclip, sigcliplow, objlim,
+								   buffers = buffers)
+	
+	# We subsample, convolve, clip negative values, and rebin to original size.
+	# laplacianplus() does all this at the original size, with the same result :
+	#subsam = subsample(cleanarray)
+	#conved = signal.convolve2d(subsam, laplkernel, mode="same", boundary="symm")
+	#cliped = conved.clip(min=0.0)
+	#cliped = np.abs(conved) # unfortunately this does not work to find holes as well ...
+	#lplus = rebin2x2(cliped)
+	lplus = laplacianplus(cleanarray)
+		
+	# We build a custom noise map, so to compare the laplacian to
+ 	m5 = ndimage.filters.median_filter(cleanarray, size=5, mode='mirror')
+ 	# We keep this m5, as I will use it later for the interpolation.
+ 	m5clipped = m5.clip(min=0.00001) # As we will take the sqrt
+ 	noise = (1.0/gain) * np.sqrt(gain*m5clipped + readnoise*readnoise)
+ 
+ 	# Laplacian signal to noise ratio :
+ 	s = lplus / (2.0 * noise) # the 2.0 is from the 2x2 subsampling
+ 	# This s is called sigmap in the original lacosmic.cl
+ 	
+ 	# We remove the large structures (s prime) :
+ 	sp = s - ndimage.filters.median_filter(s, size=5, mode='mirror')
+ 	
+	if verbose:
+		print "\tselecting candidate cosmic rays ..."
+		
+ 	# Candidate cosmic rays (this will include stars + HII regions)
+ 	candidates = sp > sigclip	
+	nbcandidates = np.sum(candidates)
+	
+	if verbose:
+		print "\t  %5i candidate pixels" % nbcandidates
+ 	
+ 	# At this stage we use the saturated stars to mask the candidates, if available :
+ 	if satstars is not None:
+ 		if verbose:
+ 			print "\tmasking saturated stars ..."
+ 		candidates = np.logical_and(np.logical_not(satstars), candidates)
+ 		nbcandidates = np.sum(candidates)
+	
+		if verbose:
+			print "\t  %5i candidate pixels not part of saturated stars" % nbcandidates
+
+		
+ 	# We build the fine structure image :
+ 	m3 = ndimage.filters.median_filter(cleanarray, size=3, mode='mirror')
+	m37 = ndimage.filters.median_filter(m3, size=7, mode='mirror')
+	f = m3 - m37
+	# In the article that's it, but in lacosmic.cl f is divided by the noise...
+	# Ok I understand why, it depends on if you use sp/f or L+/f as criterion.
+	# There are some differences between the article and the iraf implementation.
+	# So I will stick to the iraf implementation.
+	f = f / noise
+	f = f.clip(min=0.01) # as we will divide by f. like in the iraf version.
+	
+	if verbose:
+		print "\tremoving suspected compact bright objects ..."
+		
+	# Now we have our better selection of cosmics :
+	cosmics = np.logical_and(candidates, sp/f > objlim)
+	# Note the sp/f and not lplus/f ... due to the f = f/noise above.
+	
+	nbcosmics = np.sum(cosmics)
+	
+	if verbose:
+		print "\t  %5i remaining candidate pixels" % nbcosmics
+	
+	# What follows is a special treatment for neighbors, with more relaxed constains.
+	
+	if verbose:
+		print "\tfinding neighboring pixels affected by cosmic rays ..."
+		
+	# We grow these cosmics a first time to determine the immediate neighborhod.
+	# This was a convolve2d with growkernel (boundary="symm") of the mask as float32, cast back to bool,
+	# i.e. a binary dilation, the pixels beyond the edge being copies of the edge :
+	growcosmics = ndimage.binary_dilation(cosmics, structure=growkernel)
+	
+	# From this grown set, we keep those that have sp > sigmalim
+	# so obviously not requiring sp/f > objlim, otherwise it would be pointless
+	growcosmics = np.logical_and(sp > sigclip, growcosmics)
+	
+	# Now we repeat this procedure, but lower the detection limit to sigmalimlow :
+		
+	finalsel = ndimage.binary_dilation(growcosmics, structure=growkernel)
+	finalsel = np.logical_and(sp > sigcliplow, finalsel)
+	
+	# Again, we have to kick out pixels on saturated stars :
+	if satstars is not None:
+ 		if verbose:
+ 			print "\tmasking saturated stars ..."
+ 		finalsel = np.logical_and(np.logical_not(satstars), finalsel)
+
+	return finalsel
+
+
+def detectcosmicslowmem(cleanarray, satstars, gain, readnoise, sigclip, sigcliplow, objlim, buffers = None):
+	"""
+	detectcosmics(), in the dtype of cleanarray (i.e. float32 in low memory mode) and with as few frame size
+	arrays as possible : L+ comes from laplacianplus(), the filters write into work arrays and everything
+	else is done in place. The work arrays are kept in buffers (a dict) if given, for the next call.
+	"""
+	if buffers is None:
+		buffers = {}
+	def buf(name, dtype = cleanarray.dtype):
+		if name not in buffers or buffers[name].shape != cleanarray.shape or buffers[name].dtype != dtype:
+			buffers[name] = np.empty(cleanarray.shape, dtype=dtype)
+		return buffers[name]
+	
+	# s, the laplacian signal to noise ratio, is built in the L+ array
+	s = laplacianplus(cleanarray, out=buf("s"), buffers=buffers)
+	med = ndimage.filters.median_filter(cleanarray, size=5, mode='mirror', output=buf("med"))
+	noise = np.maximum(med, 0.00001, out=buf("noise"))
+	noise *= gain
+	noise += readnoise*readnoise
+	np.sqrt(noise, out=noise)
+	noise *= 1.0/gain
+	tmp = np.multiply(noise, 2.0, out=buf("tmp")) # the 2.0 is from the 2x2 subsampling
+	s /= tmp
+	
+	# We remove the large structures, sp is now in s :
+	med = ndimage.filters.median_filter(s, size=5, mode='mirror', output=med)
+	sp = s
+	sp -= med
+	candidates = np.greater(sp, sigclip, out=buf("candidates", bool))
+	if satstars is not None:
+		candidates &= ~satstars
+	
+	# The fine structure image, in med :
+	m3 = ndimage.filters.median_filter(cleanarray, size=3, mode='mirror', output=med)
+	m37 = ndimage.filters.median_filter(m3, size=7, mode='mirror', output=tmp)
+	f = m3
+	f -= m37
+	f /= noise
+	np.maximum(f, 0.01, out=f)
+	
+	cosmics = np.greater(np.divide(sp, f, out=tmp), objlim, out=buf("cosmics", bool))
+	cosmics &= candidates
+	
+	# The growing of the cosmics, as in detectcosmics()
+	above = buf("above", bool)
+	growcosmics = ndimage.binary_dilation(cosmics, structure=growkernel, output=buf("grow", bool))
+	growcosmics &= np.greater(sp, sigclip, out=above)
+	finalsel = ndimage.binary_dilation(growcosmics, structure=growkernel)
+	finalsel &= np.greater(sp, sigcliplow, out=above)
+	if satstars is not None:
+		finalsel &= ~satstars
+	return finalsel
+
+
+def _detecttile(args):
+	return detectcosmics(*args)
+
+
+def tileslices(shape, tilesize, halo = TILEHALO):
+	"""
+	Splits a frame of this shape into tiles of (at most) tilesize x tilesize.
+	Returns a list of (tile, padded, inner) slice pairs : tile in the frame, the tile with a border of
+	halo pixels around it (where the frame allows) in the frame, and the tile within the padded tile.
+	"""
+	result = []
+	for y0 in range(0, shape[0], tilesize):
+		for x0 in range(0, shape[1], tilesize):
+			y1, x1 = min(y0+tilesize, shape[0]), min(x0+tilesize, shape[1])
+			py0, px0 = max(y0-halo, 0), max(x0-halo, 0)
+			py1, px1 = min(y1+halo, shape[0]), min(x1+halo, shape[1])
+			result.append(((slice(y0, y1), slice(x0, x1)),
+						   (slice(py0, py1), slice(px0, px1)),
+						   (slice(y0-py0, y1-py0), slice(x0-px0, x1-px0))))
+	return result
 
 
 # Top-level functions
@@ -727,16 +987,74 @@ def subsample(a): # this is more a generic function then a method ...
 			outarray[2*i+1,2*j+1] = a[i,j]
 	return outarray
 	"""
+	"""
 	# much better :
 	newshape = (2*a.shape[0], 2*a.shape[1])
 	slices = [slice(0,old, float(old)/new) for old,new in zip(a.shape,newshape) ]
 	coordinates = np.mgrid[slices]
 	indices = coordinates.astype('i')   #choose the biggest smaller integer index
 	return a[tuple(indices)]
+	"""
+	# the same, without the index arrays twice the size of the output :
+	return a.repeat(2, axis=0).repeat(2, axis=1)
 	
 	
 	
 
+def laplacianplus(a, out = None, buffers = None):
+	"""
+	Returns rebin2x2(convolve2d(subsample(a), laplkernel, mode="same", boundary="symm").clip(min=0.0)),
+	i.e. the L+ of L.A.Cosmic, without building the 4x size subsampled array.
+	
+	Each pixel of a becomes 2x2 in the subsampled array, and the laplacian of each of those four is
+	4a - (the pixels above, below, left and right), half of which are a itself, with edge pixels repeated
+	at the border (as boundary="symm" does). L+ is the mean of the four, clipped at zero.
+	The terms are added in the order convolve2d and rebin2x2 add them, so the result is the same to the bit.
+	out and buffers (a dict of work arrays, kept between calls) are used if given.
+	"""
+	if buffers is None:
+		buffers = {}
+	def buf(name, shape = a.shape):
+		if name not in buffers or buffers[name].shape != shape or buffers[name].dtype != a.dtype:
+			buffers[name] = np.empty(shape, dtype=a.dtype)
+		return buffers[name]
+	if out is None:
+		out = np.empty_like(a)
+	
+	pad = buf("lpluspad", (a.shape[0]+2, a.shape[1]+2))
+	pad[1:-1,1:-1] = a
+	pad[0,1:-1] = a[0]
+	pad[-1,1:-1] = a[-1]
+	pad[:,0] = pad[:,1]
+	pad[:,-1] = pad[:,-2]
+	above, below = pad[:-2,1:-1], pad[2:,1:-1]
+	left, right = pad[1:-1,:-2], pad[1:-1,2:]
+	four = buf("lplusfour")
+	np.multiply(a, 4, out=four)
+	tmp = buf("lplustmp")
+	col = buf("lpluscol")
+	# the left then the right column of subsampled pixels, top and bottom pixel of each
+	for i, (l, r) in enumerate(((left, a), (a, right))):
+		for j, (u, d) in enumerate(((above, a), (a, below))):
+			# convolve2d sums -d, -r, 4a, -l and -u in this order
+			np.add(d, r, out=tmp)
+			np.subtract(four, tmp, out=tmp)
+			tmp -= l
+			tmp -= u
+			np.maximum(tmp, 0.0, out=tmp)
+			if j == 0:
+				col[...] = tmp
+			else:
+				col += tmp
+		if i == 0:
+			out[...] = col
+		else:
+			out += col
+	out /= 2
+	out /= 2
+	return out
+
+
 def rebin(a, newshape):
 	"""
 	Auxiliary function to rebin an ndarray a.
@@ -759,11 +1077,10 @@ def rebin(a, newshape):
 
 def rebin2x2(a):
 	"""
-	Wrapper around rebin that actually rebins 2 by 2
+	Rebins a 2 by 2 (the mean of each 2x2 block), as rebin(a, a.shape/2)
 	"""
 	inshape = np.array(a.shape)
 	if not (inshape % 2 == np.zeros(2)).all(): # Modulo check to see if size is even
 		raise RuntimeError, "I want even image shapes !"
 		
-	return rebin(a, inshape/2)
-
+	return a.reshape(a.shape[0]//2, 2, a.shape[1]//2, 2).sum(1).sum(2)/2/2
@@ -0,0 +1,51 @@
+"""
+catalog cross-matching
+
+Matches objects between two lists of pixel positions (e.g. SExtractor
+catalogs of an image and the template) by proximity, using a KD-tree so
+that dense fields of thousands of objects match in milliseconds.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+def match(coords,refcoords,radius,unique=False):
+    """
+    Pairs each object in coords with its nearest object in refcoords.
+
+    INPUT
+        coords, refcoords:
+                (n,2) arrays of x,y positions (extra columns are ignored)
+        radius:
+                largest separation to count as a match
+        unique [False]:
+                pair each refcoords object at most once, with its closest
+    OUTPUT
+        idx,refidx,sep:
+                index arrays of the matched pairs (coords[idx] matches
+                refcoords[refidx]), in order of idx, and their separations
+    """
+    coords = np.atleast_2d(np.asarray(coords,dtype=float))
+    refcoords = np.atleast_2d(np.asarray(refcoords,dtype=float))
+    if not coords.size or not refcoords.size:
+        return (np.zeros(0,dtype=int),np.zeros(0,dtype=int),np.zeros(0))
+    # the tree's upper bound is exclusive, radius is inclusive
+    bound = np.nextafter(radius,np.inf)
+    sep,refidx = cKDTree(refcoords[:,:2]).query(coords[:,:2],
+                                                distance_upper_bound=bound)
+    idx = np.flatnonzero(sep <= radius)
+    if unique:
+        idx = idx[np.argsort(sep[idx],kind='mergesort')]
+        u,first = np.unique(refidx[idx],return_index=True)
+        idx = np.sort(idx[first])
+    return idx,refidx[idx],sep[idx]
+
+
+def within(coords,refcoords,radius):
+    """
+    Returns a boolean array, True for each object in coords with an object
+    of refcoords within radius
+    """
+    coords = np.atleast_2d(np.asarray(coords,dtype=float))
+    mask = np.zeros(len(coords),dtype=bool)
+    mask[match(coords,refcoords,radius)[0]] = True
+    return mask
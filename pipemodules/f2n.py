@@ -157,7 +157,7 @@ class f2nimage:
 	
 			
 	
-	def setzscale(self, z1="auto", z2="auto", nsig=3, samplesizelimit = 10000, border=300):
+	def setzscale(self, z1="auto", z2="auto", nsig=3, samplesizelimit = 10000, border=300, maxpixels = 2**22):
 		"""
 		We set z1 and z2, according to different algorithms or arguments.
 		
@@ -179,6 +179,10 @@ class f2nimage:
 		(300 happens to be a safe value for many telescopes.)
 		You can put border = 0 to deactivate this feature.
 		
+		Of images with more than maxpixels pixels (after the border), only every n-th row and column are used
+		(about maxpixels pixels), so that the whole image is never copied. The ex(trema) are then
+		those of this sample.
+		
 		If you give nothing, the cutoff will not be changed.
 		You should set the z scale directly after cropping the image.
 		
@@ -191,13 +195,20 @@ class f2nimage:
 			if border > 0:
 				if self.verbose :
 					print "For the stats I will leave a border of %i pixels" % border
-				calcarray = self.numpyarray[border:-border, border:-border].copy()
+				calcarray = self.numpyarray[border:-border, border:-border]
 			else:
-				calcarray = self.numpyarray.copy()
+				calcarray = self.numpyarray
 		else:
-			calcarray = self.numpyarray.copy()
+			calcarray = self.numpyarray
 			if self.verbose:
 				print "Image is too small for a border of %i" % (border)
+		
+		if calcarray.size > maxpixels:
+			step = int(np.ceil(np.sqrt(float(calcarray.size)/maxpixels)))
+			if self.verbose:
+				print "For the stats I will use every %i-th row and column" % step
+			calcarray = calcarray[::step, ::step]
+		calcarray = calcarray.copy()
 
 		# JDL edit: remove zero-value pixels
 		nozerocalcarray = calcarray[calcarray!=0]
@@ -945,9 +956,13 @@ def fromfits(infile, hdu = 0, verbose = False):
 	"""
 	Factory function that reads a FITS file and returns a f2nimage object.
 	Use hdu to specify which HDU you want (primary = 0)
+	The file is memory mapped (unless its data is scaled), so it is only read once, into the float32 array
+	of the f2nimage.
 	"""
 	
-	pixelarray, hdr = ft.getdata(infile, hdu, header=True)
+	hdr = ft.getheader(infile, hdu)
+	memmap = not any(key in hdr for key in ("BZERO", "BSCALE", "BLANK")) # pyfits can't map scaled data
+	pixelarray, hdr = ft.getdata(infile, hdu, header=True, memmap=memmap)
 	pixelarray = np.asarray(pixelarray).transpose()
 	
 	pixelarrayshape = pixelarray.shape
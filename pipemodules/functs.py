@@ -1,7 +1,14 @@
 import datetime
+import hashlib
 
 import numpy as np
+import pyfits
 
+# frames larger than this (in pixels) have their stats taken on a strided
+# sample of about this size, see sample
+STATSMAXPIXELS = 2**22
+# clipped_stats works through frames this many values at a time
+STATSCHUNK = 2**16
 
 def get_obsdate(header,obsdatekeys):
     """
@@ -59,10 +66,121 @@ def get_filt(header,filterkeys):
     return filt
 
 
-def get_stats(data,rmzeros = False):
+def is_scaled(header):
+    """
+    True if header scales its data (BZERO, BSCALE or BLANK), which pyfits
+    then can't memory map
+    """
+    return any(key in header for key in ('BZERO','BSCALE','BLANK'))
+
+
+def getdata(image,header = False):
+    """
+    pyfits.getdata, with the data memory mapped (so only read as it is used)
+    unless it is scaled
+    """
+    memmap = not is_scaled(pyfits.getheader(image))
+    return pyfits.getdata(image,header=header,memmap=memmap)
+
+
+def sample(data,maxpixels = STATSMAXPIXELS):
+    """
+    Returns data if it has at most maxpixels pixels, otherwise a view of every
+    n-th row and column (every n*n-th value if 1d) with about maxpixels. No
+    copy is made, so of a memory mapped frame only the sampled rows are read
+    """
+    if data.size <= maxpixels:
+        return data
+    step = int(np.ceil(np.sqrt(float(data.size)/maxpixels)))
+    if data.ndim == 2:
+        return data[::step,::step]
+    return data.ravel()[::step*step]
+
+
+def clipped_stats(data,nsigma = 3,niter = 2,rmzeros = False,
+                  chunk = STATSCHUNK):
+    """
+    Returns the number of values, mean and standard deviation of data, then
+    of what is left after each of niter rounds of removing the values more
+    than nsigma standard deviations from the mean, as a list of niter+1
+    (n,mean,stddev) tuples. rmzeros leaves out zero values throughout.
+
+    What a round keeps is the values strictly between its limits and those
+    of the rounds before, so each round is a single pass through data,
+    `chunk` values at a time, summing the values in that interval and their
+    squares in a work array. data is not copied (a strided view of it is
+    fine, see sample). The sums are taken about a rough mean of data, so
+    they stay precise in float64. Zeros are counted in the first pass and
+    taken back out of the sums of the rounds whose interval includes zero.
+    """
+    if data.ndim > 2:
+        data = data.reshape(-1,data.shape[-1])
+    elif data.ndim < 2:
+        data = data.reshape(-1,1)
+    rows = max(1,chunk//max(data.shape[1],1))
+    size = min(rows,len(data))*data.shape[1]
+    work = np.empty(size)
+    inside = np.empty(size,dtype=bool)
+    test = np.empty(size,dtype=bool)
+    pilot = float(np.mean(sample(data,1024))) if data.size else 0.
+    if not np.isfinite(pilot):
+        pilot = 0.
+
+    def sums(lo=None,hi=None):
+        n,s1,s2,nzeros = 0,0.,0.,0
+        for i in range(0,len(data),rows):
+            block = data[i:i+rows]
+            x = work[:block.size].reshape(block.shape)
+            np.subtract(block,pilot,out=x)
+            if lo is None:
+                n += block.size
+                if rmzeros:
+                    t = test[:block.size].reshape(block.shape)
+                    nzeros += np.count_nonzero(np.equal(block,0,out=t))
+            else:
+                keep = inside[:block.size].reshape(block.shape)
+                t = test[:block.size].reshape(block.shape)
+                np.greater(x,lo,out=keep)
+                keep &= np.less(x,hi,out=t)
+                x *= keep
+                n += np.count_nonzero(keep)
+            x = x.ravel()
+            s1 += x.sum()
+            s2 += np.dot(x,x)
+        return n,s1,s2,nzeros
+
+    def stats(n,s1,s2):
+        if not n:
+            return 0,np.nan,np.nan
+        mean = s1/n
+        return n,mean,np.sqrt(max(s2/n-mean*mean,0.))
+
+    n,s1,s2,nzeros = sums()
+    # a zero is -pilot about the pilot
+    zeros = np.array([nzeros,-nzeros*pilot,nzeros*pilot*pilot])
+    rounds = [stats(*np.array([n,s1,s2])-zeros)]
+    lo,hi = -np.inf,np.inf
+    for i in range(niter):
+        n,mean,stddev = rounds[-1]
+        lo = max(lo,mean-nsigma*stddev)
+        hi = min(hi,mean+nsigma*stddev)
+        n,s1,s2 = sums(lo,hi)[:3]
+        if lo < -pilot < hi:
+            n,s1,s2 = np.array([n,s1,s2])-zeros
+        rounds.append(stats(n,s1,s2))
+    return [(int(n),mean+pilot,stddev) for n,mean,stddev in rounds]
+
+
+def get_stats(data,rmzeros = False,maxpixels = STATSMAXPIXELS):
     """
     Data must be an array. rmzeros flag used to remove all zero value pixels.
     Returns a dictionary of image stats such as mean,stddev etc.
+    Frames of more than maxpixels pixels (e.g. memory mapped mosaics) have
+    their stats taken on a strided sample of about maxpixels (see sample),
+    None for none. The sample's (clipped) mean and stddev are then off by
+    about stddev over the square root of the number of pixels sampled (0.05%
+    of the stddev for 4M pixels). tstddev, set by the few brightest pixels,
+    is less predictable (within 1% for 4M pixels of a crowded frame).
     """
     try:
         ysize,xsize = data.shape
@@ -70,31 +188,19 @@ def get_stats(data,rmzeros = False):
         ysize = data.shape[0]
         xsize = 1
 
-    if rmzeros:
-        data = data[data!=0]
-
-    #compute full array stddev
-    tstddev = np.std(data)
-
-    #compute 3sigma clip stats
-    data3 = data.copy()
-    for i in range(2):
-        stddev = np.std(data3)
-        mean = np.sum(data3)/len(data3.ravel())
-        #remove any values >3sigma from mean
-        clipmin = mean - 3 * stddev
-        clipmax = mean + 3 * stddev
-        #clip data
-        data3 = data3[data3>clipmin] #returns ravelled array anyway
-        data3 = data3[data3<clipmax]
-
-    if len(data3) < float(xsize*ysize)/100:
+    if maxpixels:
+        data = sample(data,maxpixels)
+    npixels = data.size
+
+    #compute full array and 2 rounds of 3sigma clipped stats
+    rounds = clipped_stats(data,nsigma=3,niter=2,rmzeros=rmzeros)
+    tstddev = rounds[0][2]
+    n,mean,stddev = rounds[-1]
+
+    if n < float(npixels)/100:
         print 'WARNING clipped data is small, using total data stats'
-        data3 = data
+        n,mean,stddev = rounds[0]
 
-    #define mean/stddev of clipped data
-    stddev = np.std(data3)
-    mean = np.sum(data3)/len(data3.ravel())
     datamin = mean - 5*stddev
 
     return {'xsize':xsize,'ysize':ysize,'mean':mean,
@@ -106,3 +212,24 @@ def get_datetime():
     """
     now = datetime.datetime.now()
     return now.strftime('%H:%M %a %d %B %Y')
+
+
+def get_hash(paths,extra=(),blocksize=2**20):
+    """
+    Returns a hex digest of the contents of the files in paths (None entries
+    allowed, for unset optional files) followed by the values in extra.
+    Used to tell whether a pipeline input has changed since it was last run
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        if not path:
+            h.update('none\0')
+            continue
+        with open(path,'rb') as f:
+            h.update('file\0')
+            for block in iter(lambda: f.read(blocksize),''):
+                h.update(block)
+        h.update('\0')
+    for e in extra:
+        h.update('%r\0' % (e,))
+    return h.hexdigest()
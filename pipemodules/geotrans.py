@@ -0,0 +1,173 @@
+"""
+geometric transformations
+
+An in-process replacement for iraf.geomap/iraf.geotran: fits the
+transformation from reference (template) to input (image) coordinates from
+a list of matched objects, and resamples the input image onto the
+reference grid.
+
+Coordinates are in the 1-indexed pixel convention of IRAF and SExtractor.
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy import ndimage
+
+logger = logging.getLogger('run-subpipe.subpipe.geotrans')
+
+TILESIZE = 512 # size of the square output tiles resampled by each thread
+
+def terms(x,y,order):
+    """
+    The polynomial terms x**i * y**j (i+j <= order) at x,y, as columns
+    """
+    return np.column_stack([x**(n-j)*y**j for n in range(order+1)
+                                          for j in range(n+1)])
+
+
+def poly(coeffs,x,y,order,dx=False,dy=False):
+    """
+    Evaluates the polynomial with coefficients for terms(x,y,order) (or its
+    x or y derivative) at x,y. x and y are broadcast against each other, so
+    a row of x and a column of y give the whole grid
+    """
+    result = 0.
+    k = 0
+    for n in range(order+1):
+        for j in range(n+1):
+            i = n-j
+            c = coeffs[k]
+            k += 1
+            if dx:
+                c,i = c*i,i-1
+            if dy:
+                c,j = c*j,j-1
+            if c == 0:
+                continue
+            result = result+c*(x**i if i else 1.)*(y**j if j else 1.)
+    return result+np.zeros(np.broadcast(x,y).shape)
+
+
+class Transform(object):
+    """
+    A polynomial transformation from reference to input coordinates, as
+    fitted by fit()
+    """
+    def __init__(self,xcoeffs,ycoeffs,order,used,xrms,yrms):
+        self.xcoeffs = xcoeffs
+        self.ycoeffs = ycoeffs
+        self.order = order
+        self.used = used
+        self.xrms = xrms
+        self.yrms = yrms
+
+    def __call__(self,x,y):
+        """
+        Returns the input coordinates of reference coordinates x,y
+        """
+        return (poly(self.xcoeffs,x,y,self.order),
+                poly(self.ycoeffs,x,y,self.order))
+
+    def jacobian(self,x,y):
+        """
+        Returns the determinant of the jacobian at reference coordinates
+        x,y, i.e. the input pixel area per reference pixel
+        """
+        return poly(self.xcoeffs,x,y,self.order,dx=True)*\
+               poly(self.ycoeffs,x,y,self.order,dy=True)-\
+               poly(self.xcoeffs,x,y,self.order,dy=True)*\
+               poly(self.ycoeffs,x,y,self.order,dx=True)
+
+
+def fit(refcoords,coords,order=1,reject=3.,maxiter=3):
+    """
+    Fits the transformation taking refcoords to coords (as geomap's general
+    fit when order=1).
+
+    INPUT
+        refcoords,coords:
+                (n,2) arrays of matched x,y positions
+        order [1]:
+                order of the polynomial in x and y (1 - shift, rotation,
+                scale and skew, 2+ - adds distortion terms)
+        reject [3.]:
+                matches further than this many times the rms from the fit are
+                rejected and the fit repeated. 0 for no rejection
+        maxiter [3]:
+                most rejection iterations
+    OUTPUT
+        a Transform
+    """
+    refcoords = np.atleast_2d(np.asarray(refcoords,dtype=float))
+    coords = np.atleast_2d(np.asarray(coords,dtype=float))
+    nterms = (order+1)*(order+2)//2
+    if len(coords) < nterms:
+        raise ValueError('%i matches are too few for an order %i fit'
+                         % (len(coords),order))
+    t = terms(refcoords[:,0],refcoords[:,1],order)
+    used = np.ones(len(coords),dtype=bool)
+    for i in range(maxiter+1):
+        xcoeffs = np.linalg.lstsq(t[used],coords[used,0],rcond=None)[0]
+        ycoeffs = np.linalg.lstsq(t[used],coords[used,1],rcond=None)[0]
+        dx = np.dot(t,xcoeffs)-coords[:,0]
+        dy = np.dot(t,ycoeffs)-coords[:,1]
+        xrms = np.sqrt(np.mean(dx[used]**2))
+        yrms = np.sqrt(np.mean(dy[used]**2))
+        if not reject or i == maxiter:
+            break
+        keep = (np.abs(dx) <= reject*max(xrms,1e-6)) & \
+               (np.abs(dy) <= reject*max(yrms,1e-6))
+        if keep.sum() < nterms or np.all(keep == used):
+            break
+        used = keep
+    return Transform(xcoeffs,ycoeffs,order,used,xrms,yrms)
+
+
+def resample(data,transform,shape,fluxconserve=True,nthreads=None,
+             tilesize=TILESIZE):
+    """
+    Resamples data onto the reference grid with bilinear interpolation,
+    pixels falling off data are set to 0 (as geotran with boundary=constant,
+    constant=0).
+
+    INPUT
+        data:
+                the input image array
+        transform:
+                a Transform from reference to input coordinates
+        shape:
+                (ysize,xsize) of the reference grid, i.e. the output
+        fluxconserve [True]:
+                scale by the change in pixel area, as geotran
+        nthreads [None]:
+                threads to resample tiles with, defaults to the cpu count
+        tilesize [TILESIZE]:
+                size of the square output tiles handed to each thread
+    OUTPUT
+        the resampled float32 array
+    """
+    data = np.asarray(data,dtype=np.float32)
+    out = np.zeros(shape,dtype=np.float32)
+
+    def do_tile(tile):
+        y0,x0 = tile
+        ys = slice(y0,min(y0+tilesize,shape[0]))
+        xs = slice(x0,min(x0+tilesize,shape[1]))
+        y,x = np.ogrid[ys,xs]
+        y,x = y+1.,x+1.
+        xin,yin = transform(x,y)
+        out[ys,xs] = ndimage.map_coordinates(data,[yin-1,xin-1],order=1,
+                                             mode='constant',cval=0.)
+        if fluxconserve:
+            out[ys,xs] *= transform.jacobian(x,y)
+
+    tiles = [(y0,x0) for y0 in range(0,shape[0],tilesize)
+                     for x0 in range(0,shape[1],tilesize)]
+    pool = ThreadPool(nthreads)
+    try:
+        pool.map(do_tile,tiles)
+    finally:
+        pool.close()
+        pool.join()
+    return out
@@ -0,0 +1,93 @@
+"""
+in-memory images
+
+Before alignment a frame goes through several cleaning stages (defringing,
+bad pixel mask and cosmic ray removal, trimming) and has its statistics
+taken, each of which used to read the FITS file and most of which wrote it
+back. An ImageContext holds the pixel array and header in memory across
+these stages, so that the file is read once and written once, when a tool
+working on disk (IRAF, SExtractor, ISIS) next needs it.
+"""
+import os
+import logging
+
+import pyfits
+
+import functs
+
+logger = logging.getLogger('run-subpipe.subpipe.imagecontext')
+
+# FITS files read and written by contexts in this process
+reads = 0
+writes = 0
+
+class ImageContext(object):
+    """
+    The pixel array and header of a FITS image, kept in memory until
+    flush()ed back to the file.
+
+    INPUT
+        path:
+                filepath of the image, read now
+
+    Stages change data (and header) and call update(), or replace data
+    with update(newdata). Used as a `with` statement, the image is flushed
+    on leaving it.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.data = None
+        self.header = None
+        self.modified = False
+        self.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,type,value,traceback):
+        if type is None:
+            self.flush()
+
+    def read(self):
+        """
+        (Re)reads the data and header from the file, e.g. after an external
+        tool has changed it
+        """
+        global reads
+        self.data,self.header = pyfits.getdata(self.path,header=True)
+        self.modified = False
+        reads += 1
+        logger.debug('read %s' % os.path.basename(self.path))
+
+    def update(self,data=None):
+        """
+        Marks the image as changed, with data in place of the current array
+        if given
+        """
+        if data is not None:
+            self.data = data
+        self.modified = True
+
+    def flush(self):
+        """
+        Writes the data and header to the file if they have changed, so that
+        external tools see them. Returns the filepath
+        """
+        global writes
+        if not self.modified:
+            return self.path
+        # written aside and moved into place, so a failed write doesn't
+        # lose the frame
+        tmppath = '%s.%i.tmp' % (self.path,os.getpid())
+        pyfits.PrimaryHDU(self.data,self.header).writeto(tmppath)
+        os.rename(tmppath,self.path)
+        self.modified = False
+        writes += 1
+        logger.debug('wrote %s' % os.path.basename(self.path))
+        return self.path
+
+    def stats(self,rmzeros=False):
+        """
+        Returns functs.get_stats of the data
+        """
+        return functs.get_stats(self.data,rmzeros=rmzeros)
@@ -0,0 +1,224 @@
+"""
+shared filesystem job queue
+
+Lets several run-subpipe processes, on one or more hosts, drain the same
+workdir (e.g. on NFS). Each job (image) is claimed with a lease file in the
+queue directory, created exclusively so only one process can hold it. The
+holder keeps the lease fresh while it works; a lease left untouched for
+longer than the lease time belongs to a dead worker and may be broken and
+reclaimed by anyone else. Finished jobs get a `.done` marker.
+
+The same mechanism provides locks for the shared results (report, result
+store) and the one-off setup of the workdir.
+
+NB: lease ages are judged from file modification times, so the clocks of
+hosts sharing a queue should agree to well within the lease time.
+"""
+import os
+import time
+import errno
+import socket
+import logging
+import threading
+
+logger = logging.getLogger('run-subpipe.jobqueue')
+
+LEASETIME = 600 # seconds without renewal before a lease is considered stale
+POLLTIME = 2    # seconds between attempts to acquire a busy lock
+
+class JobQueue(object):
+    """
+    A queue of named jobs kept as files in `queuedir`
+
+    INPUT
+        queuedir:
+                directory shared by all processes taking part
+        leasetime [LEASETIME]:
+                seconds after which an unrenewed lease is stale
+    """
+    def __init__(self,queuedir,leasetime=LEASETIME):
+        self.queuedir = queuedir
+        self.leasetime = leasetime
+        self.owner = '%s:%i' % (socket.gethostname(),os.getpid())
+        try:
+            os.makedirs(queuedir)
+        except OSError:
+            if not os.path.isdir(queuedir):
+                raise
+
+    def path(self,name,ext):
+        return os.path.join(self.queuedir,name+ext)
+
+    def done(self,name):
+        """
+        True if the job `name` has been completed by any process
+        """
+        return os.path.isfile(self.path(name,'.done'))
+
+    def claim(self,name):
+        """
+        Attempts to take the lease on job `name`.
+
+        OUTPUT
+            a running Lease if we now hold the job, None if it's done or
+            leased by someone else
+        """
+        if self.done(name):
+            return None
+        leasefile = self.path(name,'.lease')
+        if not self.create(leasefile):
+            if not self.isstale(leasefile):
+                return None
+            logger.warning('breaking stale lease on %s (held by %s)'
+                           % (name,self.holder(leasefile)))
+            self.breaklease(leasefile)
+            if not self.create(leasefile):
+                return None
+        # it may have been finished between our check and the claim
+        if self.done(name):
+            os.remove(leasefile)
+            return None
+        return Lease(self,leasefile).start()
+
+    def complete(self,name):
+        """
+        Marks job `name` as done and gives up its lease.
+        """
+        with open(self.path(name,'.done'),'w') as f:
+            f.write(self.owner+'\n')
+        try:
+            os.remove(self.path(name,'.lease'))
+        except OSError:
+            pass
+
+    def lock(self,name):
+        """
+        Returns a Lock on the shared resource `name`, use as
+        `with queue.lock(name):`
+        """
+        return Lock(self,self.path(name,'.lock'))
+
+    def create(self,path):
+        """
+        Creates `path` exclusively with us as its owner, False if it exists
+        """
+        try:
+            fd = os.open(path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except OSError,e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd,self.owner+'\n')
+        os.close(fd)
+        return True
+
+    def isstale(self,path):
+        try:
+            age = time.time()-os.stat(path).st_mtime
+        except OSError:
+            # vanished, i.e. released, so not stale but free
+            return False
+        return age > self.leasetime
+
+    def holder(self,path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except IOError:
+            return 'unknown'
+
+    def breaklease(self,path):
+        """
+        Removes the stale lease at `path`.
+
+        The rename is atomic so only one of several processes breaking the
+        same lease succeeds. if what we moved aside turns out to be fresh,
+        another process got there first and re-leased it, so it's put back.
+        """
+        stale = '%s.stale.%s' % (path,self.owner)
+        try:
+            os.rename(path,stale)
+        except OSError:
+            return
+        if not self.isstale(stale):
+            try:
+                os.link(stale,path)
+            except OSError:
+                pass
+        os.remove(stale)
+
+
+class Lease(object):
+    """
+    A held lease file, kept fresh by a background thread until stopped
+    """
+    def __init__(self,queue,leasefile):
+        self.queue = queue
+        self.leasefile = leasefile
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._renew)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _renew(self):
+        while not self._stop.wait(self.queue.leasetime/4.0):
+            try:
+                os.utime(self.leasefile,None)
+            except OSError:
+                logger.warning('lost lease %s' % self.leasefile)
+                return
+
+    def stop(self):
+        """
+        Stops renewing the lease, leaving it in place
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def release(self):
+        """
+        Stops renewing and removes the lease, so the job can be reclaimed
+        """
+        self.stop()
+        try:
+            os.remove(self.leasefile)
+        except OSError:
+            pass
+
+
+class Lock(object):
+    """
+    Mutual exclusion between processes sharing a queue directory. Waits
+    for the lock, breaking it if its holder has died
+    """
+    def __init__(self,queue,lockfile):
+        self.queue = queue
+        self.lockfile = lockfile
+        self.lease = None
+
+    def acquire(self):
+        while not self.queue.create(self.lockfile):
+            if self.queue.isstale(self.lockfile):
+                logger.warning('breaking stale lock %s (held by %s)'
+                               % (self.lockfile,
+                                  self.queue.holder(self.lockfile)))
+                self.queue.breaklease(self.lockfile)
+            else:
+                time.sleep(POLLTIME)
+        self.lease = Lease(self.queue,self.lockfile).start()
+
+    def release(self):
+        self.lease.release()
+        self.lease = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,*exc):
+        self.release()
@@ -0,0 +1,81 @@
+"""
+lazy loading of pyraf and the IRAF packages
+
+Importing pyraf and loading IRAF packages costs seconds, which for a short
+run (or one with the IRAF steps turned off) is most of the run. `iraf` here
+stands in for pyraf's: pyraf is only imported, and the packages a task
+needs only loaded, the first time a task is used.
+
+    from pipemodules.lazyiraf import iraf
+"""
+import logging
+
+logger = logging.getLogger('run-subpipe.subpipe.lazyiraf')
+
+APPHOT = ['noao','digiphot','apphot']
+
+# IRAF packages (in load order) needed by the tasks used in the pipelines,
+# beyond those loaded at login. tasks not listed need nothing extra
+TASKPACKAGES = {'objmasks':['nproto'],
+                'phot':APPHOT,
+                'datapars':APPHOT,
+                'centerpars':APPHOT,
+                'fitskypars':APPHOT,
+                'photpars':APPHOT,
+                'txdump':['noao','digiphot','ptools'],
+                'mkapfile':['noao','digiphot','photcal'],
+                'display':['tv'],
+                'imexam':['tv'],
+                'tvmark':['tv']}
+
+class LazyIraf(object):
+    """
+    Stands in for pyraf.iraf, importing it and loading a task's packages
+    on first use
+    """
+    def __init__(self):
+        self._iraf = None
+        self._loaded = set()
+        self._pending = {}
+
+    def _load(self):
+        if self._iraf is None:
+            logger.debug('importing pyraf')
+            from pyraf import iraf
+            self._iraf = iraf
+            if self._pending:
+                iraf.set(**self._pending)
+        return self._iraf
+
+    def __getattr__(self,name):
+        iraf = self._load()
+        for package in TASKPACKAGES.get(name,[]):
+            if package not in self._loaded:
+                logger.debug('loading IRAF package %s' % package)
+                getattr(iraf,package)(_doprint=0)
+                self._loaded.add(package)
+        return getattr(iraf,name)
+
+    def set(self,**kwargs):
+        """
+        iraf.set, held until pyraf is imported if it hasn't been yet
+        """
+        if self._iraf is None:
+            self._pending.update(kwargs)
+        else:
+            self._iraf.set(**kwargs)
+
+    def loaded(self):
+        """
+        True if pyraf has been imported
+        """
+        return self._iraf is not None
+
+    def preload(self):
+        """
+        Imports pyraf and loads every package in TASKPACKAGES now
+        """
+        for task in TASKPACKAGES:
+            getattr(self,task)
+
+iraf = LazyIraf()
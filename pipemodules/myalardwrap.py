@@ -2,12 +2,15 @@ import os
 import shutil
 import subprocess
 import logging
-import atexit
-from math import sqrt
 
 import numpy as np
 import pyfits
 
+from scratch import get_scratchdir,scratchpath
+import crossmatch
+import sexcache
+import sourcefind
+
 logger = logging.getLogger('run-subpipe.subpipe.myalardwrap')
 
 # the file and directory path to this script, in case you call it from 
@@ -15,46 +18,157 @@ logger = logging.getLogger('run-subpipe.subpipe.myalardwrap')
 FILEPATH = os.path.realpath(__file__)
 FILEDIR = os.path.dirname(FILEPATH)
 
-def runsex(image,thresh=10,sat=55000,zp=25):
-
+def runsex(image,thresh=10,sat=55000,zp=25,method='sex',data=None):
+    """
+    Extracts the objects of image into its `.stars` list, sorted brightest
+    first, returning the list's filepath (None if SExtractor failed).
+    method is 'sex' for the bundled SExtractor or 'numpy' for
+    pipemodules.sourcefind, which uses data if image's data is already in
+    memory
+    """
     daofindparam = os.path.join(FILEDIR,'Sex/daofind.param')
     defaultconv = os.path.join(FILEDIR,'Sex/default.conv')
     defaultnnw = os.path.join(FILEDIR,'Sex/default.nnw')
     configsex = os.path.join(FILEDIR,'Sex/config.sex')
-    testcat = os.path.join(FILEDIR,'Sex/test.cat')
+    # an unchanged extraction is read back from the catalog cache
+    if method == 'numpy':
+        # sourcefind only sees the pixels
+        if data is None:
+            data = pyfits.getdata(image)
+        columns = sourcefind.COLUMNS
+        key = sexcache.get_key(data,[],(method,thresh,sat,zp,
+                               sourcefind.BACKSIZE,sourcefind.BACKFILTERSIZE,
+                               sourcefind.MINAREA))
+    else:
+        with open(daofindparam) as f:
+            columns = f.read().split()
+        key = sexcache.get_key(image,[configsex,daofindparam,defaultconv,
+                                      defaultnnw],(thresh,sat,zp))
+    catalog = sexcache.load(key)
+    if catalog is None and method == 'numpy':
+        catalog = sourcefind.extract(data,thresh,sat,zp)
+        sexcache.save(key,catalog)
+    elif catalog is None:
+        # the config and catalog go in our scratch directory, as does
+        # anything else SExtractor decides to write to its current directory.
+        # the config is written once, what changes from call to call is
+        # given on the command line
+        testcat = scratchpath('test.cat')
+        defaultsex = scratchpath('default.sex')
+        if not os.path.isfile(defaultsex):
+            with open(defaultsex,'w') as f:
+                f.write(get_sex_string(configsex,testcat,daofindparam,
+                        defaultconv,thresh,sat,zp,defaultnnw))
+
+        subprocess.Popen([FILEDIR+'/Sex/sex',os.path.abspath(image),
+                          '-c',defaultsex,
+                          '-CATALOG_NAME',testcat,
+                          '-CATALOG_TYPE','FITS_LDAC',
+                          '-DETECT_THRESH',str(thresh),
+                          '-ANALYSIS_THRESH',str(thresh),
+                          '-SATUR_LEVEL',str(sat),
+                          '-MAG_ZEROPOINT',str(zp)],
+        #subprocess.Popen(['sex',image,'-c',defaultsex],
+                          stdout=open(os.devnull,'wb'),
+                          stderr=subprocess.STDOUT,
+                          cwd=get_scratchdir()).wait()
+        try:
+            catalog = read_ldac(testcat,columns)
+        except IOError:
+            logger.error('SExtractor didn\'t work on the image. check data')
+            return None
+        os.remove(testcat)
+        sexcache.save(key,catalog)
+
+    # sorted by magnitude
+    catalog = catalog[np.argsort(catalog[:,3],kind='mergesort')]
+    starfile = os.path.splitext(image)[0]+'.stars'
+    write_stars(starfile,catalog,columns)
+    return starfile
 
-    defaultsex = os.path.join(FILEDIR,'Sex/default.sex')
-    with open(defaultsex,'w') as f:
-        f.write(get_sex_string(configsex,testcat,daofindparam,defaultconv,
-                thresh,sat,zp,defaultnnw))
 
-    subprocess.Popen([FILEDIR+'/Sex/sex',image,'-c',defaultsex],
-    #subprocess.Popen(['sex',image,'-c',defaultsex],
-                      stdout=open(os.devnull,'wb'),
-                      stderr=subprocess.STDOUT).wait()
+def read_ldac(catfile,columns):
+    """
+    Returns the columns of a FITS_LDAC SExtractor catalog as an array
+    """
+    hdus = pyfits.open(catfile)
     try:
-        open(testcat)
-    except IOError:
-        logger.error('SExtractor didn\'t work on the image. check data')
-        return None
+        objects = hdus['LDAC_OBJECTS'].data
+        if objects is None or not len(objects):
+            return np.zeros((0,len(columns)))
+        return np.column_stack([np.asarray(objects.field(c),dtype=float)
+                                for c in columns])
+    finally:
+        hdus.close()
 
-    starfile = os.path.splitext(image)[0]+'.stars'
-    with open(starfile,'w') as f:
-        try:
-            p = subprocess.Popen(['sort','-n','-k','4',testcat],
-                                 stdout=f).wait()
-        except:
-            pass 
 
-    os.remove(defaultsex)
-    os.remove(testcat)
+# the .stars lists this process has written or read, by path, as
+# (identity of the file,catalog,columns), so they aren't parsed again
+_stars = {}
 
-    return starfile
+def _identify(f):
+    st = os.fstat(f.fileno())
+    return (st.st_ino,st.st_size,st.st_mtime)
+
+
+def write_stars(starfile,catalog,columns):
+    """
+    Writes catalog (with the names of its columns) to the `.stars` list
+    starfile
+    """
+    # written aside and moved into place, so that other processes sharing
+    # the workdir never read a half written .stars file
+    tmpstarfile = '%s.%i' % (starfile,os.getpid())
+    header = ''.join('#%4i %s\n' % (i+1,c) for i,c in enumerate(columns))
+    with open(tmpstarfile,'w') as f:
+        f.write(header)
+        np.savetxt(f,catalog,fmt='%.10g')
+        f.flush()
+        identity = _identify(f)
+    os.rename(tmpstarfile,starfile)
+    _stars[os.path.abspath(starfile)] = (identity,catalog,list(columns))
+
+
+def _load_stars(starfile):
+    with open(starfile) as f:
+        identity = _identify(f)
+        cached = _stars.get(os.path.abspath(starfile))
+        if cached and cached[0] == identity:
+            return cached[1:]
+        lines = f.readlines()
+    columns = [l.split()[2] for l in lines if l.startswith('#')
+                                          and len(l.split()) > 2]
+    catalog = np.loadtxt(lines,ndmin=2)
+    if columns:
+        catalog = catalog.reshape(-1,len(columns))
+    _stars[os.path.abspath(starfile)] = (identity,catalog,columns)
+    return catalog,columns
+
+
+def read_stars(starfile,columns=False):
+    """
+    Returns the catalog of the `.stars` list starfile, as an (n,columns)
+    array, along with the names of its columns if columns is True. IOError
+    if it can't be read
+    """
+    catalog,names = _load_stars(starfile)
+    if columns:
+        return catalog,names
+    return catalog
+
+
+def filter_stars(starfile,keep):
+    """
+    Rewrites the `.stars` list starfile with only the objects where keep is
+    True
+    """
+    catalog,columns = _load_stars(starfile)
+    write_stars(starfile,catalog[keep],columns)
 
 
 def getmedianseeing(starlist):
     try:
-        s = np.genfromtxt(starlist)
+        s = read_stars(starlist)
     except IOError:
         logger.warning('couldn\'t read from %s to obtain seeing info'
                        % starlist)
@@ -74,9 +188,9 @@ def getmedianseeing(starlist):
     s = sc.copy()
 
     # get median seeing of images (in pixels)
-    if len(s.shape) == 1:
+    if len(s) == 1:
         logger.warning('seeing based on only 1 SExtracted object')
-        return float(s[8])
+        return float(s[0,8])
         
     medseeing = np.median(s[:,8])
     logger.info('median seeing = %5.3f (from %i measurements)'
@@ -87,8 +201,8 @@ def getmedianseeing(starlist):
 def getseeingratio(starlist1,starlist2):
 
     try:
-        s1 = np.genfromtxt(starlist1)
-        s2 = np.genfromtxt(starlist2)
+        s1 = read_stars(starlist1)
+        s2 = read_stars(starlist2)
     except IOError:
         logger.warning('couldn\'t open output file from SExtractor')
         logger.info('SExtractor probably failed to find any objects')
@@ -108,21 +222,14 @@ def getseeingratio(starlist1,starlist2):
     s1 = s1b.copy()
     s2 = s2b.copy()
 
-    # detemine a ratio between the two (by directly comparing objects)
-    ratio = []
-    for i in range(len(np.atleast_2d(s1))):
-        if len(ratio) > 100:
-            break
-        s1x = s1[i,0]
-        s1y = s1[i,1]
-        for j in range(len(np.atleast_2d(s2))):
-            s2x = s2[j,0]
-            s2y = s2[j,1]
-            r = sqrt((s1x-s2x)**2+(s1y-s2y)**2)
-            if r < 2:
-                if s1[i,8] and s2[j,8]:
-                    ratio.append(s1[i,8]/s2[j,8])
-                    break
+    # detemine a ratio between the two (by directly comparing objects with
+    # a measured fwhm)
+    s1 = np.atleast_2d(s1)
+    s2 = np.atleast_2d(s2)
+    s1 = s1[s1[:,8]!=0]
+    s2 = s2[s2[:,8]!=0]
+    i,j,sep = crossmatch.match(s1,s2,2)
+    ratio = s1[i,8]/s2[j,8]
     logger.info('seeing ratio determined from median of %i object ratios'
                  % (len(ratio)))
 
@@ -134,12 +241,14 @@ def runalard(template,image,tempsat=55000,imagesat=55000,imagethresh=25,
              nsx=9,nsy=9,sx=1,sy=1,minval=5,minstamp=130,kernelorder=2,
              reverseflag=0,hms=9,hss=0,sg1=0.7,sg2=1.5,sg3=2.5,
              deg_bg=1,removeconv=0,iterkernelsig=2,adapt=True,
-             stamps=''):
+             stamps='',sexmethod='sex'):
     """
     Python function implementation of the perl script runalard.pl.
     Arguments correspond to same as in runalard.pl
     """
     
+    image = os.path.abspath(image)
+    template = os.path.abspath(template)
     baseimage = os.path.splitext(image)[0]
     basetemplate = os.path.splitext(template)[0]
     imstarlist = baseimage+'.stars'
@@ -155,12 +264,12 @@ def runalard(template,image,tempsat=55000,imagesat=55000,imagethresh=25,
         pass
     finally:
         logger.debug('running SExtractor on aligned image') 
-        runsex(image,imagethresh,imagesat)
+        runsex(image,imagethresh,imagesat,method=sexmethod)
     try:
         open(tempstarlist)
     except IOError:
         logger.debug('running SExtractor on template') 
-        runsex(template,tempthresh,tempsat)
+        runsex(template,tempthresh,tempsat,method=sexmethod)
 
     logger.debug('getting seeing ratio of two frames') 
     ratio = getseeingratio(imstarlist,tempstarlist)
@@ -181,14 +290,18 @@ def runalard(template,image,tempsat=55000,imagesat=55000,imagethresh=25,
 
     logger.info(r)
 
+    # alardsub reads and writes all its files in its current directory, so
+    # it is run from our scratch directory
+    scratchdir = get_scratchdir()
+
     # remove the old STAMPS file if present and copy a new one if availible
     try:
-        os.remove('STAMPS')
+        os.remove(scratchpath('STAMPS'))
     except OSError:
         pass
     if stamps:
         stampsbyxy = 1
-        shutil.copy(stamps,'STAMPS')
+        shutil.copy(stamps,scratchpath('STAMPS'))
         logger.debug('stamps file copied')
     else:
         stampsbyxy = 0
@@ -225,7 +338,7 @@ def runalard(template,image,tempsat=55000,imagesat=55000,imagethresh=25,
     if reverse:
         tempsat,imagesat = imagesat,tempsat
 
-    cfg = open('default_config','w')
+    cfg = open(scratchpath('default_config'),'w')
     cfg.write("""
 nstamps_x         %i       
 nstamps_y         %i      
@@ -262,17 +375,18 @@ iter_kernal_sig   %i
         alardfile.write(s+'\n')
         alardfile.flush()
         alardcode = subprocess.Popen([os.path.join(FILEDIR,'Alard/alardsub'),
-                                     template,image],stdout=alardfile).wait()
+                                     template,image],stdout=alardfile,
+                                     cwd=scratchdir).wait()
         print os.path.join(FILEDIR,'Alard/alardsub'),image,template
         try:
-            shutil.move('conv.fits', baseimage+'.sub.fits')
+            shutil.move(scratchpath('conv.fits'),baseimage+'.sub.fits')
         except OSError:
             logger.error('couldn\'t find ISIS subtracted output: "conv.fits"')
             return 0,0,0,alardcode
         if removeconv:
-            os.remove('conv0.fits')
+            os.remove(scratchpath('conv0.fits'))
         else:
-            shutil.move('conv0.fits',basetemplate+'.conv.fits')
+            shutil.move(scratchpath('conv0.fits'),basetemplate+'.conv.fits')
             # copy header from template to convolved template
             templatehdr = pyfits.getheader(template)
             convHDU = pyfits.open(basetemplate+'.conv.fits',mode='update')
@@ -287,16 +401,17 @@ iter_kernal_sig   %i
         alardfile.write(s+'\n')
         alardfile.flush()
         alardcode = subprocess.Popen([os.path.join(FILEDIR,'Alard/alardsub'),
-                                     image,template],stdout=alardfile).wait()
+                                     image,template],stdout=alardfile,
+                                     cwd=scratchdir).wait()
         try:
-            shutil.move('conv.fits', baseimage+'.sub.fits')
+            shutil.move(scratchpath('conv.fits'),baseimage+'.sub.fits')
         except OSError:
             logger.error('couldn\'t find ISIS subtracted output: "conv.fits"')
             return 0,0,0,alardcode
         if removeconv:
-            os.remove('conv0.fits')
+            os.remove(scratchpath('conv0.fits'))
         else:
-            shutil.move('conv0.fits',baseimage+'.conv.fits')
+            shutil.move(scratchpath('conv0.fits'),baseimage+'.conv.fits')
             # copy header from image to convolved image
             imagehdr = pyfits.getheader(image)
             convHDU = pyfits.open(baseimage+'.conv.fits',mode='update')
@@ -314,7 +429,7 @@ iter_kernal_sig   %i
     except OSError:
         pass
     try:
-        shutil.move('sum_kernel',baseimage+'.sum_kernel')
+        shutil.move(scratchpath('sum_kernel'),baseimage+'.sum_kernel')
     except IOError:
         logger.error('no sum_kernel file - subtraction gone awry')
         logger.info('check your parameters in your ISIScfg.py file')
@@ -335,13 +450,4 @@ def get_sex_string(configsex,testcat,daofindparam,defaultconv,thresh,sat,
     return configstring.format(testcat,daofindparam,thresh,thresh,
                                defaultconv,sat,zp,defaultnnw)
 
-@atexit.register
-def cleanup():
-    for junk in ['conv.fits','conv0.fits','default_config','kernel_table',
-                 'toto.bmp']:
-        try:
-            os.remove(junk)
-        except OSError:
-            pass
-
 
@@ -0,0 +1,144 @@
+"""
+subpipe result store
+
+run-subpipe used to pickle each finished SubtractionPipeline, along with its
+GetImageInfo instances, into the workdir's pipe.shelve, reopening the shelve
+for every image, and run-photpipe unpickled every one of them again, which
+needed subpipe (and pyraf with it) imported just to read a few fields. The
+results are kept in an SQLite table in the workdir instead, one row per
+image: its paths, the FWHM, stats and header values of the image, aligned,
+subtracted and template frames, the reverse flag and the failcode.
+
+Rows are written in a transaction each, so any number of processes can
+append to the same store, and read back as plain Records that photpipe
+uses just as it did the SubtractionPipeline instances.
+"""
+import os
+import sqlite3
+import logging
+
+logger = logging.getLogger('run-subpipe.subpipe.resultstore')
+
+STORENAME = 'results.sqlite'
+
+# seconds to wait for another process's write to finish
+TIMEOUT = 60
+
+# the columns for the SubtractionPipeline itself
+COLUMNS = [('image','TEXT'),('inputhash','TEXT'),('fail','INTEGER'),
+           ('code','TEXT'),('PIPEcfg','TEXT'),('template','TEXT'),
+           ('templatekey','TEXT'),('alignedimage','TEXT'),('subimage','TEXT'),
+           ('reverse','INTEGER'),('seeingratio','REAL'),('sum_kernel','REAL')]
+
+# and for each of its GetImageInfo instances, prefixed by INFOS
+INFOS = ['i','a','s','t'] # image, aligned image, subtracted image, template
+INFOCOLUMNS = [('fwhm','REAL'),('date','REAL'),('exptime','REAL'),
+               ('gain','REAL'),('readnoise','REAL'),('filter','TEXT'),
+               ('object','TEXT')]
+STATSKEYS = ['xsize','ysize','mean','stddev','tstddev','datamin']
+
+class Record(object):
+    """
+    The stored values of a SubtractionPipeline or GetImageInfo, as
+    attributes
+    """
+    def __init__(self,**values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return 'Record(%s)' % getattr(self,'name','')
+
+
+def _columns():
+    columns = [('name','TEXT PRIMARY KEY')]+COLUMNS
+    for info in INFOS:
+        columns += [('%s_%s' % (info,name),type) for name,type in INFOCOLUMNS]
+        columns += [('%s_%s' % (info,key),'REAL') for key in STATSKEYS]
+    return columns
+
+
+class ResultStore(object):
+    """
+    The subpipe results of a workdir.
+
+    INPUT
+        workdir:
+                the work directory, holding the store as STORENAME
+        readonly [False]:
+                don't create the store if it isn't there (IOError instead)
+    """
+    def __init__(self,workdir,readonly=False):
+        self.path = os.path.join(workdir,STORENAME)
+        if readonly and not os.path.isfile(self.path):
+            raise IOError('no result store in %s' % workdir)
+        self.conn = sqlite3.connect(self.path,timeout=TIMEOUT)
+        self.conn.row_factory = sqlite3.Row
+        # paths as str, as they are handed on to IRAF
+        self.conn.text_factory = str
+        self.columns = [name for name,type in _columns()]
+        if not readonly:
+            columns = ','.join('%s %s' % c for c in _columns())
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS results (%s)'
+                                  % columns)
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def put(self,s):
+        """
+        Stores the results of the SubtractionPipeline instance s, in place of
+        any earlier results for its image
+        """
+        values = {'name':os.path.basename(s.image)}
+        for name,type in COLUMNS:
+            values[name] = getattr(s,name,None)
+        for info in INFOS:
+            i = getattr(s,info,None)
+            for name,type in INFOCOLUMNS:
+                values['%s_%s' % (info,name)] = getattr(i,name,None)
+            stats = getattr(i,'stats',None) or {}
+            for key in STATSKEYS:
+                values['%s_%s' % (info,key)] = stats.get(key)
+        # numpy scalars aren't understood by sqlite3
+        for name,value in values.items():
+            if hasattr(value,'item'):
+                values[name] = value.item()
+        logger.debug('storing results of %s' % values['name'])
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO results (%s) VALUES '
+                              '(%s)' % (','.join(self.columns),
+                                        ','.join('?'*len(self.columns))),
+                              [values[name] for name in self.columns])
+
+    def get_hashes(self):
+        """
+        Returns the input hashes of the stored images, keyed by image name
+        """
+        return dict(self.conn.execute('SELECT name,inputhash FROM results'))
+
+    def records(self):
+        """
+        Returns the stored results as Records, in image name order. Their
+        i, a, s and t attributes are Records of the GetImageInfo values
+        (with a stats dict), None where the pipeline didn't get that far
+        """
+        records = []
+        for row in self.conn.execute('SELECT * FROM results ORDER BY name'):
+            values = dict((name,row[name]) for name,type in COLUMNS)
+            values['name'] = row['name']
+            for info in INFOS:
+                if row['%s_fwhm' % info] is None and \
+                   row['%s_mean' % info] is None:
+                    values[info] = None
+                    continue
+                infovalues = dict((name,row['%s_%s' % (info,name)])
+                                  for name,type in INFOCOLUMNS)
+                infovalues['stats'] = dict((key,row['%s_%s' % (info,key)])
+                                           for key in STATSKEYS)
+                values[info] = Record(**infovalues)
+            records.append(Record(**values))
+        return records
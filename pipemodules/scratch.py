@@ -0,0 +1,71 @@
+"""
+private scratch directories
+
+SExtractor, ISIS and IRAF all need somewhere to write their temporary files
+(configs, catalogs, convolved frames, match lists...). These go in a scratch
+directory private to the process, so that any number of pipeline runs can
+share a host without overwriting each other's files.
+"""
+import os
+import shutil
+import tempfile
+import atexit
+
+# the current scratch directory, made on first use if not set
+SCRATCHDIR = None
+
+# scratch trees made by make_scratchdir as (pid,path), removed at exit
+_owned = []
+
+def make_scratchdir(parent=None):
+    """
+    Creates a new private scratch tree and makes it the scratch directory.
+
+    INPUT
+        parent [None]:
+                directory to create the tree in, defaults to $TMPDIR
+    OUTPUT
+        the path to the new scratch directory
+
+    The tree is removed when the process that made it exits.
+    """
+    global SCRATCHDIR
+    SCRATCHDIR = tempfile.mkdtemp(prefix='CLASPscratch.',dir=parent)
+    _owned.append((os.getpid(),SCRATCHDIR))
+    return SCRATCHDIR
+
+
+def set_scratchdir(path):
+    """
+    Uses `path` as the scratch directory, creating it if needed. Intended
+    for sub directories of a tree from make_scratchdir (e.g. one per worker)
+    """
+    global SCRATCHDIR
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    SCRATCHDIR = path
+    return SCRATCHDIR
+
+
+def get_scratchdir():
+    """
+    Returns the scratch directory, making a new tree in $TMPDIR if unset.
+    """
+    if SCRATCHDIR is None:
+        make_scratchdir()
+    return SCRATCHDIR
+
+
+def scratchpath(filename):
+    """
+    Returns the path to `filename` inside the scratch directory.
+    """
+    return os.path.join(get_scratchdir(),filename)
+
+
+@atexit.register
+def cleanup():
+    # forked children inherit _owned, only the creator removes a tree
+    for pid,path in _owned:
+        if pid == os.getpid():
+            shutil.rmtree(path,ignore_errors=True)
@@ -0,0 +1,183 @@
+"""
+client side of the pipeline service
+
+run-pipeservice.py keeps a resident process with pyraf imported and the
+IRAF packages loaded, listening on a local UNIX socket. run-subpipe.py,
+run-photpipe.py and the GUI hand their jobs to it (when it is running)
+rather than paying for pyraf start up in a fresh interpreter each time.
+
+A job is a pipeline script and its arguments, sent as a single JSON line.
+The service forks a child for the job with the connection as its stdin,
+stdout and stderr, so the job's output comes back over the socket and
+anything written to the socket reaches the job's stdin (e.g. answers to
+its questions). The child first sends a header line with its pid, and the
+service ends the stream with a trailer line holding the exit code.
+"""
+import os
+import sys
+import json
+import socket
+import getpass
+import tempfile
+import threading
+import signal
+
+# default socket path, one service per user per host
+SOCKETPATH = os.path.join(tempfile.gettempdir(),
+                          'CLASPservice.%s.sock' % getpass.getuser())
+
+# environment variables: CLASP_SOCKET overrides the socket path, and
+# CLASP_SERVICE_JOB is set inside jobs so they don't relay back again
+SOCKETENV = 'CLASP_SOCKET'
+JOBENV = 'CLASP_SERVICE_JOB'
+
+# markers beginning the header/trailer lines around a job's output
+PIDMARKER = '\0CLASP-PID '
+EXITMARKER = '\0CLASP-EXIT '
+
+
+def get_socketpath():
+    return os.environ.get(SOCKETENV,SOCKETPATH)
+
+
+def connect(socketpath=None):
+    """
+    Returns a socket connected to the service, None if it isn't running
+    """
+    socketpath = socketpath or get_socketpath()
+    if not os.path.exists(socketpath):
+        return None
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def available():
+    """
+    True if the service is running and we're not already one of its jobs
+    """
+    if os.environ.get(JOBENV):
+        return False
+    sock = connect()
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+class ServiceJob(object):
+    """
+    A job running in the service, with the parts of the subprocess.Popen
+    interface used by the GUI (stdin, stdout, poll, wait, terminate, kill)
+
+    INPUT
+        script:
+                path to the pipeline script to run
+        args:
+                list of command line arguments for the script
+        cwd [None]:
+                directory to run the job in, defaults to the current one
+    """
+    def __init__(self,script,args,cwd=None):
+        self.sock = connect()
+        if self.sock is None:
+            raise IOError('pipeline service isn\'t running (%s)'
+                          % get_socketpath())
+        request = {'script':os.path.abspath(script),
+                   'args':[str(a) for a in args],
+                   'cwd':os.path.abspath(cwd or os.getcwd())}
+        self.sock.sendall(json.dumps(request)+'\n')
+        self._out = self.sock.makefile('rb')
+        self.stdin = self.sock.makefile('wb',0)
+        # stdout.readline() hands back the job's output, minus the trailer
+        self.stdout = self
+        self.returncode = None
+        self._rest = ''
+        header = self._out.readline()
+        if not header.startswith(PIDMARKER):
+            self.returncode = -1
+            raise IOError('bad reply from pipeline service: %r' % header)
+        self.pid = int(header[len(PIDMARKER):])
+
+    def readline(self):
+        if self.returncode is not None:
+            return ''
+        line = self._rest or self._out.readline()
+        self._rest = ''
+        i = line.find(EXITMARKER)
+        if i > 0:
+            # job output ended without a newline, return it first
+            self._rest = line[i:]
+            return line[:i]
+        if i == 0:
+            self.returncode = int(line[len(EXITMARKER):])
+            self.close()
+            return ''
+        if line == '':
+            # connection lost without a trailer, the service has gone
+            self.returncode = -1
+            self.close()
+        return line
+
+    def close(self):
+        for f in (self._out,self.stdin,self.sock):
+            try:
+                f.close()
+            except (IOError,socket.error):
+                pass
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.readline() != '':
+            pass
+        return self.returncode
+
+    def send_signal(self,sig):
+        # jobs lead their own process group, so this reaches their workers
+        if self.returncode is None and self.pid > 0:
+            try:
+                os.killpg(self.pid,sig)
+            except OSError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def relay(script,args):
+    """
+    Runs script with args in the service, passing our stdin to it and its
+    output to our stdout, as if it were running here.
+
+    OUTPUT
+        the job's exit code
+    """
+    job = ServiceJob(script,args)
+
+    def feedstdin():
+        try:
+            for line in iter(sys.stdin.readline,''):
+                job.stdin.write(line)
+        except (IOError,socket.error,ValueError):
+            pass
+    t = threading.Thread(target=feedstdin)
+    t.daemon = True
+    t.start()
+
+    try:
+        for line in iter(job.stdout.readline,''):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        job.terminate()
+        return job.wait() or 1
+    return job.returncode
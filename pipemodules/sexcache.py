@@ -0,0 +1,105 @@
+"""
+SExtractor catalog cache
+
+The same frame is SExtracted at several stages of the pipeline (and again
+on every update run), with the same settings as often as not. Catalogs are
+kept here as binary numpy arrays, keyed by a hash of the frame (its FITS
+file, header included, for SExtractor, which reads WCS and other cards from
+it), the SExtractor config files and the threshold, saturation level and
+zero point, so that an unchanged extraction is read back rather than
+repeated.
+
+The cache lives in CACHEDIR (one per workdir, shared by every process using
+it); while unset, nothing is cached.
+"""
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('run-subpipe.subpipe.sexcache')
+
+# the cache directory, None to not cache
+CACHEDIR = None
+
+# lookups this process has made, found and not found
+hits = 0
+misses = 0
+
+def set_cachedir(path):
+    """
+    Caches catalogs in `path`, creating it if needed. None stops caching
+    """
+    global CACHEDIR
+    if path is not None and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # made by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+    CACHEDIR = path
+    return CACHEDIR
+
+
+def get_key(image,configfiles,params,blocksize=2**20):
+    """
+    Returns the cache key for SExtracting image with configfiles (config,
+    parameter, filter files...) and params (threshold, saturation...).
+    image is the FITS filepath, whose header (WCS, gain...) counts as much
+    as its pixels, or an image array for extractions that only see that
+    """
+    h = hashlib.sha1()
+    if isinstance(image,basestring):
+        # the raw file, header and all, without decoding the pixels
+        with open(image,'rb') as f:
+            for block in iter(lambda: f.read(blocksize),''):
+                h.update(block)
+    else:
+        data = np.ascontiguousarray(image)
+        h.update('%s %r\0' % (data.dtype.str,data.shape))
+        h.update(data.data)
+    for path in configfiles:
+        with open(path,'rb') as f:
+            h.update(f.read())
+        h.update('\0')
+    for p in params:
+        h.update('%r\0' % (p,))
+    return h.hexdigest()
+
+
+def cachepath(key):
+    return os.path.join(CACHEDIR,key+'.npy')
+
+
+def load(key):
+    """
+    Returns the catalog array cached under key, None if there isn't one
+    """
+    global hits,misses
+    if CACHEDIR is None:
+        return None
+    try:
+        catalog = np.load(cachepath(key))
+    except (IOError,ValueError):
+        misses += 1
+        logger.debug('catalog cache miss %s' % key[:16])
+        return None
+    hits += 1
+    logger.debug('catalog cache hit %s' % key[:16])
+    return catalog
+
+
+def save(key,catalog):
+    """
+    Caches the catalog array under key
+    """
+    if CACHEDIR is None:
+        return
+    # written aside and moved into place, so other processes never load a
+    # half written catalog
+    path = cachepath(key)
+    tmppath = '%s.%i.npy' % (path[:-4],os.getpid())
+    np.save(tmppath,catalog)
+    os.rename(tmppath,path)
@@ -0,0 +1,184 @@
+"""
+source extraction
+
+An in-process alternative to the bundled SExtractor binary, working on an
+image array already in memory. The background is estimated on a mesh,
+the background subtracted image is filtered and thresholded, and the
+connected pixels above threshold (ndimage.label) are measured by their
+moments.
+
+It returns the columns of Sex/daofind.param, in the same order, so the
+catalogs can be used in place of SExtractor's. There is no deblending,
+CLASS_STAR is not estimated and no world coordinates are given (these
+columns are nan). MAG_BEST is the isophotal magnitude, and FLAGS only
+marks saturated (4) and truncated (8) objects.
+"""
+import logging
+
+import numpy as np
+from scipy import ndimage
+
+logger = logging.getLogger('run-subpipe.subpipe.sourcefind')
+
+COLUMNS = ['X_IMAGE','Y_IMAGE','NUMBER','MAG_BEST','FLAGS','A_IMAGE',
+           'B_IMAGE','ELONGATION','FWHM_IMAGE','CLASS_STAR','X_WORLD',
+           'Y_WORLD','FLUX_MAX','THRESHOLD']
+
+# as in Sex/config.sex
+BACKSIZE = 128        # background mesh size
+BACKFILTERSIZE = 3    # median filter size of the background mesh
+MINAREA = 5           # minimum number of pixels above threshold
+
+# the all-ground 3x3 filter of Sex/default.conv
+KERNEL = np.array([[1,2,1],
+                   [2,4,2],
+                   [1,2,1]],dtype=np.float32)
+
+def background(data,size=BACKSIZE,filtersize=BACKFILTERSIZE,nclip=3):
+    """
+    Estimates the background and its rms as SExtractor does: a clipped
+    mode and standard deviation in each cell of a mesh, median filtered and
+    interpolated back to the full image.
+
+    INPUT
+        data:
+                the image array
+        size [BACKSIZE]:
+                size of the square mesh cells
+        filtersize [BACKFILTERSIZE]:
+                size of the median filter applied to the mesh
+        nclip [3]:
+                iterations of 3 sigma clipping in each cell
+    OUTPUT
+        background, rms:
+                float32 arrays the shape of data
+    """
+    ny,nx = data.shape
+    my,mx = -(-ny//size),-(-nx//size)
+    # the cells as rows of a (my*mx,size*size) array, nan padded
+    cells = np.empty((my*size,mx*size),dtype=np.float32)
+    cells.fill(np.nan)
+    cells[:ny,:nx] = data
+    cells = cells.reshape(my,size,mx,size).swapaxes(1,2)\
+                 .reshape(my*mx,size*size)
+    with np.errstate(invalid='ignore'):
+        for i in range(nclip):
+            med = np.nanmedian(cells,axis=1)[:,None]
+            std = np.nanstd(cells,axis=1)[:,None]
+            cells[np.abs(cells-med) > 3*std] = np.nan
+        med = np.nanmedian(cells,axis=1)
+        mean = np.nanmean(cells,axis=1)
+        std = np.nanstd(cells,axis=1)
+    # SExtractor's mode estimate, unless the cell is too crowded for it
+    mode = np.where(np.abs(mean-med) < 0.3*std,2.5*med-1.5*mean,med)
+
+    meshes = []
+    for mesh in (mode,std):
+        mesh = mesh.reshape(my,mx)
+        bad = ~np.isfinite(mesh)
+        if bad.all():
+            mesh = np.zeros_like(mesh)
+        elif bad.any():
+            mesh[bad] = np.median(mesh[~bad])
+        if filtersize > 1:
+            mesh = ndimage.median_filter(mesh,filtersize,mode='nearest')
+        # bilinear between cell centres, one axis at a time
+        mesh = _interp(mesh.astype(np.float32),ny,size)
+        meshes.append(_interp(mesh.T,nx,size).T)
+    return meshes
+
+
+def _interp(mesh,n,size):
+    """
+    Linearly interpolates the rows of mesh (cells of `size` pixels) to `n`
+    pixels, constant beyond the first and last cell centres
+    """
+    pos = np.clip((np.arange(n)+0.5)/size-0.5,0,len(mesh)-1)
+    i = np.minimum(pos.astype(int),len(mesh)-2) if len(mesh) > 1 else \
+        np.zeros(n,dtype=int)
+    w = (pos-i).astype(np.float32)[:,None]
+    if len(mesh) == 1:
+        return mesh[i]
+    return (1-w)*mesh[i]+w*mesh[i+1]
+
+
+def extract(data,thresh=10,sat=55000,zp=25,minarea=MINAREA,kernel=KERNEL):
+    """
+    Finds and measures the objects in data.
+
+    INPUT
+        data:
+                the image array
+        thresh [10]:
+                detection threshold in units of the background rms
+        sat [55000]:
+                saturation level
+        zp [25]:
+                magnitude zero point
+        minarea [MINAREA]:
+                minimum number of pixels above threshold
+        kernel [KERNEL]:
+                filter applied before thresholding, None for none
+    OUTPUT
+        an (n,len(COLUMNS)) catalog, in detection order
+    """
+    data = np.asarray(data,dtype=np.float32)
+    bkg,rms = background(data)
+    sub = data-bkg
+    if kernel is not None:
+        filtered = ndimage.convolve(sub,kernel/kernel.sum(),mode='nearest')
+    else:
+        filtered = sub
+    labels,n = ndimage.label(filtered > thresh*rms,
+                             structure=np.ones((3,3),dtype=bool))
+    if not n:
+        return np.zeros((0,len(COLUMNS)))
+
+    # moments of each object from the pixels above threshold
+    inobj = np.flatnonzero(labels)
+    lab = labels.ravel()[inobj]
+    y,x = np.unravel_index(inobj,data.shape)
+    f = np.clip(sub.ravel()[inobj],0,None).astype(float)
+    def total(w=None):
+        return np.bincount(lab,weights=w,minlength=n+1)[1:]
+    area = total()
+    flux = total(f)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        xc = total(f*x)/flux
+        yc = total(f*y)/flux
+        x2 = total(f*x*x)/flux-xc**2
+        y2 = total(f*y*y)/flux-yc**2
+        xy = total(f*x*y)/flux-xc*yc
+    # unresolved objects, as SExtractor
+    singular = x2*y2-xy**2 < 1/144.
+    x2[singular] += 1/12.
+    y2[singular] += 1/12.
+    half = (x2+y2)/2.
+    root = np.sqrt(((x2-y2)/2.)**2+xy**2)
+    a = np.sqrt(half+root)
+    b = np.sqrt(np.clip(half-root,1e-12,None))
+
+    index = np.arange(1,n+1)
+    peak = np.asarray(ndimage.maximum(sub,labels,index),dtype=float)
+    saturated = np.asarray(ndimage.maximum(data,labels,index)) >= sat
+    edge = np.zeros(n+1,dtype=bool)
+    for border in (labels[0],labels[-1],labels[:,0],labels[:,-1]):
+        edge[border] = True
+    flags = 4*saturated+8*edge[1:]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mag = np.where(flux > 0,zp-2.5*np.log10(flux),99.)
+        # of a gaussian with this peak and total flux
+        fwhm = 2*np.sqrt(np.log(2)*flux/(np.pi*peak))
+    yi = np.clip(np.round(np.nan_to_num(yc)),0,data.shape[0]-1).astype(int)
+    xi = np.clip(np.round(np.nan_to_num(xc)),0,data.shape[1]-1).astype(int)
+    blank = np.empty(n)
+    blank.fill(np.nan)
+
+    catalog = np.column_stack([xc+1,yc+1,index,mag,flags,a,b,a/b,fwhm,
+                               blank,blank,blank,peak,thresh*rms[yi,xi]])
+    keep = (area >= minarea) & (flux > 0)
+    catalog = catalog[keep]
+    catalog[:,2] = np.arange(1,len(catalog)+1)
+    logger.debug('found %i objects above %g sigma' % (len(catalog),thresh))
+    return catalog
@@ -0,0 +1,198 @@
+"""
+star pattern matching
+
+An in-process replacement for iraf.xyxymatch: matches two coordinate lists
+(e.g. the SExtractor .coo lists of an image and the template) that differ
+by an unknown shift, rotation, scale and/or flip, returning the matched
+pairs as index arrays.
+
+Triangles are formed from the brightest objects in each list, and
+described by the ratios of their two shorter sides to their longest, which
+don't change under the transformation. Triangles with similar ratios are
+found with a KD-tree, and each such pair of triangles proposes a
+transformation (RANSAC style). Hypotheses are tried strongest first (by how
+many triangle pairs agree on their vertex correspondences) and kept by how
+many objects of the full lists they bring within `tolerance` of one
+another. No random sampling is used, so the result is repeatable.
+"""
+import itertools
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger('run-subpipe.subpipe.starmatch')
+
+INVTOL = 0.01     # tolerance on the triangle side ratios
+MAXTRIALS = 200   # most transformation hypotheses to try
+STOPFRAC = 0.8    # stop trying once this fraction of the shorter list matches
+MINRATIO = 0.05   # triangles whose shortest/longest side is below this are
+                  # too thin to be described reliably, and are dropped
+
+def brightest(coords,nmatch,separation):
+    """
+    Returns the indices of (up to) the first `nmatch` coords (lists are
+    sorted brightest first), leaving out any within `separation` of one
+    already chosen
+    """
+    keep = []
+    for i in range(len(coords)):
+        if len(keep) >= nmatch:
+            break
+        if keep:
+            d = np.hypot(*(coords[keep]-coords[i]).T)
+            if d.min() < separation:
+                continue
+        keep.append(i)
+    return np.array(keep,dtype=int)
+
+
+def triangles(coords):
+    """
+    Forms every triangle of coords.
+
+    OUTPUT
+        vertices:
+                (n,3) indices into coords, ordered so that vertex k is
+                opposite the k-th shortest side
+        invariants:
+                (n,2) the two shorter sides as fractions of the longest
+    """
+    if len(coords) < 3:
+        return np.zeros((0,3),dtype=int),np.zeros((0,2))
+    vertices = np.array(list(itertools.combinations(range(len(coords)),3)))
+    p = coords[vertices]
+    sides = np.column_stack([np.hypot(*(p[:,1]-p[:,2]).T),
+                             np.hypot(*(p[:,0]-p[:,2]).T),
+                             np.hypot(*(p[:,0]-p[:,1]).T)])
+    order = np.argsort(sides,axis=1,kind='mergesort')
+    rows = np.arange(len(vertices))[:,None]
+    sides = sides[rows,order]
+    vertices = vertices[rows,order]
+    good = sides[:,0] > MINRATIO*sides[:,2]
+    invariants = sides[good,:2]/sides[good,2:]
+    return vertices[good],invariants
+
+
+def fit_affine(coords,refcoords):
+    """
+    Least squares affine transformation taking coords onto refcoords, as a
+    (3,2) matrix to apply with `np.dot(np.column_stack([x,y,1]),A)`. None if
+    the points are degenerate (e.g. in a line)
+    """
+    X = np.column_stack([coords,np.ones(len(coords))])
+    A,res,rank,sv = np.linalg.lstsq(X,refcoords,rcond=None)
+    if rank < 3:
+        return None
+    return A
+
+
+def transform(A,coords):
+    return np.dot(np.column_stack([coords,np.ones(len(coords))]),A)
+
+
+def inliers(A,coords,reftree,tolerance):
+    """
+    Pairs coords (transformed by A) with their nearest reference object,
+    where within tolerance. Each reference object is paired at most once,
+    with its closest.
+
+    OUTPUT
+        indices into coords, indices into the reference coords
+    """
+    d,refidx = reftree.query(transform(A,coords),
+                             distance_upper_bound=tolerance)
+    idx = np.flatnonzero(np.isfinite(d))
+    idx = idx[np.argsort(d[idx],kind='mergesort')]
+    refidx,first = np.unique(refidx[idx],return_index=True)
+    idx = idx[first]
+    order = np.argsort(idx)
+    return idx[order],refidx[order]
+
+
+def match(coords,refcoords,nmatch=60,tolerance=3,separation=5,
+          invtol=INVTOL,maxtrials=MAXTRIALS):
+    """
+    Matches objects in coords to those in refcoords.
+
+    INPUT
+        coords, refcoords:
+                (n,2) arrays of x,y positions, sorted brightest first
+        nmatch [60]:
+                number of brightest objects in each list to form triangles
+                from (cf. xyxymatch's nmatch)
+        tolerance [3]:
+                pixels within which transformed objects are matched
+        separation [5]:
+                objects closer than this to a brighter one aren't used in
+                triangles (cf. xyxymatch's separation)
+        invtol [INVTOL]:
+                tolerance on the triangle side ratios
+        maxtrials [MAXTRIALS]:
+                most transformation hypotheses to try
+    OUTPUT
+        idx,refidx:
+                index arrays of the matched pairs, i.e. coords[idx] matches
+                refcoords[refidx]. empty if no match was found
+    """
+    nomatch = np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+    coords = np.atleast_2d(np.asarray(coords,dtype=float))[:,:2]
+    refcoords = np.atleast_2d(np.asarray(refcoords,dtype=float))[:,:2]
+    if len(coords) < 3 or len(refcoords) < 3:
+        return nomatch
+
+    ci = brightest(coords,nmatch,separation)
+    ri = brightest(refcoords,nmatch,separation)
+    ctri,cinv = triangles(coords[ci])
+    rtri,rinv = triangles(refcoords[ri])
+    if not len(ctri) or not len(rtri):
+        return nomatch
+
+    # all pairs of similar triangles
+    near = cKDTree(cinv).sparse_distance_matrix(cKDTree(rinv),invtol,
+                                                output_type='ndarray')
+    if not len(near):
+        return nomatch
+    ct = near['i'].astype(int)
+    rt = near['j'].astype(int)
+
+    # each pair votes for its three vertex correspondences, and hypotheses
+    # are ranked by the votes for theirs
+    votes = np.bincount((ctri[ct]*len(ri)+rtri[rt]).ravel(),
+                        minlength=len(ci)*len(ri)).reshape(len(ci),len(ri))
+    score = votes[ctri[ct],rtri[rt]].sum(axis=1)
+    # only the best maxtrials are needed, ordered (ties included, for a
+    # repeatable order)
+    if len(score) > maxtrials:
+        top = np.flatnonzero(score >= np.partition(score,-maxtrials)
+                                                         [-maxtrials])
+        ct,rt,score = ct[top],rt[top],score[top]
+    order = np.lexsort((rt,ct,-score))
+
+    reftree = cKDTree(refcoords)
+    enough = STOPFRAC*min(len(coords),len(refcoords))
+    best = nomatch
+    for k in order[:maxtrials]:
+        A = fit_affine(coords[ci[ctri[ct[k]]]],refcoords[ri[rtri[rt[k]]]])
+        if A is None:
+            continue
+        idx,refidx = inliers(A,coords,reftree,tolerance)
+        if len(idx) > len(best[0]):
+            best = idx,refidx
+            if len(idx) >= enough:
+                break
+    if len(best[0]) < 3:
+        return nomatch
+
+    # refine the transformation with everything matched, and match again
+    for i in range(2):
+        A = fit_affine(coords[best[0]],refcoords[best[1]])
+        if A is None:
+            break
+        idx,refidx = inliers(A,coords,reftree,tolerance)
+        if len(idx) < len(best[0]):
+            break
+        best = idx,refidx
+    logger.debug('matched %i objects, tried %i hypotheses'
+                 % (len(best[0]),min(len(order),maxtrials)))
+    return best
@@ -0,0 +1,135 @@
+"""
+template product cache
+
+The same deep templates are used for run after run, each in its own
+workdir, and each run cleaned the template, measured it and found its
+objects again, and photpipe redid its aperture correction. The results are
+kept here instead, in a directory shared by every run and workdir, so a new
+workdir starts with them ready.
+
+Entries are keyed by a hash of whatever went into the products: for the
+cleaned template, its information (FWHM, stats...) and object lists, the
+original template, the fringe frame and bad pixel mask, the pipeline config
+and the cleaning options (see run-subpipe); for the aperture correction
+products, the template's key, the star list and the photometry options
+(see photpipe). An entry holds files named by their suffix and an optional
+pickled object.
+
+The cache lives in CACHEDIR; while unset, nothing is cached.
+"""
+import os
+import shutil
+import cPickle
+import logging
+
+logger = logging.getLogger('run-subpipe.subpipe.templatecache')
+
+# the cache directory, None to not cache
+CACHEDIR = None
+
+INFONAME = 'info.pickle'
+
+# entries this process has restored, and looked for but not found
+hits = 0
+misses = 0
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # made by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+
+
+def set_cachedir(path):
+    """
+    Caches template products in `path`, creating it if needed. None stops
+    caching
+    """
+    global CACHEDIR
+    if path is not None:
+        _makedirs(path)
+    CACHEDIR = path
+    return CACHEDIR
+
+
+def entrypath(key,name=''):
+    return os.path.join(CACHEDIR,key,name)
+
+
+def _put(path,write):
+    """
+    Writes path with write(tmppath), aside and moved into place, so that
+    other processes never see a half written file
+    """
+    tmppath = '%s.%i.tmp' % (path,os.getpid())
+    write(tmppath)
+    os.rename(tmppath,path)
+
+
+def fetch(key,base,suffixes):
+    """
+    Copies the files cached under key with these suffixes to base+suffix.
+    Returns the suffixes found (and copied)
+    """
+    global hits,misses
+    if CACHEDIR is None:
+        return []
+    found = []
+    for suffix in suffixes:
+        try:
+            shutil.copy(entrypath(key,'template'+suffix),base+suffix)
+        except (IOError,OSError):
+            continue
+        found.append(suffix)
+    if found:
+        hits += 1
+        logger.debug('template cache hit %s (%s)' % (key[:16],
+                                                     ' '.join(found)))
+    else:
+        misses += 1
+        logger.debug('template cache miss %s' % key[:16])
+    return found
+
+
+def save(key,base,suffixes):
+    """
+    Caches the files base+suffix (those that exist) under key
+    """
+    if CACHEDIR is None:
+        return
+    _makedirs(entrypath(key))
+    for suffix in suffixes:
+        if os.path.isfile(base+suffix):
+            _put(entrypath(key,'template'+suffix),
+                 lambda tmppath: shutil.copy(base+suffix,tmppath))
+
+
+def load_info(key):
+    """
+    Returns the object cached under key, None if there isn't one
+    """
+    if CACHEDIR is None:
+        return None
+    try:
+        with open(entrypath(key,INFONAME),'rb') as f:
+            return cPickle.load(f)
+    except (IOError,OSError,EOFError,cPickle.UnpicklingError,
+            AttributeError,ImportError):
+        # missing, half written, or pickled by an incompatible version
+        return None
+
+
+def save_info(key,info):
+    """
+    Caches the (picklable) object info under key
+    """
+    if CACHEDIR is None:
+        return
+    _makedirs(entrypath(key))
+    def write(tmppath):
+        with open(tmppath,'wb') as f:
+            cPickle.dump(info,f,cPickle.HIGHEST_PROTOCOL)
+    _put(entrypath(key,INFONAME),write)
@@ -18,14 +18,18 @@ import logging
 import datetime
 from glob import glob
 
-import subpipe
-import photpipe
 import pipemodules.functs as functs
+import pipemodules.service as service
+import pipemodules.resultstore as resultstore
 
 LCFILENAME = 'lightcurve.txt'
 REPORTNAME = 'photpipe_report.txt'
 LOGNAME = 'photpipe_log.txt'
-SHELVENAME = 'pipe.shelve' 
+SHELVENAME = 'pipe.shelve' # results of workdirs from before resultstore
+
+# the file and directory path to this script: in case you call it from 
+# another directory, the relative paths to the script are still intact
+FILEPATH = os.path.realpath(__file__)
 
 class MyParser(argparse.ArgumentParser):
     """
@@ -65,7 +69,7 @@ class CallPhotometryPipeline(object):
     def __init__(self,args):
 
         self.workdir = os.path.abspath(args.workdir)
-        self.shelvefilepath = os.path.join(self.workdir,SHELVENAME)
+        self.storepath = os.path.join(self.workdir,resultstore.STORENAME)
         self.smallap = args.smallap
         self.largeap = args.largeap
         self.objcoords = args.objcoords
@@ -111,10 +115,15 @@ class CallPhotometryPipeline(object):
 
 
     def get_next_instance(self):
-        # grab all the subpipe instances found in the workdir shelve
-        logger.debug('opening shelve file')
-        self.shv = shelve.open(self.shelvefilepath)
-        self.numinst = len(self.shv)
+        # grab all the subpipe results found in the workdir result store
+        if not os.path.isfile(self.storepath):
+            logger.info('converting %s to a result store' % SHELVENAME)
+            convert_shelve(self.workdir)
+        logger.debug('opening result store')
+        store = resultstore.ResultStore(self.workdir,readonly=True)
+        instances = store.records()
+        store.close()
+        self.numinst = len(instances)
         logger.info('%i subpipe instances to process' % self.numinst)
         if self.clobber:
             logger.debug('removing previous template photometry files')
@@ -127,18 +136,11 @@ class CallPhotometryPipeline(object):
                         logger.warning('removing of %s failed' % f)
             
         # if the instance didn't fail in subtraction, yield it
-        i = 0
-        for image in sorted(self.shv):
-            i += 1
-            instance = self.shv[image]
-            if not isinstance(instance,subpipe.SubtractionPipeline):
-                logger.error('\n'+'-'*79+'\ninstance found (%s) not of '
-                             'subpipe.SubtractionPipeline, skipping' 
-                             % (instance)+'-'*79)
-                continue     
+        for i,instance in enumerate(instances,1):
             if instance.fail: #FIXME is not None
                 logger.warning('\n'+'-'*79+'\n%s failed (code %i) in subpipe,'
-                               ' skipping\n' % (image,instance.fail)+'-'*79)
+                               ' skipping\n' % (instance.name,instance.fail)+
+                               '-'*79)
                 continue
             yield instance,i
 
@@ -205,8 +207,46 @@ class CallPhotometryPipeline(object):
                           'details'.format(r[0],r[1]))
 
 
+def convert_shelve(workdir):
+    """
+    writes the SubtractionPipeline instances pickled in the pipe.shelve of a
+    workdir from before resultstore to its result store
+    """
+    # needed to unpickle them. only old workdirs need it, so it (with its
+    # numpy, scipy and pyfits) isn't imported otherwise
+    import subpipe
+    shv = shelve.open(os.path.join(workdir,SHELVENAME),'r')
+    store = resultstore.ResultStore(workdir)
+    try:
+        for image in sorted(shv):
+            instance = shv[image]
+            if not isinstance(instance,subpipe.SubtractionPipeline):
+                logger.error('instance found (%s) not of '
+                             'subpipe.SubtractionPipeline, skipping'
+                             % instance)
+                continue
+            store.put(instance)
+    except:
+        # so that it is converted again next time
+        store.close()
+        os.remove(store.path)
+        raise
+    store.close()
+    shv.close()
+
+
 if __name__ == '__main__':
 
+    # hand the job to the pipeline service if it's running (see
+    # run-pipeservice.py), saving the pyraf start up
+    if service.available():
+        sys.exit(service.relay(FILEPATH,sys.argv[1:]))
+
+    # only imported once we know the job isn't being relayed to the
+    # service, which has it (and numpy) loaded already. pyraf itself is
+    # only loaded when photpipe first uses IRAF, see lazyiraf
+    import photpipe
+
     parser = MyParser(description='Photometry pipeline for'
                                   ' transient observations.')
     parser.add_argument('workdir', type=str, help='path to the working'
@@ -214,6 +254,11 @@ if __name__ == '__main__':
     parser.add_argument('-c',dest='clobber',action='store_true',
                         help='Clobber over existing photometry work in \
                               `workdir`')
+    parser.add_argument('-l',dest='relight',action='store_true',
+                        help='overwrite the lightcurve and report files in '
+                        '`workdir`, but keep the template photometry (star '
+                        'list and aperture correction) for consistent '
+                        'magnitudes')
     parser.add_argument('-sa',dest='smallap',type=int,default=3,
                         help='radius (in pixels) of small object aperture'
                               ' (default: 3)')
@@ -241,18 +286,17 @@ if __name__ == '__main__':
     if not os.path.isdir(workdir):
         print 'ERROR\tworkdir does not exist! (%s)' % os.path.abspath(workdir)
         sys.exit(2)
-    # check that workdir has a 'template' directory
-    try:
-        open(os.path.join(workdir,SHELVENAME))
-    except:
-        print 'ERROR\tsubpipe shelve (%s) cannot be opened! check it exists.'\
-              % os.path.join(workdir,SHELVENAME)
+    # check that workdir has subpipe results (or an old shelve of them)
+    if not os.path.isfile(os.path.join(workdir,resultstore.STORENAME)) and \
+       not os.path.isfile(os.path.join(workdir,SHELVENAME)):
+        print 'ERROR\tsubpipe result store (%s) not found! check it exists.'\
+              % os.path.join(workdir,resultstore.STORENAME)
         sys.exit(2)
     # check if there is an existing lightcurve file if we don't have 
     # permission to overwrite it.
     clobber = args.clobber
     lcfile = glob(os.path.join(workdir,LCFILENAME))
-    if len(lcfile) != 0 and not clobber:
+    if len(lcfile) != 0 and not clobber and not args.relight:
         print 'ERROR\tlightcurve file (%s) exists and clobber is False.'\
                % os.path.join(workdir,LCFILENAME)
         sys.exit(2)
@@ -0,0 +1,210 @@
+#! /usr/bin/env python2.7
+
+"""
+resident pipeline service
+
+imports pyraf and loads the IRAF packages used by subpipe and photpipe once,
+then runs run-subpipe.py/run-photpipe.py jobs handed to it over a local UNIX
+socket (see pipemodules/service.py), each in a forked child that starts with
+everything already loaded. while it is running, run-subpipe.py,
+run-photpipe.py and the GUI send their jobs here automatically.
+"""
+
+import sys
+import os
+import json
+import signal
+import socket
+import fcntl
+import logging
+import argparse
+import threading
+import traceback
+import runpy
+
+import pipemodules.service as service
+
+# the file and directory path to this script: in case you call it from
+# another directory, the relative paths to the script are still intact
+FILEPATH = os.path.realpath(__file__)
+FILEDIR = os.path.dirname(FILEPATH)
+
+# the only scripts the service will run
+SCRIPTS = ['run-subpipe.py','run-photpipe.py']
+
+class MyParser(argparse.ArgumentParser):
+    """
+    wrapper for argparse.ArgumentParser
+
+    custom error behaviour - will automatically show usage help on argument
+    error
+    """
+    def error(self, message):
+        sys.stderr.write('ERROR\t%s\n' % message)
+        self.print_usage()
+        sys.stderr.write('type -h or --help to display full help\n')
+        sys.exit(2)
+
+
+def read_request(conn):
+    """
+    reads the JSON request line from conn a byte at a time, so that
+    anything after it is left on the socket for the job's stdin
+    """
+    line = ''
+    while not line.endswith('\n'):
+        c = conn.recv(1)
+        if not c:
+            return None
+        line += c
+    request = json.loads(line)
+    # back to the byte strings the scripts expect
+    request['script'] = request['script'].encode('utf-8')
+    request['cwd'] = request['cwd'].encode('utf-8')
+    request['args'] = [a.encode('utf-8') for a in request['args']]
+    return request
+
+
+def run_job(conn,request):
+    """
+    runs the requested script in this (forked) process with conn as stdin,
+    stdout and stderr. never returns
+    """
+    code = 1
+    try:
+        # lead a process group of our own, so the client can signal the job
+        # and any workers it starts all at once
+        os.setpgid(0,0)
+        for sig in (signal.SIGPIPE,signal.SIGTERM,signal.SIGINT,
+                    signal.SIGCHLD):
+            signal.signal(sig,signal.SIG_DFL)
+        conn.sendall('%s%i\n' % (service.PIDMARKER,os.getpid()))
+        for fd in (0,1,2):
+            os.dup2(conn.fileno(),fd)
+        conn.close()
+        sys.stdin = os.fdopen(0,'r')
+        sys.stdout = os.fdopen(1,'w')
+        sys.stderr = os.fdopen(2,'w',0)
+        os.environ[service.JOBENV] = '1'
+        os.chdir(request['cwd'])
+        script = request['script']
+        sys.argv = [script]+request['args']
+        try:
+            runpy.run_path(script,run_name='__main__')
+            code = 0
+        except SystemExit,e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code,int):
+                code = e.code
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except:
+            traceback.print_exc()
+        sys.stdout.flush()
+    finally:
+        os._exit(code)
+
+
+def handle(conn):
+    """
+    forks a job for the request on conn, then reports its exit code back
+    """
+    try:
+        request = read_request(conn)
+        if request is None:
+            # just checking we're here, see service.available
+            return
+        script = request['script']
+        if os.path.dirname(script) != FILEDIR or \
+                os.path.basename(script) not in SCRIPTS:
+            logger.warning('refused request: %r' % request)
+            conn.sendall('%s%i\n' % (service.PIDMARKER,-1))
+            conn.sendall('%s%i\n' % (service.EXITMARKER,2))
+            return
+        pid = os.fork()
+        if pid == 0:
+            run_job(conn,request)
+        logger.info('job %i: %s %s (in %s)'
+                    % (pid,os.path.basename(script),' '.join(request['args']),
+                       request['cwd']))
+        pid,status = os.waitpid(pid,0)
+        if os.WIFEXITED(status):
+            code = os.WEXITSTATUS(status)
+        else:
+            code = -os.WTERMSIG(status)
+        logger.info('job %i finished (code %i)' % (pid,code))
+        conn.sendall('%s%i\n' % (service.EXITMARKER,code))
+    except (socket.error,ValueError,KeyError):
+        logger.exception('lost job connection')
+    finally:
+        conn.close()
+
+
+def serve(socketpath):
+    # a socket left behind by a service that died is removed, a live one
+    # is left alone
+    if os.path.exists(socketpath):
+        if service.connect(socketpath):
+            logger.error('pipeline service already running on %s'
+                         % socketpath)
+            sys.exit(1)
+        os.remove(socketpath)
+
+    # loading IRAF is what we're here to save the jobs from, so rather than
+    # waiting for first use (see lazyiraf) everything is loaded up front
+    logger.info('loading pyraf and IRAF packages')
+    import subpipe
+    import photpipe
+    from pipemodules.lazyiraf import iraf
+    iraf.preload()
+    # the service runs no IRAF tasks itself, so that no job shares the IRAF
+    # subprocesses of another. clear any started while loading
+    from pyraf import irafexecute
+    irafexecute.processCache.flush()
+
+    listener = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    fcntl.fcntl(listener.fileno(),fcntl.F_SETFD,fcntl.FD_CLOEXEC)
+    listener.bind(socketpath)
+    os.chmod(socketpath,0600)
+    listener.listen(5)
+    # stop cleanly when killed, as with ctrl-c
+    signal.signal(signal.SIGTERM,lambda sig,frame: sys.exit(0))
+    logger.info('pipeline service listening on %s' % socketpath)
+    try:
+        while True:
+            conn,addr = listener.accept()
+            t = threading.Thread(target=handle,args=(conn,))
+            t.daemon = True
+            t.start()
+    except (KeyboardInterrupt,SystemExit):
+        logger.info('pipeline service stopped')
+    finally:
+        listener.close()
+        os.remove(socketpath)
+
+
+if __name__ == '__main__':
+
+    parser = MyParser(description='Resident service running the subtraction '
+                                  'and photometry pipelines with IRAF loaded')
+    parser.add_argument('-socket',dest='socketpath', type=str,
+                        default=service.get_socketpath(),
+                        help='path of the UNIX socket to listen on (default:'
+                        ' %s, or $%s)' % (service.SOCKETPATH,
+                                          service.SOCKETENV))
+    parser.add_argument('-d',dest='debug', action='store_true',
+                        help='output all debug messages (i.e. run verbose)')
+
+    args = parser.parse_args()
+
+    # set up logger
+    logger = logging.getLogger('run-pipeservice')
+    logger.setLevel(logging.DEBUG)
+    f = logging.Formatter('%(levelname)s\t%(module)s - %(message)s')
+    h = logging.StreamHandler(sys.stdout)
+    h.setLevel(logging.DEBUG) if args.debug else h.setLevel(logging.INFO)
+    h.setFormatter(f)
+    logger.addHandler(h)
+
+    serve(os.path.abspath(args.socketpath))
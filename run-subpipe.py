@@ -5,8 +5,6 @@
 #     use more fits headers (i.e. GAIN)
 #TODO add as a sub function to align_images the xyfail and `retval =
 #     None if wfail else outimage` and logger error to keep it DRY
-#TODO remove instance in pipe.shelve before doing anything with updating
-#     to prevent half over-written instances
 #TODO make numobj an attribute of subtraction instance but need to still
 #     define it for all even when not making tempcoo
 #TODO ensure SExtracting using a good threshold, and how to pass tempthresh
@@ -25,21 +23,33 @@
 
 import sys
 import os
+import time
+import socket
 import shutil
 import argparse
-import shelve
 import logging
 import subprocess
+import shlex
 import filecmp
+import itertools
+import multiprocessing
 from glob import glob
 
 import pipemodules.functs as functs
+import pipemodules.scratch as scratch
+import pipemodules.jobqueue as jobqueue
+import pipemodules.service as service
+import pipemodules.sexcache as sexcache
+import pipemodules.resultstore as resultstore
 
 ISISCONFIG = 'ISIScfg.py'
 PIPECONFIG = 'PIPEcfg.py'
 REPORTNAME = 'subpipe_report.txt'
 LOGNAME = 'subpipe_log.txt'
-SHELVENAME = 'pipe.shelve'
+CACHENAME = 'sexcache' # SExtractor catalog cache, see pipemodules/sexcache
+QUEUENAME = 'queue'
+QUEUEPOLL = 30 # seconds to wait for images leased by other processes
+WATCHPOLL = 10 # default seconds between looks for new images in watch mode
 
 # the file and directory path to this script: in case you call it from 
 # another directory, the relative paths to the script are still intact
@@ -76,6 +86,106 @@ class FlushFile(object):
 # Assign stdout to our custom class
 sys.stdout = FlushFile(sys.stdout)
 
+class WorkerExit(Exception):
+    """
+    raised by a worker process in place of SystemExit
+
+    a worker calling sys.exit would die without returning its result and
+    leave the pool waiting forever, so the exit code is passed back to the
+    parent instead, which shuts the pool down and exits with it
+    """
+
+
+def use_scratchdir(scratchdir):
+    """
+    makes `scratchdir` the private scratch directory of this process
+
+    SExtractor, ISIS and IRAF temporary files are written there, it becomes
+    the current directory (for anything still written to the current
+    directory) and it holds our own IRAF uparm directory.
+    """
+    import subpipe
+    scratch.set_scratchdir(scratchdir)
+    uparm = os.path.join(scratchdir,'uparm')
+    if not os.path.isdir(uparm):
+        os.makedirs(uparm)
+    os.chdir(scratchdir)
+    subpipe.iraf.set(uparm=uparm+'/')
+
+
+def init_worker(scratchdir):
+    """
+    worker pool initialiser, gives each worker process its own state
+
+    each worker gets a private sub directory of the run's scratch tree (see
+    use_scratchdir). PIPEcfg is executed into the worker's own copy of the
+    subpipe module for every image, so the config globals are per worker.
+    """
+    use_scratchdir(os.path.join(scratchdir,'worker%i' % os.getpid()))
+
+
+def jobname(image,inputhash):
+    """
+    name of the queue job for an image, which changes with its inputs
+    """
+    return '%s.%s' % (os.path.basename(image),inputhash[:16])
+
+
+def process_image(job):
+    """
+    copies a raw image to the workdir and runs it through
+    subpipe.SubtractionPipeline
+
+    `job` is a tuple of (rawimage,num,numimages,workdir,PIPEcfg,pipeargs,
+    jobs,inputhash), where pipeargs are the remaining positional arguments
+    of SubtractionPipeline, jobs is the JobQueue shared with other processes
+    (None if not sharing) and inputhash identifies the image's inputs (see
+    CallSubtractionPipeline.hash_inputs). a module level function so it can
+    be sent to the worker pool, returns the finished SubtractionPipeline
+    instance or None if the image is done or claimed by another process.
+    """
+    import subpipe
+    rawimage,num,numimages,workdir,pipecfg,pipeargs,jobs,inputhash = job
+    lease = None
+    if jobs:
+        # the image must be ours before we copy over the top of it
+        lease = jobs.claim(jobname(rawimage,inputhash))
+        if not lease:
+            logger.debug('(%i/%i) %s is done or claimed by another process'
+                         % (num,numimages,os.path.basename(rawimage)))
+            return None
+    try:
+        logger.debug('copying image %i to workdir' % num)
+        shutil.copy(rawimage,workdir)
+        image = os.path.join(workdir,os.path.basename(rawimage))
+        logger.info('\n'+'-'*79+'\n(%i/%i) processsing image: %s\n'
+                    % (num,numimages,image)+'-'*79)
+        logger.debug('executing %s' % pipecfg)
+        subpipe.execpipecfg("",pipecfg)
+        logger.debug('calling subpipe.SubtractionPipeline')
+        try:
+            s = subpipe.SubtractionPipeline(image,*pipeargs)
+        except SystemExit,e:
+            if multiprocessing.current_process().name == 'MainProcess':
+                raise
+            raise WorkerExit(e.code)
+        logger.debug('subpipe.SubtractionPipeline finished')
+        logger.info('SExtractor catalog cache: %i hit(s), %i miss(es) so '
+                    'far' % (sexcache.hits,sexcache.misses))
+        s.make_pngs()
+        # kept with the results, so an update can tell if it needs rerunning
+        s.inputhash = inputhash
+    except:
+        # give the image back so it can be retried
+        if lease:
+            lease.release()
+        raise
+    if lease:
+        # the lease is left in place until the results are written (see
+        # write_results), which run_images does as soon as they arrive
+        lease.stop()
+    return s
+
 
 class CallSubtractionPipeline(object):
     """
@@ -92,12 +202,15 @@ class CallSubtractionPipeline(object):
 
         # assign command line arguments as class attributes
         self.imagedir = os.path.abspath(args.imagedir)
-        self.imagelist = imagelist
+        self.imagelist = [os.path.abspath(i) for i in imagelist]
+        self.seen = set(self.imagelist)
         self.template = os.path.abspath(args.template)
         self.workdir = os.path.abspath(args.workdir)
         self.selection = args.selection
-        self.fringeframe = args.fringeframe
-        self.bpm = args.badpixelmask
+        # absolute paths, as worker processes don't share our current dir
+        self.fringeframe = args.fringeframe and \
+                           os.path.abspath(args.fringeframe)
+        self.bpm = args.badpixelmask and os.path.abspath(args.badpixelmask)
         self.trim = args.trim
         self.reverseflag = args.reverseflag
         self.update = args.update
@@ -106,11 +219,60 @@ class CallSubtractionPipeline(object):
         self.image_iter = args.image_iter
         self.ISIScfg = args.ISIScfg
         self.PIPEcfg = args.PIPEcfg
+        self.nproc = args.nproc
+        self.watch = args.watch
+        self.photargs = args.photargs
+        self.jobs = None
+        if args.queue:
+            # share out the images with any other processes using workdir
+            self.jobs = jobqueue.JobQueue(os.path.join(self.workdir,
+                                                       QUEUENAME))
         if args.stamps != '':
             self.stamps = os.path.abspath(args.stamps)
         else:
             self.stamps = args.stamps
 
+        # everything other than the image itself that goes into its results,
+        # hashed before any of it is copied to (and altered in) workdir
+        logger.debug('hashing template, configs and options')
+        self.basehash = functs.get_hash([self.template,self.fringeframe,
+                                         self.bpm,self.stamps or None,
+                                         self.ISIScfg,self.PIPEcfg],
+                                        [self.cleantemplate,self.temp_iter,
+                                         self.image_iter,self.trim,
+                                         self.reverseflag])
+        # and everything that goes into the cleaned template and its
+        # products, which are shared across runs and workdirs when
+        # TEMPLATECACHE is set
+        self.templatekey = functs.get_hash([self.template,self.fringeframe,
+                                            self.bpm,self.PIPEcfg],
+                                           [self.cleantemplate,
+                                            self.temp_iter,self.trim])
+        self.hashes = {}
+        self.store = None
+
+        # when sharing a queue, the first process to arrive sets up the
+        # workdir. everyone after finds it done and joins in as if updating
+        if self.jobs:
+            setupname = 'setup.%s' % self.basehash[:16]
+            setuplock = self.jobs.lock('setup')
+            setuplock.acquire()
+            if self.jobs.done(setupname):
+                logger.info('joining processes sharing %s' % self.workdir)
+                self.update = True
+            elif not self.update and (
+                    glob(self.jobs.path('setup.*','.done')) or
+                    os.path.isfile(os.path.join(self.workdir,'template',
+                                   os.path.basename(self.template)))):
+                # set up with other inputs (or by a run not sharing a
+                # queue), so its template has been cleaned already and
+                # would be cleaned again over the top
+                setuplock.release()
+                logger.error('%s was set up with a different template, '
+                             'config or options. use a new workdir, or -u '
+                             'to update it' % self.workdir)
+                sys.exit(2)
+
         if self.update:
             logger.info('LOG FILE UPDATED - %s' % functs.get_datetime())
         else:
@@ -118,6 +280,17 @@ class CallSubtractionPipeline(object):
 
         self.create_report()
 
+        # every invocation gets its own scratch tree, so that any number of
+        # runs can share a host. it is removed again when we exit
+        self.scratchdir = scratch.make_scratchdir(args.scratch or
+                                                  self.workdir)
+        logger.debug('using scratch directory %s' % self.scratchdir)
+        use_scratchdir(self.scratchdir)
+
+        # SExtractor catalogs are kept in the workdir, so unchanged frames
+        # aren't SExtracted again by later stages or update runs
+        sexcache.set_cachedir(os.path.join(self.workdir,CACHENAME))
+
         # define the template variable to the new path of the template in
         # the `template` sub directory of workdir
         newtemplatepath = os.path.join(self.workdir,'template/')+\
@@ -184,7 +357,12 @@ class CallSubtractionPipeline(object):
         logger.debug('ISIS config file: %s' % self.ISIScfg)
 
         # copy stamps file to work directory if required
-        if self.stamps:
+        newstamps = os.path.join(self.workdir,os.path.basename(self.stamps))
+        if self.stamps and os.path.isfile(newstamps) and \
+                filecmp.cmp(self.stamps,newstamps):
+            logger.debug('stamps file already in workdir')
+            self.stamps = newstamps
+        elif self.stamps:
             logger.debug('copying stamps file to workdir')
             try:
                 shutil.copy(self.stamps,self.workdir)
@@ -203,46 +381,257 @@ class CallSubtractionPipeline(object):
             self.cleantemplate = False
             self.temp_iter = 0
 
+        self.pipeargs = (self.template,self.fringeframe,self.bpm,self.trim,
+                         self.image_iter,self.reverseflag,self.ISIScfg,
+                         self.PIPEcfg,self.stamps,self.cleantemplate,
+                         self.temp_iter,self.templatekey)
+
+        # when updating, leave out any image whose inputs haven't changed
+        # since it was last run
+        if self.update:
+            if self.jobs:
+                with self.jobs.lock('results'):
+                    previous = self.get_previous_hashes()
+            else:
+                previous = self.get_previous_hashes()
+            todo = [i for i in self.imagelist if self.hash_inputs(i) !=
+                    previous.get(os.path.basename(i))]
+            skipped = len(self.imagelist)-len(todo)
+            logger.info('skipping %i of %i image(s), unchanged since last '
+                        'processed' % (skipped,len(self.imagelist)))
+            with open(os.path.join(self.workdir,REPORTNAME),'a') as rpt:
+                rpt.write('\n# skipped %i unchanged image(s)' % skipped)
+            self.imagelist = todo
+        self.numimages = len(self.imagelist)
+
+        pool = None
+        parallel = self.nproc > 1 and (self.numimages > 1 or self.watch)
+        if parallel or self.jobs or self.watch:
+            # the template is shared by all images, so it is prepared up
+            # front rather than by whichever image gets there first. it
+            # then stays in memory for every image that follows
+            self.prepare_template()
+        if self.jobs:
+            self.jobs.complete(setupname)
+            setuplock.release()
+        if parallel:
+            # preparing the template may have started IRAF subprocesses
+            # (e.g. defringing), which forked workers would inherit and
+            # share the pipes of. clear them so each worker starts its own
+            if 'pyraf.irafexecute' in sys.modules:
+                sys.modules['pyraf.irafexecute'].processCache.flush()
+            pool = multiprocessing.Pool(self.nproc,init_worker,
+                                        (self.scratchdir,))
+
         logger.debug('entering main loop')
-        for self.image,num in self.get_next_image():
-            logger.info('\n'+'-'*79+'\n(%i/%i) processsing image: %s\n'
-                        % (num,self.numimages,self.image)+'-'*79)
-            logger.debug('executing %s' % self.PIPEcfg)
-            subpipe.execpipecfg("",self.PIPEcfg)
-            logger.debug('calling subpipe.SubtractionPipeline')
-            self.s = subpipe.SubtractionPipeline(self.image,
-                                                 self.template,
-                                                 self.fringeframe,
-                                                 self.bpm,
-                                                 self.trim,
-                                                 self.image_iter,
-                                                 self.reverseflag,
-                                                 self.ISIScfg,
-                                                 self.PIPEcfg,
-                                                 self.stamps,
-                                                 self.cleantemplate,
-                                                 self.temp_iter)
-            logger.debug('subpipe.SubtractionPipeline finished')
-
-            self.s.make_pngs()
-            self.write_report_line()
-            self.write_to_shelve()
+        try:
+            self.process_images(pool)
+            if self.watch:
+                if self.numimages and self.photargs is not None:
+                    self.run_photpipe()
+                self.watch_imagedir(pool)
+        except WorkerExit,e:
+            logger.error('worker process exited with code %s, stopping'
+                         % e.args[0])
+            pool.terminate()
+            sys.exit(e.args[0])
+        except KeyboardInterrupt:
+            if not self.watch:
+                raise
+            logger.info('stopped watching %s' % self.imagedir)
+            if pool:
+                pool.terminate()
+                pool = None
+        if pool:
+            pool.close()
+            pool.join()
 
         logger.debug('finished main loop')
 
         logger.info('run-subpipe finished!\n')
         
 
+    def prepare_template(self):
+        """
+        cleans the template and finds its objects ahead of the images
+
+        done before any workers are forked, so they inherit the result
+        rather than each cleaning it over the top of one another
+        """
+        import subpipe
+        logger.info('preparing template')
+        subpipe.execpipecfg("",self.PIPEcfg)
+        subpipe.prepare_template(self.template,self.cleantemplate,
+                                 self.temp_iter,self.trim,self.fringeframe,
+                                 self.bpm,self.templatekey)
+        tempcoo = os.path.splitext(self.template)[0]+'.coo'
+        if not os.path.isfile(tempcoo):
+            # the workers see the .coo list in place, so they're handed
+            # the number of objects and threshold to act on instead
+            tempobj,tempthresh = subpipe.find_template_objects(self.template,
+                                                        self.templatekey)
+            self.pipeargs += ((tempobj,tempthresh),)
+
+
+    def hash_inputs(self,rawimage):
+        """
+        returns the hash of everything going into the results of `rawimage`:
+        its contents, the template, the config files and the options
+        """
+        if rawimage not in self.hashes:
+            self.hashes[rawimage] = functs.get_hash([rawimage],
+                                                    [self.basehash])
+        return self.hashes[rawimage]
+
+
+    def get_previous_hashes(self):
+        """
+        returns the input hashes of the images already in the workdir result
+        store, keyed by image name
+        """
+        try:
+            store = resultstore.ResultStore(self.workdir,readonly=True)
+        except IOError:
+            return {}
+        try:
+            return store.get_hashes()
+        except resultstore.sqlite3.Error:
+            logger.warning('couldn\'t read the result store')
+            return {}
+        finally:
+            store.close()
+
+
+    def process_images(self,pool=None):
+        """
+        runs the imagelist through the pipeline, waiting on any images
+        leased to other processes when sharing a queue
+        """
+        self.run_images(pool)
+        # other processes may still be working on (or have died with)
+        # images we couldn't claim, so wait until every image is done
+        while self.jobs:
+            remaining = [i for i in self.imagelist if not self.jobs.done(
+                         jobname(i,self.hash_inputs(i)))]
+            if not remaining:
+                break
+            logger.info('waiting on %i image(s) leased to other '
+                        'processes' % len(remaining))
+            time.sleep(QUEUEPOLL)
+            self.run_images(pool)
+
+
+    def watch_imagedir(self,pool=None):
+        """
+        polls imagedir for new images matching the selection and runs them
+        through the pipeline as they arrive, until interrupted (ctrl-c)
+
+        a new file is only taken once it has a whole number of FITS blocks
+        and its size and modification time are unchanged over a poll, so
+        frames still being written out by the camera/transfer are left alone
+        """
+        pending = {}
+        logger.info('watching %s for new images (%s), ctrl-c to stop'
+                    % (self.imagedir,self.selection))
+        while True:
+            time.sleep(self.watch)
+            ready = []
+            for path in sorted(glob(os.path.join(self.imagedir,
+                                                 self.selection))):
+                if path in self.seen:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state = (st.st_size,st.st_mtime)
+                if pending.get(path) == state and st.st_size and \
+                        not st.st_size % 2880:
+                    ready.append(path)
+                else:
+                    pending[path] = state
+            if not ready:
+                continue
+            for path in ready:
+                self.seen.add(path)
+                del pending[path]
+            logger.info('%i new image(s) in %s' % (len(ready),self.imagedir))
+            self.imagelist = ready
+            self.numimages = len(ready)
+            self.process_images(pool)
+            if self.photargs is not None:
+                self.run_photpipe()
+
+
+    def run_photpipe(self):
+        """
+        runs run-photpipe over workdir, to bring the lightcurve up to date
+
+        only the lightcurve is overwritten (-l): the template's star list
+        and aperture correction are kept from batch to batch, so the points
+        stay consistent and no stars need picking by hand
+        """
+        cmd = [sys.executable,os.path.join(FILEDIR,'run-photpipe.py'),
+               self.workdir,'-l']+shlex.split(self.photargs)
+        logger.info('running run-photpipe: %s' % ' '.join(cmd[2:]))
+        code = subprocess.call(cmd)
+        if code:
+            logger.error('run-photpipe failed (code %i), see %s' 
+                         % (code,os.path.join(self.workdir,
+                                              'photpipe_log.txt')))
+
+
+    def run_images(self,pool=None):
+        """
+        runs every image in the imagelist through the pipeline, using the 
+        worker pool if given, and writes the results as they arrive
+        """
+        jobs = ((rawimage,num,self.numimages,self.workdir,self.PIPEcfg,
+                 self.pipeargs,self.jobs,self.hash_inputs(rawimage))
+                for rawimage,num in self.get_next_image())
+        if pool and self.jobs:
+            # sharing a queue, results are handed back (and written) as soon
+            # as each image finishes, rather than in image order: a finished
+            # image's lease is no longer renewed, so it mustn't wait on
+            # slower images before being marked done, or another process
+            # could take it for dead and run it again
+            results = pool.imap_unordered(process_image,jobs)
+        elif pool:
+            # imap hands back the results in image order as they finish,
+            # so the report and result store are written in the same order
+            # as they would be running one image at a time
+            results = pool.imap(process_image,jobs)
+        else:
+            results = itertools.imap(process_image,jobs)
+        for self.s in results:
+            if self.s is None:
+                # done or being done by another process sharing the queue
+                continue
+            self.image = self.s.image
+            self.write_results()
+
+
     def get_next_image(self):
         # grab all raw image paths
         self.numimages = len(self.imagelist)
         logger.debug('found %s image(s) to process' % self.numimages)     
 
-        # copy raw images to workdir one at a time and yield them
+        # the raw images are copied to the workdir by process_image, once
+        # it knows the image is its to work on
         for i,rawimage in enumerate(self.imagelist,1):
-            logger.debug('copying image %i to workdir' % i)
-            shutil.copy(rawimage,self.workdir)
-            yield os.path.join(self.workdir,os.path.basename(rawimage)),i
+            yield rawimage,i
+
+
+    def write_results(self):
+        if not self.jobs:
+            self.write_report_line()
+            self.write_to_store()
+            return
+        # the report and result store are shared with the other processes
+        with self.jobs.lock('results'):
+            self.write_report_line()
+            self.write_to_store()
+            self.jobs.complete(jobname(self.image,self.s.inputhash))
 
 
     def create_report(self):
@@ -296,12 +685,12 @@ class CallSubtractionPipeline(object):
                       r['subtstddev'],r['sum_kernel'],r['failcode']))
 
 
-    def write_to_shelve(self):
-        logger.debug('writing to shelve')
-        self.shv = shelve.open(os.path.join(self.workdir,SHELVENAME))
-        shelvekey = os.path.basename(self.image)
-        self.shv[shelvekey] = self.s
-        self.shv.close()
+    def write_to_store(self):
+        logger.debug('writing to result store')
+        # opened on the first result, after any workers have been forked
+        if self.store is None:
+            self.store = resultstore.ResultStore(self.workdir)
+        self.store.put(self.s)
 
 
 
@@ -309,6 +698,11 @@ class CallSubtractionPipeline(object):
 
 if __name__ == '__main__':
 
+    # hand the job to the pipeline service if it's running (see
+    # run-pipeservice.py), saving the pyraf start up
+    if service.available():
+        sys.exit(service.relay(FILEPATH,sys.argv[1:]))
+
     parser = MyParser(description='Subtraction pipeline for'
                                   ' transient observations')
     parser.add_argument('imagedir', type=str, help='path to a directory'
@@ -325,7 +719,10 @@ if __name__ == '__main__':
     parser.add_argument('-u',dest='update',action='store_true',
                         help='update `workdir` without destroying previous '
                         'work, use to add new observations/overwrite old '
-                        'pipeline output where output is poor')
+                        'pipeline output where output is poor. images '
+                        'whose contents, template, config files and options '
+                        'are unchanged since they were last processed are '
+                        'skipped')
     parser.add_argument('-f',dest='fringeframe', type=str, help='file path to'
                         ' the fringeframe for observations, if required')
     parser.add_argument('-b',dest='badpixelmask', type=str, help='file path '
@@ -352,6 +749,34 @@ if __name__ == '__main__':
                         'coordinates of the stamps to use by ISIS '
                         'in columns 1 and 2 respectively, ISIS '
                         'will use these instead of finding its own')
+    parser.add_argument('-j',dest='nproc', type=int, default=1,
+                        help='number of images to process at once, each in '
+                        'its own worker process (default: 1)')
+    parser.add_argument('-q',dest='queue', action='store_true',
+                        help='share the images with other run-subpipe '
+                        'processes (on this or other hosts) given the same '
+                        '`imagedir`, `template` and `workdir`. the first to '
+                        'start sets up `workdir`, the rest join in. a '
+                        '`workdir` set up with other inputs is refused '
+                        'unless updating (-u)')
+    parser.add_argument('-w',dest='watch', type=float, nargs='?',
+                        const=WATCHPOLL, default=None,
+                        help='watch mode - after processing the images, keep '
+                        'watching `imagedir` and process new images matching'
+                        ' the selection as they arrive, until ctrl-c. '
+                        'optionally give the seconds between looks '
+                        '(default: %i)' % WATCHPOLL)
+    parser.add_argument('-p',dest='photargs', type=str, default=None,
+                        help='in watch mode, run run-photpipe on `workdir` '
+                        'with these arguments after each batch of new images,'
+                        ' e.g. -p="-o 123,456 -sa 4". must include -o, '
+                        'and -a unless workdir already has a star list. the '
+                        'lightcurve is rewritten each time, the template '
+                        'photometry kept')
+    parser.add_argument('-scratch',dest='scratch', type=str, default='',
+                        help='directory in which to make the private scratch'
+                        ' directory for this run, e.g. a fast local disk '
+                        '(default: `workdir`)')
     parser.add_argument('-d',dest='debug', action='store_true',
                         help='output all debug messages (i.e. run verbose), '
                              'logfile has verbosity `debug`automatically')
@@ -360,6 +785,34 @@ if __name__ == '__main__':
 
     print 'INFO\tchecking argument sanity'
 
+    # check watch mode has a directory to watch and photometry can run
+    # unattended
+    if args.watch is not None:
+        if not os.path.isdir(args.imagedir):
+            print 'ERROR\timagedir (%s) must be a directory in watch mode!'\
+                  % os.path.abspath(args.imagedir)
+            sys.exit(2)
+        if args.watch <= 0:
+            print 'WARNING\tsetting watch poll time to %i' % WATCHPOLL
+            args.watch = WATCHPOLL
+    if args.photargs is not None:
+        if args.watch is None:
+            print 'ERROR\t-p only applies in watch mode (-w)'
+            sys.exit(2)
+        if '-o' not in shlex.split(args.photargs):
+            print 'ERROR\tphotometry arguments must give the object ' \
+                  'coordinates (-o "x,y")'
+            sys.exit(2)
+        # without a star list, one has to be made, by hand unless -a
+        starcoo = os.path.join(args.workdir,'template',os.path.splitext(
+                               os.path.basename(args.template))[0]+'.starcoo')
+        if '-a' not in shlex.split(args.photargs) and \
+           not os.path.isfile(starcoo):
+            print 'ERROR\tphotometry arguments must pick the aperture ' \
+                  'correction stars (-a) when workdir has no star list ' \
+                  '(%s)' % starcoo
+            sys.exit(2)
+
     # check imagedir is a directory or a file and generate list of images
     if os.path.isdir(args.imagedir):
         imagelist = sorted(glob(os.path.join(os.path.abspath(args.imagedir),
@@ -372,7 +825,7 @@ if __name__ == '__main__':
         sys.exit(2)
 
     # check there will be images to process:
-    if len(imagelist) == 0:
+    if len(imagelist) == 0 and args.watch is None:
         print 'ERROR\tno images in imagedir (%s) matching selection, "%s"!'\
               % (args.imagedir,args.selection)
         sys.exit(2)
@@ -401,6 +854,11 @@ if __name__ == '__main__':
         print 'WARNING\tsetting image cleaning iterations to 0'
         args.image_iter = 0
 
+    # check number of worker processes is valid
+    if args.nproc < 1:
+        print 'WARNING\tsetting number of worker processes to 1'
+        args.nproc = 1
+
     # check trim value is valid
     if args.trim < 0:
         print 'WARNING\tsetting trim to 0'
@@ -426,6 +884,13 @@ if __name__ == '__main__':
         print 'ERROR\treverseflag must be 0-3, see -h for options.'
         sys.exit(2)
 
+    # check scratch directory exists
+    if args.scratch and not os.path.isdir(args.scratch):
+        print 'ERROR\tscratch directory (%s) doesn\'t exist!'\
+              % os.path.abspath(args.scratch)
+        sys.exit(2)
+    args.scratch = args.scratch and os.path.abspath(args.scratch)
+
     # check stamps file exists
     if args.stamps and not os.path.isfile(args.stamps):
         print 'ERROR\tstamps file (%s) doesn\'t exist!'\
@@ -433,12 +898,13 @@ if __name__ == '__main__':
         sys.exit(2)
 
     # check that the workdir exists if the user is updating previous work
-    if args.update and not os.path.isdir(args.workdir):
+    if args.update and not args.queue and not os.path.isdir(args.workdir):
         print 'ERROR\tif you\'re updating previous work, workdir must exist!'
         sys.exit(2)
 
-    # if the workdir exists, check with user whether to remove
-    if os.path.isdir(args.workdir) and not args.update:
+    # if the workdir exists, check with user whether to remove (unless
+    # we're sharing it with other processes)
+    if os.path.isdir(args.workdir) and not args.update and not args.queue:
         print 'WARNING\tworkdir (%s) already exists!'\
               % os.path.abspath(args.workdir)
         while True:
@@ -459,9 +925,13 @@ if __name__ == '__main__':
                 print 'EXITING (workdir already in use)'
                 sys.exit(0)
 
-    # make the workdir if needed
-    if not os.path.isdir(args.workdir):
+    # make the workdir if needed. other processes sharing a queue may be
+    # doing the same
+    try:
         os.makedirs(os.path.join(args.workdir,'template'))
+    except OSError:
+        if not os.path.isdir(os.path.join(args.workdir,'template')):
+            raise
 
     # set up loggers
     # global logger
@@ -469,7 +939,12 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     f = logging.Formatter('%(levelname)s\t%(module)s - %(message)s')
     # handler to write log entries to file
-    h1 = logging.FileHandler(os.path.join(args.workdir,LOGNAME))
+    # processes sharing a queue keep their own log files
+    logname = LOGNAME
+    if args.queue:
+        logname = '%s.%s.%i.txt' % (os.path.splitext(LOGNAME)[0],
+                                    socket.gethostname(),os.getpid())
+    h1 = logging.FileHandler(os.path.join(args.workdir,logname))
     h1.setLevel(logging.DEBUG) # logfile will always have debug verbosity
     h1.setFormatter(f)
     logger.addHandler(h1)
@@ -7,12 +7,10 @@
 import os
 import sys
 import logging
-import atexit
 import shutil
 from glob import glob
 from datetime import datetime
 
-from pyraf import iraf
 import numpy as np
 import pyfits
 
@@ -20,16 +18,19 @@ import pipemodules.functs as functs
 import pipemodules.cosmics as cosmics
 import pipemodules.myalardwrap as alardwrap
 import pipemodules.f2n as f2n
+import pipemodules.starmatch as starmatch
+import pipemodules.geotrans as geotrans
+import pipemodules.crossmatch as crossmatch
+import pipemodules.templatecache as templatecache
+from pipemodules.scratch import scratchpath
+from pipemodules.imagecontext import ImageContext
+from pipemodules.lazyiraf import iraf
 
 # stops pyfits throwing out annoying warnings about file size not expected:
 import warnings
 warnings.filterwarnings('ignore')
 
-# load necessary iraf packages
-iraf.nproto(_doprint=0)
-iraf.noao(_doprint=0)
-iraf.digiphot(_doprint=0)
-iraf.apphot(_doprint=0)
+# pyraf is imported and the iraf packages loaded on first use, see lazyiraf
 
 # the file and directory path to this script, in case you call it from 
 # another directory, so relative paths to the script are still intact
@@ -76,11 +77,18 @@ sys.stdout = FlushFile(sys.stdout)
 # set up the logger defined in run-subpipe
 logger = logging.getLogger('run-subpipe.subpipe')
 
+# the lowest threshold (sigma) objectfind runs SExtractor at
+MINTHRESH = 8
+# the threshold objectfind last chose in this process, for each role
+# ('template' or 'image'), see objectfind
+_lastthresh = {}
+
 class SubtractionPipeline(object):
     
     def __init__(self,image,template,fringeframe=None,bpm=None,trim=0,
                  image_iter=2,reverseflag=0,ISIScfg='ISIScfg.py',
-                 PIPEcfg='PIPEcfg.py',stamps='',cleantemplate=1,temp_iter=2):
+                 PIPEcfg='PIPEcfg.py',stamps='',cleantemplate=1,temp_iter=2,
+                 templatekey=None,templateobjects=None):
         self.image = image
         self.template = template
         self.fringeframe = fringeframe
@@ -93,29 +101,23 @@ class SubtractionPipeline(object):
         self.stamps = stamps
         self.cleantemplate = cleantemplate
         self.temp_iter = temp_iter
+        self.templatekey = templatekey
+        # (number of objects,threshold) of the template if found already,
+        # i.e. by run-subpipe ahead of its workers
+        self.templateobjects = templateobjects
 
         self.fail = None
 
         # get some info on the template and clean it as required, due to 
         # `singleton` this will only be done once per call
-        self.t = singleton(GetImageInfo,self.template,
-                           info='getting template information')
-        if self.cleantemplate:
-            # i.e. remove fringing and bpm as well as CR and trim
-            #logger.info('full cleaning of template')
-            singleton(CleanTemplate,self.template,self.temp_iter,self.trim,
-                      self.fringeframe,self.bpm,
-                      info='full cleaning of template')
-        elif self.temp_iter != 0:
-            # i.e. remove only CR and trim
-            #logger.info('removing cosmic rays from template')
-            singleton(CleanTemplate,self.template,self.temp_iter,self.trim,
-                      info='removing cosmic rays from template')
-        else:
-            pass
+        self.t = prepare_template(self.template,self.cleantemplate,
+                                  self.temp_iter,self.trim,self.fringeframe,
+                                  self.bpm,self.templatekey)
 
         logger.info('getting image information')
-        self.i = GetImageInfo(self.image)
+        # the image is kept in memory until cleaned, see main
+        self.ctx = ImageContext(self.image)
+        self.i = GetImageInfo(self.ctx)
 
         self.main()
 
@@ -174,41 +176,45 @@ class SubtractionPipeline(object):
 
         if self.fringeframe:
             logger.info('defringing image using %s' % self.fringeframe)
-            defringe(self.image,self.fringeframe)
+            defringe(self.ctx,self.fringeframe)
         if self.bpm:
             logger.info('removing bad pixel mask')
         if self.image_iter:
             logger.info('removing cosmic rays with %i iteration(s)'
                         % self.image_iter)
         if self.bpm or self.image_iter != 0:
-            remove_cosmetics(image = self.image,
+            remove_cosmetics(image = self.ctx,
                              cositer = self.image_iter,
                              bpm = self.bpm,
                              gain = self.i.gain,
                              readnoise = self.i.readnoise,
                              satlevel = IMAGESATLIMIT,
-                             trim = self.trim)
+                             trim = self.trim,
+                             tilesize = COSMICTILESIZE,
+                             nproc = COSMICNPROC,
+                             lowmem = COSMICLOWMEM,
+                             incremental = COSMICINCREMENTAL,
+                             minnew = COSMICMINNEW)
         
         if self.trim:
             logger.info('trimming %i pixels from image' % self.trim)
-            trim_border(self.image,self.trim)
+            trim_border(self.ctx,self.trim)
+
+        # SExtractor, IRAF and ISIS take it from here
+        self.ctx.flush()
+        self.ctx = None
 
         # We may need to alter this depending on number of objects we find
         global XYXYMATCH
 
         # find objects in template if we haven't already
         tempcoo = os.path.splitext(self.template)[0]+'.coo'
-        try:
-            open(tempcoo)
-        except IOError:
-            logger.info('running SExtractor on template')
-            tempcoo = os.path.splitext(self.template)[0]+'.coo'
-            tempobj,tempthresh = objectfind(self.template,
-                                  imagesat=TEMPSATLIMIT,
-                                  thresh=TEMPTHRESH,
-                                  minobj=TEMPMINOBJ,maxobj=TEMPMAXOBJ)
-            logger.info('found %i objects in template at threshold %i'\
-                    % (tempobj,tempthresh))
+        if self.templateobjects or not os.path.isfile(tempcoo):
+            if self.templateobjects:
+                tempobj,tempthresh = self.templateobjects
+            else:
+                tempobj,tempthresh = find_template_objects(self.template,
+                                                           self.templatekey)
             if tempobj < XYMIN and XYXYMATCH:
                 logger.warning('num objects found in template < XYMIN.')
                 logger.warning('switching off XYXYMATCH aligning!')
@@ -231,8 +237,9 @@ class SubtractionPipeline(object):
         imagecoo = os.path.splitext(self.image)[0]+'.coo'
         imageobj,imagethresh = objectfind(self.image,imagesat=IMAGESATLIMIT,
                                thresh=IMAGETHRESH,
-                               minobj=IMAGEMINOBJ,maxobj=IMAGEMAXOBJ)
-        logger.info('found %i objects in image at threshold %i'\
+                               minobj=IMAGEMINOBJ,maxobj=IMAGEMAXOBJ,
+                               role='image')
+        logger.info('found %i objects in image at threshold %.1f'\
                     % (imageobj,imagethresh))
         if imageobj < XYMIN and XYXYMATCH:
                 logger.warning('num objects found in image < XYMIN.')
@@ -307,7 +314,7 @@ class GetImageInfo(object):
 
     INPUT
         image:
-                the filepath of image to be examined
+                the filepath of image to be examined, or its ImageContext
         subimage [False]:
                 set to true if a subtracted image
         rmzeros [False]:
@@ -318,7 +325,12 @@ class GetImageInfo(object):
 
     def __init__(self,image,subimage=False,rmzeros=False,getfwhm=True):
         
-        self.data,self.header = pyfits.getdata(image,header=True)
+        if isinstance(image,ImageContext):
+            self.data,self.header = image.data,image.header
+            image = image.path
+        else:
+            # memory mapped unless scaled, only read as needed
+            self.data,self.header = functs.getdata(image,header=True)
         self.stats = functs.get_stats(self.data,rmzeros=rmzeros)
         self.filter = functs.get_filt(self.header,FILTERKEYS)
         if not self.filter:
@@ -334,7 +346,8 @@ class GetImageInfo(object):
                 logger.warning('couldn\'t find `%s` header' % EXPHDR)
 
             logger.debug('running SExtractor to estimate FWHM')
-            starlist = alardwrap.runsex(image,thresh=10,sat=55000)
+            starlist = alardwrap.runsex(image,thresh=10,sat=55000,
+                                        method=SEXMETHOD,data=self.data)
             if starlist == None: # i.e. Sextractor failed
                 self.fwhm = np.nan
             else:
@@ -354,17 +367,7 @@ class GetImageInfo(object):
             else:
                 logger.debug('found date as `%s`' % self.date)
 
-            global WREGISTER
-            try:
-                wcs_err = self.header["WCS_ERR"]
-                logger.debug('WCS_ERR header value = %s' % wcs_err)
-            except KeyError:
-                logger.debug('WCS_ERR key not found in header')
-                wcs_err = 0
-            if wcs_err != 0 and WREGISTER:
-                logger.warning('switching off WREGISTER - WCS_ERR header value'
-                               ' != 0.')
-                WREGISTER = False
+            self.wcs_err = check_wcs(self.header)
 
             self.object = self.header.get(OBJECTHDR,OBJECTNAME)
             self.gain = float(self.header.get(GAINHDR,GAIN))
@@ -378,42 +381,189 @@ class GetImageInfo(object):
 class CleanTemplate(object):
     _instance = None
     def __init__(self,template,temp_iter,trim=0,fringeframe=None,bpm=None):
+        # read once and written once cleaned
+        ctx = ImageContext(template)
         if fringeframe:
             logger.info('defringing template using %s' % fringeframe)
-            defringe(template,fringeframe)
+            defringe(ctx,fringeframe)
         if bpm:
             logger.info('removing bad pixel mask from template')
         if temp_iter !=0:
             logger.info('removing template cosmic rays with %i iteration(s)'
                         % temp_iter)
         if trim:
-            trim_border(template,trim)
-        header = pyfits.getheader(template)
-        gain = float(header.get(GAINHDR,GAIN))
-        readnoise = float(header.get(RDNOISEHDR,RDNOISE))
-        remove_cosmetics(image = template,
+            trim_border(ctx,trim)
+        gain = float(ctx.header.get(GAINHDR,GAIN))
+        readnoise = float(ctx.header.get(RDNOISEHDR,RDNOISE))
+        remove_cosmetics(image = ctx,
                          cositer = temp_iter,
                          bpm = bpm,
                          gain = gain,
                          readnoise = readnoise,
                          satlevel = TEMPSATLIMIT,
-                         trim = trim)
+                         trim = trim,
+                         tilesize = COSMICTILESIZE,
+                         nproc = COSMICNPROC,
+                         lowmem = COSMICLOWMEM,
+                         incremental = COSMICINCREMENTAL,
+                         minnew = COSMICMINNEW)
+        ctx.flush()
 
 ############################## FUNCTIONS #####################################
-def defringe(image,fringeframe,mask='CLASPobjmask.fits'):
+def prepare_template(template,cleantemplate=1,temp_iter=2,trim=0,
+                     fringeframe=None,bpm=None,cachekey=None):
+    """
+    Gets the template information and cleans the template as required.
+
+    INPUT
+        template:
+                filepath of the template
+        cleantemplate [1]:
+                remove fringing and the bpm as well as cosmic rays
+        temp_iter [2]:
+                number of CR detection iterations to perform
+        trim [0]:
+                border in pixels to fix to zero
+        fringeframe [None]:
+                the fringeframe pattern filepath
+        bpm [None]:
+                bad pixel mask relevant to `template`
+        cachekey [None]:
+                key of the template's products in the template cache (see
+                run-subpipe), None to not use the cache
+    OUTPUT
+        the GetImageInfo instance of the template
+
+    Due to `singleton` this is only done once per process, so calling it
+    before forking worker processes means they all share the result.
+    With TEMPLATECACHE set, the cleaned template, its information and its
+    object lists are restored from the cache if another run has made them,
+    and cached otherwise.
+    """
+    templatecache.set_cachedir(TEMPLATECACHE)
+    if not cachekey or GetImageInfo._instance:
+        cachekey = None
+    else:
+        t = restore_template(template,cachekey)
+        if t is not None:
+            return t
+
+    t = singleton(GetImageInfo,template,info='getting template information')
+    if cleantemplate:
+        # i.e. remove fringing and bpm as well as CR and trim
+        singleton(CleanTemplate,template,temp_iter,trim,fringeframe,bpm,
+                  info='full cleaning of template')
+    elif temp_iter != 0:
+        # i.e. remove only CR and trim
+        singleton(CleanTemplate,template,temp_iter,trim,
+                  info='removing cosmic rays from template')
+    if cachekey:
+        base,ext = os.path.splitext(template)
+        templatecache.save(cachekey,base,[ext])
+        templatecache.save_info(cachekey,t)
+    return t
+
+
+def restore_template(template,cachekey):
+    """
+    Restores the cleaned template, its information and object lists from
+    the template cache.
+
+    INPUT
+        template:
+                filepath of the template
+        cachekey:
+                key of the template's products in the template cache
+    OUTPUT
+        the GetImageInfo instance of the template, None if not cached
+    """
+    t = templatecache.load_info(cachekey)
+    if t is None:
+        return None
+    base,ext = os.path.splitext(template)
+    if not templatecache.fetch(cachekey,base,[ext]):
+        return None
+    logger.info('restored cleaned template from the template cache')
+    # as if prepared in this process, so it isn't cleaned again
+    GetImageInfo._instance = t
+    CleanTemplate._instance = t
+    check_wcs(pyfits.getheader(template))
+    # the object lists are only there if a run has got as far as them,
+    # otherwise they are found as usual
+    templatecache.fetch(cachekey,base,['.coo','.stars'])
+    return t
+
+
+def check_wcs(header):
+    """
+    Switches off WREGISTER if header's WCS_ERR says the WCS is bad.
+
+    INPUT
+        header:
+                the image header
+    OUTPUT
+        the WCS_ERR value (0 if absent)
+    """
+    global WREGISTER
+    try:
+        wcs_err = header["WCS_ERR"]
+        logger.debug('WCS_ERR header value = %s' % wcs_err)
+    except KeyError:
+        logger.debug('WCS_ERR key not found in header')
+        wcs_err = 0
+    if wcs_err != 0 and WREGISTER:
+        logger.warning('switching off WREGISTER - WCS_ERR header value'
+                       ' != 0.')
+        WREGISTER = False
+    return wcs_err
+
+
+def find_template_objects(template,cachekey=None):
+    """
+    Runs SExtractor on the template to create its `.coo` object list.
+
+    INPUT
+        template:
+                filepath of the template
+        cachekey [None]:
+                key of the template's products in the template cache, to
+                cache the object lists under
+    OUTPUT
+        the number of objects found and the threshold they were found at
+    """
+    logger.info('running SExtractor on template')
+    tempobj,tempthresh = objectfind(template,imagesat=TEMPSATLIMIT,
+                                    thresh=TEMPTHRESH,minobj=TEMPMINOBJ,
+                                    maxobj=TEMPMAXOBJ,role='template')
+    logger.info('found %i objects in template at threshold %.1f'
+                % (tempobj,tempthresh))
+    if cachekey:
+        templatecache.save(cachekey,os.path.splitext(template)[0],
+                           ['.coo','.stars'])
+    return tempobj,tempthresh
+
+
+def defringe(image,fringeframe,mask=None,outimage=None):
     """
     Removes fringing from image.
 
     INPUT
         image: 
-                the filepath of image for defringing
+                the filepath of image for defringing, or its ImageContext
         fringeframe: 
                 the fringeframe pattern filepath
+        mask [None]:
+                filepath for the temporary object mask, defaults to one in
+                the scratch directory
+        outimage [None]:
+                filepath for the defringed frame to be written to
     OUTPUT
         the defringed frame filepath
 
     Image is overwritten with the defringed version. iraf.rmfringe does the
-    actual fringe removal after masking objects using iraf.objmasks
+    actual fringe removal after masking objects using iraf.objmasks, on disk,
+    so an ImageContext is flushed first (and read back after, if
+    overwritten).
     """
     try:
         iraf.mscred(_doprint=0)
@@ -423,8 +573,14 @@ def defringe(image,fringeframe,mask='CLASPobjmask.fits'):
                      'install `mscred`')
         sys.exit(5)
         
+    ctx = None
+    if isinstance(image,ImageContext):
+        ctx = image
+        image = ctx.flush()
     if not outimage:
         outimage = image
+    if not mask:
+        mask = scratchpath('CLASPobjmask.fits')
     
     try:
         os.remove(mask)
@@ -445,18 +601,22 @@ def defringe(image,fringeframe,mask='CLASPobjmask.fits'):
    
     os.remove(mask) 
 
+    if ctx is not None and outimage == image:
+        ctx.read()
     return outimage
       
   
 def remove_cosmetics(image,cositer=1,bpm=None,savesat=False,trim=0,gain=2.0,
-                    readnoise=5.0,satlevel=50000,verbose=False,outimage=None):
+                    readnoise=5.0,satlevel=50000,verbose=False,outimage=None,
+                    tilesize=0,nproc=None,lowmem=False,incremental=False,
+                    minnew=0):
     """
     Cleans both cosmic rays and the bpm (if supplied).
     (Uses Malte Tewes python adaptation of L.A.Cosmic)
 
     INPUT
         image:
-                filepath of image to be cleaned
+                filepath of image to be cleaned, or its ImageContext
         cositer [1]:
                 number of CR detection iterations to perform
         bpm [None]:
@@ -475,24 +635,48 @@ def remove_cosmetics(image,cositer=1,bpm=None,savesat=False,trim=0,gain=2.0,
                 run verbosely
         outimage [None]:
                 filepath for cleaned frame to be written to
+        tilesize [0]:
+                detect CRs in tiles of this size, 0 for the whole frame
+        nproc [None]:
+                processes to detect tiles with, None for the cpu count
+        lowmem [False]:
+                work in float32 and reuse work arrays between iterations
+        incremental [False]:
+                after the first iteration, only detect CRs again around the
+                pixels cleaned
+        minnew [0]:
+                stop iterating once fewer than this many new CR pixels are
+                found
     OUTPUT
         the cleaned image filepath
 
     See cosmics.py for full documentation on the method. Pixels flagged in the
     bad pixel mask will be treated as CR and interpolated over. If outimage is
     None (or otherwise equates to False) then image is overwritten with the 
-    cleaned version.
+    cleaned version. An ImageContext is cleaned in memory instead, unless
+    outimage is given.
     """
+    ctx = None
+    if isinstance(image,ImageContext):
+        ctx = image
+        image = ctx.path
+        # as cosmics.fromfits reads it
+        array,header = ctx.data.transpose(),ctx.header
+    else:
+        array,header = cosmics.fromfits(image)
     if not outimage:
         outimage = image
 
     # Run cosmics.py to clean, and then write the cleaned array to fits
-    array,header = cosmics.fromfits(image)
     c = cosmics.cosmicsimage(array,gain=gain,readnoise=readnoise,
                              satlevel=satlevel,bpm=bpm,trimborder=trim,
-                             verbose=verbose)
-    c.run(maxiter=cositer)
-    cosmics.tofits(outimage,c.cleanarray,header)
+                             verbose=verbose,tilesize=tilesize,nproc=nproc,
+                             lowmem=lowmem,incremental=incremental)
+    c.run(maxiter=cositer,minnew=minnew)
+    if ctx is not None and outimage == image:
+        ctx.update(c.cleanarray.transpose())
+    else:
+        cosmics.tofits(outimage,c.cleanarray,header)
     
     if savesat:
         satmask = os.path.splitext(image)[0]+'.satmask.fits'
@@ -507,7 +691,7 @@ def trim_border(image,trim,replacement_value=0):
 
     INPUT
         image:
-                the image to have its border fixed
+                the image to have its border fixed, or its ImageContext
         trim:
                 size of border to fix in pixels
         replacement_value [0]:
@@ -517,10 +701,22 @@ def trim_border(image,trim,replacement_value=0):
 
     Take a border of width `trim` around the image and sets all pixel values
     in this border to `replacement_value` (physical image size is unaffected!)
-    The image is overwritten with the trimmed version.
+    The image is overwritten with the trimmed version (an ImageContext is
+    trimmed in memory). Unless its data is scaled, the file is memory mapped
+    and only the border is read and written.
     """
 
-    hdu = pyfits.open(image,mode='update')
+    if isinstance(image,ImageContext):
+        data = image.data
+        data[:trim] = replacement_value
+        data[-trim:] = replacement_value
+        data[:,:trim] = replacement_value
+        data[:,-trim:] = replacement_value
+        image.update()
+        return image.path
+
+    memmap = not functs.is_scaled(pyfits.getheader(image))
+    hdu = pyfits.open(image,mode='update',memmap=memmap)
 
     hdu[0].data[:trim] = replacement_value
     hdu[0].data[-trim:] = replacement_value
@@ -553,8 +749,13 @@ def align_images(image,template,imagecoo,tempcoo,
     # a variable to hold info about the alignment to be put in the report
     aligninfo = ''
 
+    # the matched coordinates and transformation database are kept in our
+    # private scratch directory
+    matchcoo = scratchpath('CLASPmatch.coo')
+    geomapdb = scratchpath('CLASPgeomap.db')
+
     # clean up after previous call
-    for junk in ('/tmp/CLASPmatch.coo','/tmp/CLASPgeomap.db'):
+    for junk in (matchcoo,geomapdb):
         try:
             os.remove(junk)
         except OSError:
@@ -580,137 +781,27 @@ def align_images(image,template,imagecoo,tempcoo,
         #        #    retval = None
         #        return None,aligninfo+'BADWCS?'
 
-        # use xyxymatch>geomap>geotran: 
-        logger.info('trying to compute alignment with XYXYMATCH')
-        xyxymatches = 0 # assign now since we conditionally assign later
-                        # in the absence of IrafErrors
-        iraf.unlearn(iraf.xyxymatch)
-        try:
-            xyout = iraf.xyxymatch(input = imagecoo,
-                                   reference = tempcoo,
-                                   output = '/tmp/CLASPmatch.coo',
-                                   tolerance = XYTOL,
-                                   nmatch = XYNMATCH,
-                                   separation = XYSEP,
-                                   verbose="yes",
-                                   Stdout=1)
-        except iraf.IrafError,e:
-            logger.exception('XYXYMATCH failed due to IrafError!')
-            #if not WREGISTER:
-            #    logger.warning('XYXYMATCH failed!')
-            #    return None,'XYERROR'
+        # match objects, then use geomap>geotran:
+        if MATCHMETHOD == 'numpy':
+            xyxymatches = starmatch_coords(imagecoo,tempcoo,matchcoo)
         else:
-            logger.debug('XYXYMATCH output:\n'+'\n'.join(l for l in xyout if l))
-            xyxymatches = int(xyout[-1].split()[0])
-            logger.info('XYXYMATCH matched objects = %i' % xyxymatches)
+            xyxymatches = xyxymatch_iraf(imagecoo,tempcoo,matchcoo)
 
-        if xyxymatches < XYMIN and SEARCHRAD != 0:
-            logger.warning('XYXYMATCH didn\'t find transformation initially')
-            logger.info('attempting XYXYMATCH with objects located within '
-                        'SEARCHRAD')
-            ia = np.genfromtxt(imagecoo)
-            ta = np.genfromtxt(tempcoo)
-            linestoremove = []
-            for x in range(len(np.atleast_2d(ia))):
-                found = 0
-                for y in range(len(np.atleast_2d(ta))):
-                    r = ((ia[x,0] - ta[y,0])**2 + (ia[x,1] - ta[y,1])**2)**0.5
-                    if r <= SEARCHRAD:
-                        found = 1
-                        break
-                if not found:
-                    linestoremove.append(x)
-            linestoremove = list(set(linestoremove)) #remove duplicates
-            linestoremove.sort(reverse=True) # prevent indexing errors      
-            for line in linestoremove:
-                ia = np.delete(ia,line,0)
-            numcoincident = len(np.atleast_2d(ia))
-
-            if numcoincident < XYMIN:
-                logger.warning('objects within %i pixels on image'
-                             ' and template (%i) < XYMIN' % (SEARCHRAD,
-                                                              numcoincident))
-                logger.info('check your XYMIN and SEARCHRAD values')
-                #if not WREGISTER:
-                #    return None,'NOCOIN*'
-            else:
-                for junk in (imagecoo,'/tmp/CLASPmatch.coo'):
-                    try:
-                        os.remove(junk)
-                    except OSError:
-                        pass
-                        #save the reduced image object list
-                        np.savetxt(imagecoo,ia,fmt='%13.3f')
-                        #repeat xyxymatch with the reduced list
-                        logger.info('repeating XYXYMATCH with reduced '
-                                    'coordinate list')
-                        try:
-                            xyout = iraf.xyxymatch(input = imagecoo,
-                                                reference = tempcoo,
-                                                output = '/tmp/CLASPmatch.coo',
-                                                tolerance = XYTOL,
-                                                nmatch = XYNMATCH,
-                                                separation = XYSEP,
-                                                verbose = "yes",
-                                                Stdout=1)
-                        except iraf.IrafError,e:
-                            logger.exception('XYXYMATCH failed due to '
-                                             'IrafError!')
-                            #if not WREGISTER:
-                            #    logger.warning('XYXYMATCH failed!')
-                            #    return None,'XYERROR'
-                        else:
-                            logger.debug('XYXYMATCH output:\n'+'\n'\
-                                         .join(l for l in xyout if l))
-                            xyxymatches = int(xyout[-1].split()[0])
-                            logger.info('XYXYMATCH matched objects = %i' 
-                                        % xyxymatches)       
-
-        if xyxymatches < XYMIN:
-            if SEARCHRAD > 0:
-                logger.warning('XYXYMATCH didn\'t find transformation on '
-                               'second pass')
-            else:
-                logger.warning('XYXYMATCH didn\'t find transformation '
-                               'initially')
-            logger.info('attempting XYXYMATCH using tolerance matching')
-            # finally, let's try xyxymatch with the `tolerance` algorithm 
-            # (triangles is used previous). see iraf docs for info.
-    
-            try:
-                os.remove('/tmp/CLASPmatch.coo')
-            except OSError:
-                pass
-            try:
-                xyout = iraf.xyxymatch(input = imagecoo,
-                                       reference = tempcoo,
-                                       output = '/tmp/CLASPmatch.coo',
-                                       matching='tolerance',
-                                       tolerance = 5,
-                                       nmatch = XYNMATCH,
-                                       separation = XYSEP,
-                                       verbose = "yes",
-                                       Stdout=1)
-            except iraf.IrafError,e:
-                logger.exception('XYXYMATCH failed due to IrafError!')
-                #if not WREGISTER:
-                #    logger.warning('XYXYMATCH failed!')
-                #    return None,'XYERROR'
-            else:
-                logger.debug('XYXYMATCH output:\n'+'\n'\
-                             .join(l for l in xyout if l))
-                xyxymatches = int(xyout[-1].split()[0])
-                logger.info('XYXYMATCH matched objects = %i' % xyxymatches)
-
-        if xyxymatches >= XYMIN:
+        if xyxymatches >= XYMIN and TRANSMETHOD == 'numpy':
+            # xyxymatch has worked
+            # now compute and perform the transformation in process
+            if geotransform(image,template,matchcoo,outimage):
+                logger.info('alignment sucessful with XYXYMATCH/GEOTRANS')
+                return outimage,'XYSUCCESS'
+        elif xyxymatches >= XYMIN:
             # xyxymatch has worked
             # now compute and perform the transformation
             ysize,xsize = pyfits.getdata(template).shape
             try:
                 logger.debug('running GEOMAP to calculate transformation')
                 iraf.unlearn(iraf.geomap)
-                mapout = iraf.geomap(input = '/tmp/CLASPmatch.coo',
-                                     database = '/tmp/CLASPgeomap.db',
+                mapout = iraf.geomap(input = matchcoo,
+                                     database = geomapdb,
                                      xmin = 1,
                                      xmax = xsize,
                                      ymin = 1,
@@ -721,8 +812,8 @@ def align_images(image,template,imagecoo,tempcoo,
                 iraf.unlearn(iraf.geotran)
                 tranout = iraf.geotran(input = image,
                                        output = outimage,
-                                       database = '/tmp/CLASPgeomap.db',
-                                       transforms = '/tmp/CLASPmatch.coo',
+                                       database = geomapdb,
+                                       transforms = matchcoo,
                                        boundary = 'constant',
                                        constant = 0,
                                        Stdout = 1)
@@ -771,60 +862,288 @@ def align_images(image,template,imagecoo,tempcoo,
         return retval,aligninfo
 
 
-def objectfind(image,imagesat=55000,thresh=10,minobj=10,maxobj=50,
-                maxattempts=20):
-    """
-    Performs SExtractor recursively to find number of objects between
-    given limits
+def xyxymatch_iraf(imagecoo,tempcoo,matchcoo):
     """
+    Matches the objects in imagecoo to those in tempcoo with iraf.xyxymatch,
+    writing the matches to matchcoo.
 
-    logger.debug('SExtractor called with minobj=%i, maxobj=%i for '
-                 '%i attempts' % (minobj,maxobj,maxattempts))
+    The triangles algorithm is tried first, then again on only those image
+    objects within SEARCHRAD of a template object, and finally the
+    tolerance algorithm.
 
-    # define a counter to ensure we don't end up in infinite loop
-    counter = 0
-    while True:
-        counter += 1
-        if counter > maxattempts:
-            print ' '*50+'\r'
-            logger.warning('reached max iterations! proceeding with numobj=%i'
-                           % numobj)
-            break
-        
-        starfile = alardwrap.runsex(image,thresh,imagesat)
+    OUTPUT
+        the number of matched objects
+    """
+    logger.info('trying to compute alignment with XYXYMATCH')
+    xyxymatches = 0 # assign now since we conditionally assign later
+                    # in the absence of IrafErrors
+    iraf.unlearn(iraf.xyxymatch)
+    try:
+        xyout = iraf.xyxymatch(input = imagecoo,
+                               reference = tempcoo,
+                               output = matchcoo,
+                               tolerance = XYTOL,
+                               nmatch = XYNMATCH,
+                               separation = XYSEP,
+                               verbose="yes",
+                               Stdout=1)
+    except iraf.IrafError,e:
+        logger.exception('XYXYMATCH failed due to IrafError!')
+        #if not WREGISTER:
+        #    logger.warning('XYXYMATCH failed!')
+        #    return None,'XYERROR'
+    else:
+        logger.debug('XYXYMATCH output:\n'+'\n'.join(l for l in xyout if l))
+        xyxymatches = int(xyout[-1].split()[0])
+        logger.info('XYXYMATCH matched objects = %i' % xyxymatches)
+
+    if xyxymatches < XYMIN and SEARCHRAD != 0:
+        logger.warning('XYXYMATCH didn\'t find transformation initially')
+        logger.info('attempting XYXYMATCH with objects located within '
+                    'SEARCHRAD')
+        ia = np.atleast_2d(np.genfromtxt(imagecoo))
+        ta = np.atleast_2d(np.genfromtxt(tempcoo))
+        # keep only those image objects with a template object nearby
+        ia = ia[crossmatch.within(ia,ta,SEARCHRAD)]
+        numcoincident = len(ia)
+
+        if numcoincident < XYMIN:
+            logger.warning('objects within %i pixels on image'
+                         ' and template (%i) < XYMIN' % (SEARCHRAD,
+                                                          numcoincident))
+            logger.info('check your XYMIN and SEARCHRAD values')
+            #if not WREGISTER:
+            #    return None,'NOCOIN*'
+        else:
+            for junk in (imagecoo,matchcoo):
+                try:
+                    os.remove(junk)
+                except OSError:
+                    pass
+                    #save the reduced image object list
+                    np.savetxt(imagecoo,ia,fmt='%13.3f')
+                    #repeat xyxymatch with the reduced list
+                    logger.info('repeating XYXYMATCH with reduced '
+                                'coordinate list')
+                    try:
+                        xyout = iraf.xyxymatch(input = imagecoo,
+                                            reference = tempcoo,
+                                            output = matchcoo,
+                                            tolerance = XYTOL,
+                                            nmatch = XYNMATCH,
+                                            separation = XYSEP,
+                                            verbose = "yes",
+                                            Stdout=1)
+                    except iraf.IrafError,e:
+                        logger.exception('XYXYMATCH failed due to '
+                                         'IrafError!')
+                        #if not WREGISTER:
+                        #    logger.warning('XYXYMATCH failed!')
+                        #    return None,'XYERROR'
+                    else:
+                        logger.debug('XYXYMATCH output:\n'+'\n'\
+                                     .join(l for l in xyout if l))
+                        xyxymatches = int(xyout[-1].split()[0])
+                        logger.info('XYXYMATCH matched objects = %i' 
+                                    % xyxymatches)       
+
+    if xyxymatches < XYMIN:
+        if SEARCHRAD > 0:
+            logger.warning('XYXYMATCH didn\'t find transformation on '
+                           'second pass')
+        else:
+            logger.warning('XYXYMATCH didn\'t find transformation '
+                           'initially')
+        logger.info('attempting XYXYMATCH using tolerance matching')
+        # finally, let's try xyxymatch with the `tolerance` algorithm 
+        # (triangles is used previous). see iraf docs for info.
+
+        try:
+            os.remove(matchcoo)
+        except OSError:
+            pass
         try:
-            starfilearray = np.genfromtxt(starfile)
-        except (IOError,TypeError):
-            numobj = 0
+            xyout = iraf.xyxymatch(input = imagecoo,
+                                   reference = tempcoo,
+                                   output = matchcoo,
+                                   matching='tolerance',
+                                   tolerance = 5,
+                                   nmatch = XYNMATCH,
+                                   separation = XYSEP,
+                                   verbose = "yes",
+                                   Stdout=1)
+        except iraf.IrafError,e:
+            logger.exception('XYXYMATCH failed due to IrafError!')
+            #if not WREGISTER:
+            #    logger.warning('XYXYMATCH failed!')
+            #    return None,'XYERROR'
         else:
-            if len(starfilearray) == 0:
-                numobj = 0
-            else:
-                numobj = len(np.atleast_2d(starfilearray))
+            logger.debug('XYXYMATCH output:\n'+'\n'\
+                         .join(l for l in xyout if l))
+            xyxymatches = int(xyout[-1].split()[0])
+            logger.info('XYXYMATCH matched objects = %i' % xyxymatches)
 
-        print 'attempt %i/%i\tthreshold: %i\t numobj: %i          \r'\
-              % (counter,maxattempts,thresh,numobj),
+    return xyxymatches
 
-        if numobj > maxobj: 
-            thresh += 5
-        elif numobj < minobj:
-            thresh -= 2
-        else:
-            # clear current line of attempt/threshold info
-            print ' '*50+'\r'
-            break
-        if thresh < 8:
-            print ' '*50+'\r'
-            logger.warning('low number of objects found by SExtractor'
-                           ' at minimum threshold!')
-            break
 
+def starmatch_coords(imagecoo,tempcoo,matchcoo):
+    """
+    Matches the objects in imagecoo to those in tempcoo with
+    pipemodules.starmatch, writing the matches to matchcoo in the format
+    of xyxymatch's output (x_ref y_ref x_in y_in) for geomap.
+
+    OUTPUT
+        the number of matched objects
+    """
+    logger.info('trying to compute alignment with STARMATCH')
+    try:
+        ia = np.atleast_2d(np.genfromtxt(imagecoo))
+        ta = np.atleast_2d(np.genfromtxt(tempcoo))
+    except IOError:
+        logger.exception('couldn\'t read object lists to match')
+        return 0
+    if ia.size == 0 or ta.size == 0:
+        logger.warning('no objects to match')
+        return 0
+    idx,tempidx = starmatch.match(ia[:,:2],ta[:,:2],nmatch=XYNMATCH,
+                                  tolerance=XYTOL,separation=XYSEP)
+    np.savetxt(matchcoo,np.column_stack([ta[tempidx,:2],ia[idx,:2]]),
+               fmt='%13.3f')
+    logger.info('STARMATCH matched objects = %i' % len(idx))
+    return len(idx)
+
+
+def geotransform(image,template,matchcoo,outimage):
+    """
+    Fits the transformation between image and template from the matched
+    objects in matchcoo and resamples image onto the template's pixel grid,
+    with pipemodules.geotrans (in place of geomap/geotran).
+
+    INPUT
+        image:
+                filepath of the image to align
+        template:
+                filepath of the template
+        matchcoo:
+                matched coordinates, as output by xyxymatch
+        outimage:
+                filepath for the aligned image to be written to
+    OUTPUT
+        True if successful
+    """
+    try:
+        m = np.atleast_2d(np.genfromtxt(matchcoo))
+        t = geotrans.fit(m[:,:2],m[:,2:4],order=GEOORDER,reject=GEOREJECT)
+    except (IOError,IndexError,ValueError,np.linalg.LinAlgError):
+        logger.exception('GEOTRANS couldn\'t fit a transformation!')
+        return False
+    logger.info('GEOTRANS fit from %i of %i matches, rms x=%.3f y=%.3f'
+                % (t.used.sum(),len(m),t.xrms,t.yrms))
+    logger.debug('GEOTRANS coefficients x: %s y: %s' % (t.xcoeffs,t.ycoeffs))
+
+    hdu = pyfits.open(image)
+    data = hdu[0].data
+    header = hdu[0].header.copy()
+    hdu.close()
+    templatehdr = pyfits.getheader(template)
+    shape = (templatehdr['NAXIS2'],templatehdr['NAXIS1'])
+    aligned = geotrans.resample(data,t,shape)
+    # the data is no longer scaled integers
+    for key in ('BZERO','BSCALE'):
+        if key in header:
+            del header[key]
+    pyfits.writeto(outimage,aligned,header,clobber=True,
+                   output_verify='ignore')
+    return True
+
+
+def objectfind(image,imagesat=55000,thresh=10,minobj=10,maxobj=50,
+               minthresh=MINTHRESH,role='image'):
+    """
+    Finds between minobj and maxobj objects in image with SExtractor.
+
+    INPUT
+        image:
+                filepath of image
+        imagesat [55000]:
+                saturation level
+        thresh [10]:
+                preferred detection threshold (sigma), used for the first
+                frame of a role. later frames prefer the last threshold
+                chosen for the role in this process
+        minobj,maxobj [10,50]:
+                limits on the number of objects
+        minthresh [MINTHRESH]:
+                lowest detection threshold
+        role ['image']:
+                'template' or 'image', so that one never warm starts the
+                other
+    OUTPUT
+        the number of objects found and the threshold they were found at
+
+    SExtractor is run at minthresh, and each object's peak S/N tells us
+    the thresholds it would be found at, so a threshold satisfying the
+    limits (nearest the preferred one, to 0.1 sigma) is picked from it. This
+    ignores the minimum area and deblending at that threshold, so the count
+    is then confirmed by running SExtractor again at it, and the objects it
+    finds written to image's `.stars` and `.coo` lists.
+    """
+    logger.debug('SExtractor called with minobj=%i, maxobj=%i'
+                 % (minobj,maxobj))
+
+    starfile = alardwrap.runsex(image,minthresh,imagesat,method=SEXMETHOD)
+    if starfile is None:
+        return 0,minthresh
+    try:
+        stars,columns = alardwrap.read_stars(starfile,columns=True)
+    except IOError:
+        stars,columns = np.zeros((0,0)),[]
+
+    # peak S/N of each object (the THRESHOLD column is minthresh sigma)
+    if len(stars):
+        snr = stars[:,columns.index('FLUX_MAX')]/\
+              stars[:,columns.index('THRESHOLD')]*minthresh
+    else:
+        snr = np.zeros(0)
+    snr = np.sort(snr)[::-1]
+    # the number found at threshold t is about the number with snr above t,
+    # so thresholds in [lo,hi) satisfy the limits
+    if len(snr) < minobj:
+        logger.warning('low number of objects found by SExtractor'
+                       ' at minimum threshold!')
+        lo = hi = minthresh
+    else:
+        lo = max(snr[maxobj],minthresh) if len(snr) > maxobj else minthresh
+        hi = snr[minobj-1]
+    # NB: the warm start makes an image's threshold (so its .coo list and
+    # alignment) depend on which frames this process ran before it, i.e. on
+    # processing order, -j and -q, not only on the image's own inputs. any
+    # threshold in [lo,hi) satisfies the limits, so the difference is small
+    preferred = _lastthresh.get(role,thresh)
+    # keep to one decimal place if there is room to
+    steps = np.arange(np.ceil(lo*10),np.ceil(hi*10))/10.
+    if len(steps):
+        thresh = steps[np.argmin(np.abs(steps-preferred))]
+    else:
+        thresh = lo
+    _lastthresh[role] = thresh
+
+    if thresh != minthresh:
+        starfile = alardwrap.runsex(image,thresh,imagesat,method=SEXMETHOD)
+        if starfile is None:
+            return 0,thresh
+        try:
+            stars = alardwrap.read_stars(starfile)
+        except IOError:
+            stars = np.zeros((0,0))
+    numobj = len(stars)
+    if not minobj <= numobj <= maxobj and len(snr) >= minobj:
+        logger.debug('%i objects found at threshold %.1f, outside the '
+                     'limits estimated for it' % (numobj,thresh))
 
     # we don't want to be printing out hundreds of lines to the log file:
-    with open(starfile) as f:
-        out = f.readlines(30)        
-    logger.debug('SExtractor output:\n'+''\
-                 .join(l for l in out if not l.startswith('#')))
+    logger.debug('SExtractor output:\n'+'\n'.join(' '.join('%.10g' % v
+                 for v in row) for row in stars[:30]))
 
     try:
         os.remove(os.path.splitext(image)[0]+'.coo')
@@ -882,7 +1201,7 @@ def subtract_images(image,template,ISIScfg='ISIScfg.py',imagethresh=25,
                             hms=hms,hss=hss,sg1=sg1,sg2=sg2,sg3=sg3,
                             deg_bg=deg_bg,removeconv=removeconv,
                             iterkernelsig=iterkernelsig,adapt=adapt,
-                            stamps=stamps)
+                            stamps=stamps,sexmethod=SEXMETHOD)
     except NameError:
         logger.exception('check ISIScfg file (%s). Parameter missing (see '
                          'traceback)' % ISIScfg)
@@ -919,7 +1238,7 @@ def subtract_images(image,template,ISIScfg='ISIScfg.py',imagethresh=25,
                             hms=hms,hss=hss,sg1=sg1,sg2=sg2,sg3=sg3,
                             removeconv=removeconv,
                             iterkernelsig=iterkernelsig,adapt=adapt,
-                            stamps=stamps)
+                            stamps=stamps,sexmethod=SEXMETHOD)
         # if it's still rubbish then probably misalignment or rubbish data
         if alardfail:
             logger.info('runalard returned code %s for ISIS' % alardfail)
@@ -990,14 +1309,3 @@ def make_png(image):
     f2nimage.tonet(pngfilename)
 
 
-@atexit.register
-def cleanup():
-    junk = ['CLASPobjmask.fits','conv.fits','conv0.fits','default_config',
-            'kernel_table','toto.bmp','imxymatch.1','/tmp/CLASPmatch.coo',
-            '/tmp/CLASPgeomap.db','wregister.db','kernel_coeff0','STAMPS']
-    for f in junk:
-        try:
-            os.remove(f)
-        except OSError:
-            pass
-